@@ -0,0 +1,121 @@
+'''
+Benchmarks the EmrPhraseMatcher build on synthetic rule tables of increasing size, ie:
+python benchmarkPhraseMatcher.py --sizes 10000 100000 1000000
+
+For every size, reports:
+- build time and peak resident memory of the streaming build (EmrPhraseMatcher.buildAssetsFromPhrases)
+- the same for the previous build, which tokenized every phrase into a list of docs (with --legacy)
+- size of the saved component, and of the pickled matcher saved previously (with --legacy)
+- match throughput over synthetic notes, in tokens per second
+Each measurement runs in a fresh process, so that peak memory is not carried over from an earlier run.
+'''
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import argparse
+import multiprocessing
+import pickle
+import random
+import resource
+import time
+
+import spacy
+from spacy.matcher import PhraseMatcher
+
+from components import helperFunctions, lruCache, ruleGenerations
+from components.tokenizer import customTokenizer
+from components.ruleBasedMedicalCondition import EmrPhraseMatcher
+
+SYLLABLES = ["hy", "per", "ten", "sion", "dia", "be", "tes", "as", "thma", "car", "dio", "my", "op", "a", "thy",
+             "neu", "ro", "path", "ic", "gas", "tro", "en", "ter", "itis", "chron", "pul", "mo", "nar", "al", "ve"]
+
+
+def makeWords(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    words = set()
+    while len(words) < count:
+        words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 5))))
+    return sorted(words)
+
+
+def iterPhrases(size: int, words, seed: int = 1):
+    '''Yields size distinct phrases of one to four words, the way getRuleBasedPhrases streams the rule table.'''
+    rng = random.Random(seed)
+    seen = set()
+    while len(seen) < size:
+        phrase = " ".join(rng.choice(words) for _ in range(rng.choice([1, 1, 2, 2, 2, 3, 4])))
+        if phrase not in seen:
+            seen.add(phrase)
+            yield phrase
+
+
+def makeNotes(count: int, words, seed: int = 2):
+    rng = random.Random(seed)
+    filler = ["patient", "was", "seen", "today", "with", "no", "history", "of", "and", "the", "reports", "mild"]
+    return [" ".join(rng.choice(words) if rng.random() < 0.2 else rng.choice(filler) for _ in range(200)) + "."
+            for _ in range(count)]
+
+
+def _peakMemory():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # kilobytes on Linux
+
+
+def _measureBuild(size, legacy, noteCount, output):
+    nlp = spacy.blank("en")
+    nlp.tokenizer = customTokenizer(nlp)
+    words = makeWords(max(1000, size // 20))
+    baseline = _peakMemory()
+    component = EmrPhraseMatcher(nlp)
+
+    start = time.perf_counter()
+    if legacy:
+        matcher = PhraseMatcher(nlp.vocab, attr="LOWER")
+        matcher.add("emr_phrase", list(nlp.tokenizer.pipe(iterPhrases(size, words))))
+        buildTime = time.perf_counter() - start
+        savedSize = len(pickle.dumps((matcher,)))
+    else:
+        component.setAssets(component.buildAssetsFromPhrases(iterPhrases(size, words), nlp.tokenizer))
+        matcher = component.matcher
+        buildTime = time.perf_counter() - start
+        with TemporaryDirectory() as tmp:
+            component.to_disk(Path(tmp)/"emr_phrase_matcher")
+            savedSize = (Path(tmp)/"emrphrasematcher.bin").stat().st_size
+    peak = _peakMemory() - baseline
+
+    docs = list(nlp.tokenizer.pipe(makeNotes(noteCount, words)))
+    start = time.perf_counter()
+    matches = sum(len(matcher(doc)) for doc in docs)
+    matchTime = time.perf_counter() - start
+
+    output.put({
+        "buildSeconds": buildTime,
+        "peakBuildBytes": peak,
+        "savedBytes": savedSize,
+        "tokensPerSecond": sum(len(doc) for doc in docs) / matchTime if matchTime else 0.0,
+        "matchesPerNote": matches / noteCount,
+    })
+
+
+def measure(size: int, legacy: bool = False, noteCount: int = 2000) -> dict:
+    context = multiprocessing.get_context("spawn")
+    output = context.Queue()
+    process = context.Process(target=_measureBuild, args=(size, legacy, noteCount, output))
+    process.start()
+    result = output.get()
+    process.join()
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the EmrPhraseMatcher build on synthetic rule tables.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000], help="Numbers of phrases.")
+    parser.add_argument("--legacy", action="store_true", help="Also measure the previous build, which keeps every pattern doc in memory.")
+    parser.add_argument("--notes", type=int, default=2000, help="Number of synthetic notes of 200 words to match.")
+    args = parser.parse_args()
+
+    builds = [("streaming", False)] + ([("legacy", True)] if args.legacy else [])
+    print(f"{'phrases':>10} {'build':>10} {'seconds':>9} {'peak MB':>9} {'saved MB':>9} {'tokens/s':>12}")
+    for size in args.sizes:
+        for name, legacy in builds:
+            result = measure(size, legacy, args.notes)
+            print(f"{size:>10} {name:>10} {result['buildSeconds']:>9.1f} {result['peakBuildBytes'] / 2**20:>9.1f} "
+                  f"{result['savedBytes'] / 2**20:>9.1f} {result['tokensPerSecond']:>12.0f}")
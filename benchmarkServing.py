@@ -0,0 +1,58 @@
+'''
+Checks that one loaded pipeline gives the same results on several threads as on one, and compares the throughput of
+a single thread, ThreadedPool and PreforkPool over a corpus file with one note per line, ie:
+python benchmarkServing.py notes.txt --threads 2 4 8 --workers 4
+
+The stress check processes every note several times (--rounds), shuffled, so that threads process the same notes and
+different notes at the same time, and compares the results of every note with the results of a single thread.
+For every mode, reports notes per second and the speedup over a single thread.
+'''
+from pathlib import Path
+import argparse
+import time
+
+import spacy
+
+from components.equivalence import EQUIVALENCE_FIELDS
+from components.workerPool import PreforkPool, ThreadedPool, runSingleThread, stressThreads
+
+
+def readCorpus(path: Path):
+    with open(path, mode='r', encoding='utf-8') as f:
+        return [line.rstrip("\n") for line in f if line.strip()]
+
+
+def runPool(pool, texts):
+    start = time.perf_counter()
+    results = list(pool.pipe(texts))
+    return results, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check and benchmark serving one pipeline on threads and processes.")
+    parser.add_argument("corpus", type=Path, help="Corpus file, one note per line.")
+    parser.add_argument("--model", default="en_emr_pipeline_nlp", help="Package name or path of the pipeline.")
+    parser.add_argument("--threads", type=int, nargs="+", default=[2, 4, 8], help="Numbers of threads to measure.")
+    parser.add_argument("--workers", type=int, nargs="*", default=[4], help="Numbers of worker processes to measure.")
+    parser.add_argument("--rounds", type=int, default=3, help="Times every note is processed by the stress check.")
+    args = parser.parse_args()
+
+    nlp = spacy.load(args.model)
+    texts = readCorpus(args.corpus)
+    reference, seconds = runSingleThread(nlp, texts)
+
+    print(f"{'mode':>12} {'notes/s':>10} {'speedup':>8}")
+    print(f"{'1 thread':>12} {len(texts) / seconds:>10.1f} {1.0:>8.2f}")
+    for threads in args.threads:
+        with ThreadedPool(nlp, threads=threads) as pool:
+            _, poolSeconds = runPool(pool, texts)
+        print(f"{f'{threads} threads':>12} {len(texts) / poolSeconds:>10.1f} {seconds / poolSeconds:>8.2f}")
+    for workers in args.workers:
+        with PreforkPool(nlp, workers=workers) as pool:
+            _, poolSeconds = runPool(pool, texts)
+        print(f"{f'{workers} processes':>12} {len(texts) / poolSeconds:>10.1f} {seconds / poolSeconds:>8.2f}")
+
+    for threads in args.threads:
+        report = stressThreads(nlp, texts, reference, threads, args.rounds, fields=EQUIVALENCE_FIELDS)
+        print(f"stress check, {threads} threads: {report['mismatches']} of {report['notes']} notes differ"
+              + (f", first: {report['example']}" if report["example"] else ""))
@@ -1,10 +1,19 @@
 import spacy
+from spacy import registry
 from spacy.cli.package import package
 from pathlib import Path
+import argparse
+import json
 
 import dataFunctions
+import buildCache
+from buildCache import rmdir
 
 from components import helperFunctions
+from components import lruCache
+from components import ruleGenerations
+from components import matchRecords
+from components import docResults
 from components.tokenizer import customTokenizer
 from components import demograph
 from components import ruleBasedMedicalCondition
@@ -12,69 +21,177 @@ from components import sentencizer
 from components import negation
 from components import postProcess
 from components import sectionizer
+from components import boilerplate
+from components import prefilter
+from components import spellNormalizer
+from components import timeBudget
 from components import xgb
+from components import equivalence
 
 
-def rmdir(directory: Path):
-    if directory.is_dir():
-        for item in directory.iterdir():
-            if item.is_dir():
-                rmdir(item)
-            else:
-                item.unlink()
-        directory.rmdir()
+VARIANTS = ["rules", "rules_fast"]
+'''
+Pipeline variants that can be built:
+rules: components on top of en_core_web_sm, negation patterns match on lemmas.
+rules_fast: components on a blank tokenizer-only pipeline, negation patterns match on lemma surface forms.
+'''
 
 
-def makePipe():
-    modelName = 'en_core_web_sm'
-    nlp = spacy.load(modelName, disable=['parser', 'ner'])
+BUILD_CACHE_DIR = Path(__file__).parent/".buildcache"
+
+
+def getBuildInputs(name):
+    '''
+    Returns the files a component build depends on: its code, the code of the rule table readers, and its source tables.
+    A change to any of these files invalidates the cached build of the component.
+    '''
+    dir = Path(__file__).parent
+    code = [dir/"dataFunctions.py", dir/"components/helperFunctions.py", dir/"components/tokenizer.py"]
+    inputs = {
+        "emr_boilerplate": [dir/"components/boilerplate.py", Path("data/phrase_to_condition.csv"), Path("data/demographs.csv")]
+        + sorted(Path("data/boilerplate_sample").glob("*.txt")),
+        "emr_prefilter": [dir/"components/prefilter.py", Path("data/phrase_to_condition.csv"), Path("data/demographs.csv")],
+        "emr_sectionizer": [dir/"components/sectionizer.py", Path("data/sections.csv")],
+        "emr_phrase_matcher": [dir/"components/ruleBasedMedicalCondition.py", Path("data/phrase_to_condition.csv")],
+        "emr_spell_normalizer": [dir/"components/spellNormalizer.py", Path("data/phrase_to_condition.csv"), Path("data/demographs.csv")],
+        "demograph_matcher": [dir/"components/demograph.py", Path("data/demographs.csv")],
+        "negation_matcher": [dir/"components/negation.py"],
+        "med_cond_detect": [dir/"components/ruleBasedMedicalCondition.py", Path("data/phrase_to_condition.csv")],
+        "xgb_binary_classifier": [dir/"components/xgb.py", Path("data/xgbModels.py"), Path("data/xgb_vectorizer.model")]
+        + [Path("data")/i["path"] for i in dataFunctions.modelConfigs],
+    }
+    return code + inputs[name]
+
+
+def getConceptMapInput(name):
+    '''
+    Returns the concept names a component build looks up with the 'getConceptMap' registry function (ie. from the OMOP
+    concept table), as sorted (concept id, name) pairs, or None if the component saves none. The names are saved with
+    the component, so a change to them invalidates the cached build of the component, like a change to its files.
+    '''
+    if name == "med_cond_detect":
+        conceptIds = ruleBasedMedicalCondition.getSearchAsset()[2]
+    elif name == "demograph_matcher":
+        conceptIds = [rule["omopConceptId"] for rule in registry.get("misc", "getDemographRules")()]
+    else:
+        return None
+    if not registry.has("misc", "getConceptMap"):
+        return None
+    return sorted((str(conceptId), str(conceptName)) for conceptId, conceptName in registry.get("misc", "getConceptMap")(conceptIds).items())
+
+
+def getBuildKey(name, variant, **buildArgs):
+    '''Returns a hash of the build inputs of a component, the concept names it saves, the pipeline variant and the build arguments.'''
+    return buildCache.getBuildKey(name, variant, getBuildInputs(name), getConceptMapInput(name), **buildArgs)
+
+
+def buildComponent(nlp, name, variant, cacheDir: Path = BUILD_CACHE_DIR, **buildArgs):
+    '''
+    Builds a component, or restores it from the build cache if none of its build inputs changed since it was cached.
+    Pass cacheDir=None to always build.
+    '''
+    if cacheDir is None:
+        nlp.get_pipe(name).build(**buildArgs)
+        return
+    buildCache.buildComponent(nlp, name, getBuildKey(name, variant, **buildArgs), cacheDir, **buildArgs)
+
+
+def makePipe(variant="rules", cacheDir: Path = BUILD_CACHE_DIR, treeEngine=False, spellNormalizer=False, boilerplate=False, prefilter=False,
+             compactRules=False):
+    if variant == "rules_fast":
+        nlp = spacy.blank("en")
+    else:
+        modelName = 'en_core_web_sm'
+        nlp = spacy.load(modelName, disable=['parser', 'ner'])
     nlp.tokenizer = customTokenizer(nlp)
+    # med_cond_detect and its build key need the whole rule table, so it is parsed first: the components built from its
+    # phrases then read them from this parse instead of streaming the table again
+    ruleBasedMedicalCondition.getSearchAsset()
+    if prefilter:
+        nlp.add_pipe("emr_prefilter", first=True)
+        buildComponent(nlp, "emr_prefilter", variant, cacheDir)
+    nlp.add_pipe("emr_time_budget", first=True)
     nlp.add_pipe("custom_sentencizer", last=True)
+    if boilerplate:
+        nlp.add_pipe("emr_boilerplate", last=True)
+        buildComponent(nlp, "emr_boilerplate", variant, cacheDir)
     nlp.add_pipe("emr_sectionizer", last=True)
-    nlp.get_pipe("emr_sectionizer").build()
+    buildComponent(nlp, "emr_sectionizer", variant, cacheDir)
     nlp.add_pipe("emr_phrase_matcher", last=True)
-    nlp.get_pipe("emr_phrase_matcher").build()
+    buildComponent(nlp, "emr_phrase_matcher", variant, cacheDir)
+    if spellNormalizer:
+        nlp.add_pipe("emr_spell_normalizer", last=True)
+        buildComponent(nlp, "emr_spell_normalizer", variant, cacheDir)
     nlp.add_pipe("demograph_matcher", last=True)
-    nlp.get_pipe("demograph_matcher").build()
-    nlp.add_pipe("negation_matcher", last=True)
-    nlp.get_pipe("negation_matcher").build()
+    buildComponent(nlp, "demograph_matcher", variant, cacheDir)
+    # rules_fast has no lemmatizer, so its negation matcher is the lemma-free factory, which does not require lemmas
+    nlp.add_pipe("negation_matcher_lemma_free" if variant == "rules_fast" else "negation_matcher", name="negation_matcher", last=True)
+    buildComponent(nlp, "negation_matcher", variant, cacheDir)
     nlp.add_pipe("med_cond_detect", last=True)
-    nlp.get_pipe("med_cond_detect").build()
+    buildComponent(nlp, "med_cond_detect", variant, cacheDir, compact=compactRules)
     nlp.add_pipe("post_process", last=True)
     nlp.add_pipe("xgb_binary_classifier", last=True)
-    nlp.get_pipe("xgb_binary_classifier").build()
+    buildComponent(nlp, "xgb_binary_classifier", variant, cacheDir, treeEngine=treeEngine, compactVocabulary=True)
     return nlp
 
 
-def savePipe(nlp):
+def getBuildDir(variant="rules"):
     dir = Path(__file__).parent
-    buildDir = dir/"build"
+    return dir/"build" if variant == "rules" else dir/f"build_{variant}"
+
+
+def savePipe(nlp, variant="rules"):
+    buildDir = getBuildDir(variant)
     rmdir(buildDir)
     buildDir.mkdir(parents=True, exist_ok=True)
     nlp.to_disk(buildDir)
 
 
-def packagePipe():
+def packagePipe(variant="rules"):
     dir = Path(__file__).parent
     codePaths = [
         "components/helperFunctions.py",
+        "components/lruCache.py",
+        "components/ruleGenerations.py",
+        "components/matchRecords.py",
+        "components/docResults.py",
         "components/demograph.py",
         "components/negation.py",
         "components/postProcess.py",
         "components/ruleBasedMedicalCondition.py",
         "components/sectionizer.py",
+        "components/boilerplate.py",
+        "components/prefilter.py",
         "components/sentencizer.py",
+        "components/spellNormalizer.py",
+        "components/timeBudget.py",
         "components/tokenizer.py",
-        "components/xgb.py"
+        "components/xgb.py",
+        "components/resultCache.py",
+        "components/incremental.py",
+        "components/pipelineProfiles.py",
+        "components/workerPool.py",
+        "components/patientAggregator.py",
+        "components/equivalence.py"
     ]
 
-    packageDir = dir/"package"
+    packageDir = dir/"package" if variant == "rules" else dir/f"package_{variant}"
     rmdir(packageDir)
     packageDir.mkdir(parents=True, exist_ok=True)
+
+    metaPath = dir/"meta.json"
+    if variant != "rules":
+        with open(metaPath, mode='r', encoding='utf-8') as f:
+            meta = json.load(f)
+        meta["name"] = f"{meta['name']}_{variant}"
+        metaPath = packageDir/"meta.json"
+        with open(metaPath, mode='w', encoding='utf-8') as f:
+            json.dump(meta, f, indent=2)
+
     package(
-        input_dir=dir/"build",
+        input_dir=getBuildDir(variant),
         output_dir=packageDir,
-        meta_path=dir/"meta.json",
+        meta_path=metaPath,
         code_paths=[dir/i for i in codePaths],
         create_meta=False,
         create_sdist=True,
@@ -84,7 +201,49 @@ def packagePipe():
     )
 
 
+def reportNegationAgreement(nlp, referenceNlp, corpusPath: Path):
+    '''Prints the agreement of the negation results of two pipelines over a corpus file with one note per line.'''
+    with open(corpusPath, mode='r', encoding='utf-8') as f:
+        texts = [line.rstrip("\n") for line in f if line.strip()]
+    report = negation.getNegationAgreementReport(referenceNlp, nlp, texts)
+    print(json.dumps(report, indent=2))
+
+
+def reportEquivalence(nlp, referenceNlp, corpusPath: Path):
+    '''Prints the differences between the results of two pipelines over a corpus file with one note per line, and the speedup.'''
+    with open(corpusPath, mode='r', encoding='utf-8') as f:
+        texts = [line.rstrip("\n") for line in f if line.strip()]
+    report = equivalence.compareOutputs(referenceNlp, nlp, texts)
+    print(json.dumps(report, indent=2, default=str))
+
+
 if __name__ == "__main__":
-    nlp = makePipe()
-    savePipe(nlp)
-    packagePipe()
+    parser = argparse.ArgumentParser(description="Build and package the EMR pipeline.")
+    parser.add_argument("--variant", choices=VARIANTS, default="rules")
+    parser.add_argument("--agreement-corpus", type=Path, default=None,
+                        help="Corpus file (one note per line) to report negation agreement against the 'rules' variant.")
+    parser.add_argument("--no-cache", action="store_true", help="Rebuild every component instead of using the build cache.")
+    parser.add_argument("--tree-engine", action="store_true",
+                        help="Export the XGB models to NumPy node arrays, so the package is scored without the xgboost runtime.")
+    parser.add_argument("--boilerplate", action="store_true",
+                        help="Add the boilerplate masker, learned from the sample notes of data/boilerplate_sample.")
+    parser.add_argument("--prefilter", action="store_true",
+                        help="Add the prefilter, which skips the rule stages for notes without any rule phrase.")
+    parser.add_argument("--spell-normalizer", action="store_true",
+                        help="Add the spell normalizer, which also detects conditions from misspelled rule phrases.")
+    parser.add_argument("--compact-rules", action="store_true",
+                        help="Hold the condition rules of med_cond_detect as integer-interned arrays instead of dictionaries of lists.")
+    parser.add_argument("--equivalence-corpus", type=Path, default=None,
+                        help="Corpus file (one note per line) to compare the results and speed of the build against a default 'rules' build.")
+    args = parser.parse_args()
+
+    nlp = makePipe(args.variant, None if args.no_cache else BUILD_CACHE_DIR, args.tree_engine, args.spell_normalizer, args.boilerplate, args.prefilter,
+                   args.compact_rules)
+    savePipe(nlp, args.variant)
+    packagePipe(args.variant)
+
+    if args.agreement_corpus and args.variant != "rules":
+        reportNegationAgreement(nlp, makePipe("rules"), args.agreement_corpus)
+
+    if args.equivalence_corpus:
+        reportEquivalence(nlp, makePipe("rules", None if args.no_cache else BUILD_CACHE_DIR), args.equivalence_corpus)
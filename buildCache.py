@@ -0,0 +1,59 @@
+import spacy
+from pathlib import Path
+import hashlib
+import json
+
+
+def rmdir(directory: Path):
+    if directory.is_dir():
+        for item in directory.iterdir():
+            if item.is_dir():
+                rmdir(item)
+            else:
+                item.unlink()
+        directory.rmdir()
+
+
+def getBuildKey(name, variant, inputPaths, conceptMapInput=None, **buildArgs):
+    '''
+    Returns a hash of the build inputs of a component (the content of the files at inputPaths), the concept names it
+    saves, the pipeline variant and the build arguments.
+    '''
+    key = [name, variant, buildArgs, spacy.__version__, conceptMapInput]
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8"))
+    for path in inputPaths:
+        digest.update(str(path.name).encode("utf-8"))
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+def buildComponent(nlp, name, key, cacheDir: Path, **buildArgs):
+    '''
+    Builds a component, or restores it from cacheDir if it was cached under the same build key (see getBuildKey).
+    Strings added to the vocab by the build (ie. matcher labels) are cached with the component and restored along with it.
+    '''
+    component = nlp.get_pipe(name)
+    artifactDir = cacheDir/f"{name}-{key}"
+    stringsPath = artifactDir/"strings.json"
+
+    if stringsPath.exists():
+        component.from_disk(artifactDir/name)
+        with open(stringsPath, mode='r', encoding='utf-8') as f:
+            for string in json.load(f):
+                nlp.vocab.strings.add(string)
+        print(f"{name}: restored from build cache {artifactDir.name}")
+        return
+
+    existingStrings = set(nlp.vocab.strings)
+    component.build(**buildArgs)
+
+    tmpDir = cacheDir/f"{artifactDir.name}.tmp"
+    rmdir(tmpDir)
+    tmpDir.mkdir(parents=True, exist_ok=True)
+    component.to_disk(tmpDir/name)
+    with open(tmpDir/"strings.json", mode='w', encoding='utf-8') as f:
+        json.dump(sorted(set(nlp.vocab.strings) - existingStrings), f)
+    rmdir(artifactDir)
+    tmpDir.rename(artifactDir)
@@ -0,0 +1,158 @@
+from typing import Iterable, List, Set, Tuple
+from collections import Counter
+from hashlib import blake2b
+from spacy.language import Language
+from spacy.tokens import Doc
+from spacy import registry
+import pickle
+import re
+
+try:
+    @Language.factory("emr_boilerplate", requires=["token.is_sent_start"], assigns=["doc._.emrBoilerplate"])
+    def createBoilerplateMasker(nlp: Language, name: str):
+        return BoilerplateMasker(nlp)
+except:
+    pass
+
+
+WORD_REGEX = re.compile(r"\w+")
+
+
+def normalizeLine(line: str) -> str:
+    '''Returns a line lowercased, with runs of whitespace collapsed, so that lines differing only in spacing share a fingerprint.'''
+    return " ".join(line.lower().split())
+
+
+def getLineFingerprint(line: str) -> int:
+    '''Returns the 64-bit fingerprint of a normalized line.'''
+    return int.from_bytes(blake2b(line.encode("utf-8"), digest_size=8).digest(), 'little')
+
+
+def iterLines(text: str) -> Iterable[Tuple[int, int]]:
+    '''Yields the character offsets (start, end) of the lines of a text, without their leading and trailing whitespace.'''
+    for match in re.finditer(r"[^\n]+", text):
+        line = match.group()
+        stripped = line.strip()
+        if stripped:
+            start = match.start() + len(line) - len(line.lstrip())
+            yield start, start + len(stripped)
+
+
+class BoilerplateMasker:
+    '''
+    Merges the tokens of every known boilerplate line (ie. disclaimers, signature blocks and template headers repeated
+    across notes) into a single token, which the phrase matchers, the spell normalizer and the negation matcher then pass
+    over in one step instead of token by token. To be placed right after custom_sentencizer: only lines made of whole
+    sentences are merged, so the sentences of the rest of the note stay as they are, and a merged line is a single
+    sentence. The text of the doc is not changed, so every output keeps the character offsets of the original note.
+    doc._.emrBoilerplate lists the character spans (start, end) that were merged.
+
+    Lines are looked up by fingerprint (see getLineFingerprint) in an index learned offline from a sample of notes
+    (see buildAssets), and saved with the pipeline.
+    '''
+
+    def __init__(self, nlp: Language):
+        self.nlp = nlp
+        self.ruleAssets = registry.get("misc", "RuleAssets")(self)
+        self.setAssets((frozenset(), 20))
+        if not Doc.has_extension("emrBoilerplate"):
+            Doc.set_extension("emrBoilerplate", default=None)
+
+    def to_disk(self, path, exclude=tuple()):
+        dataPath = path.parent/"boilerplate.bin"
+        assets = (sorted(self.fingerprints), self.minLength)
+        with open(dataPath, 'wb') as f:
+            pickle.dump(assets, f)
+
+    def from_disk(self, path, exclude=tuple()):
+        dataPath = path.parent/"boilerplate.bin"
+        with open(dataPath, 'rb') as f:
+            assets = pickle.load(f)
+        self.setAssets(assets)
+
+    def build(self, minDocuments=5, minFraction=0.01, minLength=20):
+        self.setAssets(self.buildAssets(minDocuments=minDocuments, minFraction=minFraction, minLength=minLength))
+
+    def buildAssets(self, tokenizer=None, minDocuments=5, minFraction=0.01, minLength=20):
+        '''
+        Returns new assets (fingerprints, minLength) learned from the notes of the 'getBoilerplateSample' registry function.
+        A line is boilerplate if it has at least minLength characters, and appears in at least minDocuments notes and
+        minFraction of the notes of the sample. Lines containing a phrase of the rule tables are never boilerplate, so that
+        frequent clinical lines (ie. "Patient denies chest pain.") keep being matched.
+        '''
+        if not registry.has("misc", "getBoilerplateSample"):
+            print("\033[91m WARNING:\033[0m Building without 'getBoilerplateSample' method provided via spaCy registry will result in non-function of BoilerplateMasker component.")
+            return (frozenset(), minLength)
+
+        counts = Counter()
+        documents = 0
+        for text in registry.get("misc", "getBoilerplateSample")():
+            documents += 1
+            counts.update({normalizeLine(text[start:end]) for start, end in iterLines(text) if end - start >= minLength})
+
+        threshold = max(minDocuments, minFraction * documents)
+        rulePhrases, maxWords = self._getRulePhrases()
+        fingerprints = frozenset(getLineFingerprint(line) for line, count in counts.items()
+                                 if count >= threshold and not self._containsRulePhrase(line, rulePhrases, maxWords))
+        return (fingerprints, minLength)
+
+    def _getRulePhrases(self) -> Tuple[Set[str], int]:
+        '''Returns the phrases of the rule tables as space separated words, and the largest number of words of a phrase.'''
+        phrases = []
+        if registry.has("misc", "getRuleBasedSearchAsset"):
+            _, terms, _ = registry.get("misc", "getRuleBasedSearchAsset")()
+            phrases.extend(terms)
+        if registry.has("misc", "getDemographRules"):
+            phrases.extend(phrase for rule in registry.get("misc", "getDemographRules")() for phrase in rule['phrases'])
+        phrases = {" ".join(WORD_REGEX.findall(phrase.lower())) for phrase in phrases}
+        phrases.discard("")
+        return phrases, max((phrase.count(" ") + 1 for phrase in phrases), default=0)
+
+    def _containsRulePhrase(self, line: str, rulePhrases: Set[str], maxWords: int) -> bool:
+        words = WORD_REGEX.findall(line)
+        return any(" ".join(words[i:i + n]) in rulePhrases for n in range(1, maxWords + 1) for i in range(len(words) - n + 1))
+
+    def setAssets(self, assets, generation=None):
+        '''Sets the assets (fingerprints, minLength), right away or for the docs of a rule generation (see RuleAssets).'''
+        fingerprints, self.minLength = assets
+        self.fingerprints = frozenset(fingerprints)
+        self.ruleAssets.set((self.fingerprints, self.minLength), generation)
+
+    def reload(self, background=True):
+        '''Learns a new index from the registry functions and swaps it in for the next documents. See reloadRules.'''
+        return self.ruleAssets.reload(background)
+
+    def getBoilerplateSpans(self, text: str, assets=None) -> List[Tuple[int, int]]:
+        '''
+        Returns the character spans (start, end) of the boilerplate lines of a text, looked up in the assets
+        (fingerprints, minLength) of a rule generation, the latest ones by default.
+        '''
+        fingerprints, minLength = (self.fingerprints, self.minLength) if assets is None else assets
+        if not fingerprints:
+            return []
+        return [(start, end) for start, end in iterLines(text)
+                if end - start >= minLength and getLineFingerprint(normalizeLine(text[start:end])) in fingerprints]
+
+    def __call__(self, doc: Doc, enabled: bool = True) -> Doc:
+        '''
+        Merges the boilerplate lines of a doc. Can be turned off per call, ie.
+        nlp(text, component_cfg={"emr_boilerplate": {"enabled": False}}).
+        '''
+        with registry.get("misc", "getStageBudget")(doc, "emr_boilerplate"):
+            _, assets = self.ruleAssets.get(doc)
+            # lines that do not start and end on token boundaries, or that start or end within a sentence, are left as they are
+            merged = [(start, end) for start, end in (self.getBoilerplateSpans(doc.text, assets) if enabled else [])
+                      if self._isWholeSentences(doc, doc.char_span(start, end))]
+
+            with doc.retokenize() as retokenizer:
+                for start, end in merged:
+                    span = doc.char_span(start, end)
+                    if len(span) > 1:
+                        retokenizer.merge(span)
+
+            doc._.emrBoilerplate = merged
+        return doc
+
+    @staticmethod
+    def _isWholeSentences(doc: Doc, span) -> bool:
+        return span is not None and span[0].is_sent_start and (span.end == len(doc) or doc[span.end].is_sent_start)
@@ -4,12 +4,14 @@ from spacy.language import Language
 from spacy.tokens import Doc
 from spacy.matcher import PhraseMatcher
 from operator import itemgetter
-from itertools import chain, groupby
+from itertools import chain, islice
 from spacy import registry
 from typing import Generator, List, Union
 
 try:
-    @Language.factory("demograph_matcher")
+    @Language.factory("demograph_matcher",
+                      requires=["token.is_sent_start"],
+                      assigns=["doc._.demograph", "doc._.demograph_items", "doc._.demograph_by_sent"])
     def createDemographMatcher(nlp: Language, name: str):
         return DemographMatcher(nlp)
 except:
@@ -20,9 +22,9 @@ class DemographMatcher:
 
     def __init__(self, nlp: Language):
         self.nlp = nlp
-        self.conceptMap = defaultdict(dict)
-        self.matcher = PhraseMatcher(nlp.vocab, attr="LOWER")
-        self.flattenDictionary = registry.get("misc", "flattenDictionary")
+        self.setMatchRecords = registry.get("misc", "setMatchRecords")
+        self.ruleAssets = registry.get("misc", "RuleAssets")(self)
+        self.setAssets((defaultdict(dict), PhraseMatcher(nlp.vocab, attr="LOWER")))
 
     def to_disk(self, path, exclude=tuple()):
         dataPath = path.parent/"demographmatcher.bin"
@@ -34,7 +36,7 @@ class DemographMatcher:
         dataPath = path.parent/"demographmatcher.bin"
         with open(dataPath, 'rb') as f:
             assets = pickle.load(f)
-            self.conceptMap, self.matcher = assets
+        self.setAssets(assets)
 
     def getDemographRules(self) -> Union[Generator, List]:
         print("getDemographRules")
@@ -52,37 +54,59 @@ class DemographMatcher:
             return {}
 
     def build(self):
-        self.conceptMap = defaultdict(dict)
-        conceptIds = map(itemgetter("omopConceptId"), self.getDemographRules())
+        self.setAssets(self.buildAssets())
+
+    def buildAssets(self, tokenizer=None):
+        '''Returns new assets (conceptMap, matcher) built from the 'getDemographRules' registry function.'''
+        if tokenizer is None:
+            tokenizer = self.nlp.tokenizer
+        conceptMap = defaultdict(dict)
+        matcher = PhraseMatcher(tokenizer.vocab, attr="LOWER")
+        rules = list(self.getDemographRules())
+        conceptIds = map(itemgetter("omopConceptId"), rules)
         omopConceptMap = self.getConceptMap(conceptIds)  # Concept map provided by OMOP Concept table
-        for rule in self.getDemographRules():
+        patterns = iter(tokenizer.pipe(chain.from_iterable(rule['phrases'] for rule in rules)))
+        for rule in rules:
             conceptId = rule['omopConceptId']
             # look up concept name from OMOP Concept table, if not available use 'label' specified from Demograph rule table (DemographConcept), otherwise use concept id
             conceptName = omopConceptMap.get(conceptId) or rule['label'] or str(conceptId)
-            self.conceptMap[conceptId].update({'category': rule['category'], 'concept_name': conceptName})
-            patterns = [self.nlp.make_doc(phrase) for phrase in rule['phrases']]
-            self.matcher.add(str(conceptId), patterns)
+            conceptMap[conceptId].update({'category': rule['category'], 'concept_name': conceptName})
+            matcher.add(str(conceptId), list(islice(patterns, len(rule['phrases']))))
+        return (conceptMap, matcher)
+
+    def setAssets(self, assets, generation=None):
+        '''Sets the assets (conceptMap, matcher), right away or for the docs of a rule generation (see RuleAssets).'''
+        self.conceptMap, self.matcher = assets
+        for conceptId in self.conceptMap:  # match ids are looked up as strings in the vocab of processed docs
+            self.nlp.vocab.strings.add(str(conceptId))
+        self.ruleAssets.set(assets, generation)
+
+    def reload(self, background=True):
+        '''Builds new rule assets from the registry functions and swaps them in for the next documents. See reloadRules.'''
+        return self.ruleAssets.reload(background)
 
     def __call__(self, doc: Doc) -> Doc:
-        doc.set_extension("demograph", default=None, force=True)
-        doc._.demograph = self.demographicPhraseMatcher(doc)
-        doc.set_extension("demograph_items", default=None, force=True)
-        doc._.demograph_items = chain.from_iterable(doc._.demograph.values())
-        doc.set_extension("demograph_by_sent", default=None, force=True)
-        doc._.demograph_by_sent = self.summarize(doc._.demograph)
+        with registry.get("misc", "getStageBudget")(doc, "demograph_matcher"):
+            matches = () if registry.get("misc", "isRuleSkipped")(doc) else self.demographicPhraseMatcher(doc)
+            self.setMatchRecords(doc, "demograph", "demographs", matches)
+            self.setMatchRecords(doc, "demograph_items", "demographItems", matches)
+            self.setMatchRecords(doc, "demograph_by_sent", "demographSummary", matches)
         return doc
 
     def demographicPhraseMatcher(self, doc):
-        outputMatches = defaultdict(list)
-        spans = [(match_id, doc[start:end]) for match_id, start, end in self.matcher(doc)]
+        '''Returns a DemographMatch for every demographic phrase found, in order of position.'''
+        DemographMatch = registry.get("misc", "DemographMatch")
+        _, (conceptMap, matcher) = self.ruleAssets.get(doc)
+        outputMatches = []
+        spans = [(match_id, doc[start:end]) for match_id, start, end in matcher(doc)]
         conceptIds = map(lambda i: int(doc.vocab.strings[i[0]]), spans)
-        self.runtimeConceptMap = self.getConceptMap(conceptIds)
+        runtimeConceptMap = self.getConceptMap(conceptIds)  # local, so that docs can be processed on several threads
 
         for match_id, span in spans:
             conceptId = int(doc.vocab.strings[match_id])
-            conceptDict = self.conceptMap[conceptId]
+            conceptDict = conceptMap[conceptId]
             cat = conceptDict['category']
-            label = self.runtimeConceptMap.get(conceptId) or conceptDict['concept_name']
+            label = runtimeConceptMap.get(conceptId) or conceptDict['concept_name']
             start_token = doc[span.start]
             end_token = doc[span.end-1]
             start_char = start_token.idx
@@ -90,35 +114,6 @@ class DemographMatcher:
             text = doc.text[start_char:end_char]
             sent_start_char = doc[span.sent.start].idx
             sent_end_char = doc[span.sent.end-1].idx
-            outputMatches[(sent_start_char, sent_end_char)].append({
-                "text": text,
-                "concept_id": conceptId,
-                "type": cat,
-                "label": label,
-                "start": start_char, "end": end_char})
-
-        return outputMatches
-
-    def summarize(self, sentSpans):
-
-        # produce a dictionary where key is category, value is a dictionary where key is concept id and value is list of tokens.
-        categoryDictionary = defaultdict(lambda: defaultdict(list))
-        for sentSpan, tokens in sentSpans.items():
-            sentStart, sentEnd = sentSpan
-            for token in tokens:
-                flattened = [{**d, 'sentBound': (sentStart, sentEnd)} for d in self.flattenDictionary(token)]
-                categoryDictionary[token['type']][token['concept_id']].extend(flattened)
-
-        # produce a summary data structured as the following:
-        # {category: {label:{ "concept_id": 0000, "sentences":[ {sentBound: (sentStart, sentEnd), tokens: [(tokenStart, tokenEnd) ... ]} ...] }}}
-        summary = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
-        for category, labelDictionary in categoryDictionary.items():
-            for conceptId, tokens in labelDictionary.items():
-                conceptName = self.runtimeConceptMap.get(conceptId) or self.conceptMap[conceptId]['concept_name']
-                sortedTokens = sorted(tokens, key=itemgetter('sentBound'))
-                for sentBound, group in groupby(sortedTokens, itemgetter('sentBound')):
-
-                    sentDict = {'sentBound': sentBound, 'tokens': list(map(lambda i: (i['start'], i['end']), group))}
-                    summary[category][conceptName]["concept_id"] = conceptId
-                    summary[category][conceptName]["sentences"].append(sentDict)
-        return summary
+            outputMatches.append(DemographMatch(sent_start_char, sent_end_char, start_char, end_char, text, conceptId, cat, label))
+
+        return tuple(outputMatches)
@@ -0,0 +1,82 @@
+from collections.abc import Iterator
+from spacy import registry
+from spacy.tokens import Doc
+
+
+RESULT_EXTENSIONS = [
+    "emrSections",
+    "emrPhrases",
+    "rule_based_emr_items",
+    "rule_based_emr_by_sent",
+    "demograph",
+    "demograph_items",
+    "demograph_by_sent",
+    "xgb_summary",
+    "emr_degraded",
+]
+'''Doc extensions that hold the results of the pipeline, in the order they are produced.'''
+
+
+@registry.misc("ensureResultExtensions")
+def ensureResultExtensions():
+    '''
+    Registers the result extensions that are not registered yet, so that results of components that did not run read as
+    None, and match records restored along with docs made in other processes read in their documented shape.
+    '''
+    registerRecordExtension = registry.get("misc", "registerRecordExtension")
+    for extension in RESULT_EXTENSIONS:
+        if not Doc.has_extension(extension):
+            registerRecordExtension(extension)
+
+
+def _toPlainContainers(value):
+    '''Recursively convert defaultdicts and iterators into plain dictionaries and lists so the value can be pickled.'''
+    if isinstance(value, dict):
+        return {k: _toPlainContainers(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_toPlainContainers(i) for i in value]
+    if isinstance(value, Iterator):
+        return [_toPlainContainers(i) for i in value]
+    return value
+
+
+@registry.misc("getDocResults")
+def getDocResults(doc, extensions=None):
+    '''
+    Returns a dictionary {extension name: value} of the pipeline results held by a processed doc, along with the
+    sentence start token indices under the key 'sentStarts'. Values are converted to plain picklable containers.
+    Extensions holding match records (see setMatchRecords) are read in their documented shape, and extensions holding
+    one-shot iterators are materialized and written back onto the doc.
+    '''
+    if extensions is None:
+        extensions = RESULT_EXTENSIONS
+
+    results = {}
+    for extension in extensions:
+        if not doc.has_extension(extension):
+            continue
+        value = getattr(doc._, extension)
+        if isinstance(value, Iterator):
+            value = list(value)
+            setattr(doc._, extension, value)
+        results[extension] = _toPlainContainers(value)
+
+    results["sentStarts"] = [token.i for token in doc if token.is_sent_start] if doc.has_annotation("SENT_START") else []
+    return results
+
+
+@registry.misc("setDocResults")
+def setDocResults(doc, results):
+    '''Restores pipeline results produced by getDocResults onto a freshly tokenized doc of the same text.'''
+    sentStarts = set(results.get("sentStarts", []))
+    if sentStarts:
+        for token in doc[1:]:
+            token.is_sent_start = token.i in sentStarts
+
+    for extension, value in results.items():
+        if extension == "sentStarts":
+            continue
+        if not doc.has_extension(extension):
+            doc.set_extension(extension, default=None, force=True)
+        setattr(doc._, extension, value)
+    return doc
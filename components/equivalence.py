@@ -0,0 +1,129 @@
+from typing import Callable, Iterable, List, Optional, Union
+from itertools import islice
+from spacy import registry
+from spacy.language import Language
+import time
+
+EQUIVALENCE_FIELDS = [
+    "rule_based_emr_items",
+    "rule_based_emr_by_sent",
+    "demograph_by_sent",
+    "emrSections",
+    "xgb_summary",
+]
+'''Results compared by compareOutputs by default.'''
+
+
+def _getResults(docs, fields):
+    '''Returns the fields of processed docs, or of results already collected by getDocResults (ie. from PreforkPool.pipe).'''
+    getDocResults = registry.get("misc", "getDocResults")
+    return [item if isinstance(item, dict) else getDocResults(item, extensions=fields) for item in docs]
+
+
+def _runPipeline(pipeline, texts, fields, kwargs):
+    start = time.perf_counter()
+    if isinstance(pipeline, Language):
+        results = _getResults(pipeline.pipe(texts, **kwargs), fields)
+    else:
+        results = _getResults(pipeline(texts, **kwargs), fields)
+    return results, time.perf_counter() - start
+
+
+@registry.misc("findFirstDifference")
+def findFirstDifference(reference, candidate, path=""):
+    '''
+    Returns (path, reference value, candidate value) of the first difference between two results, or None if they are
+    equal. Dictionaries are compared key by key and lists item by item; the path locates the difference, ie.
+    "[(250, 263)][0]['concept_id']".
+    '''
+    if isinstance(reference, dict) and isinstance(candidate, dict):
+        for key in reference:
+            if key not in candidate:
+                return (f"{path}[{key!r}]", reference[key], "<missing>")
+            difference = findFirstDifference(reference[key], candidate[key], f"{path}[{key!r}]")
+            if difference:
+                return difference
+        for key in candidate:
+            if key not in reference:
+                return (f"{path}[{key!r}]", "<missing>", candidate[key])
+        return None
+
+    if isinstance(reference, (list, tuple)) and isinstance(candidate, (list, tuple)):
+        for i, (referenceItem, candidateItem) in enumerate(zip(reference, candidate)):
+            difference = findFirstDifference(referenceItem, candidateItem, f"{path}[{i}]")
+            if difference:
+                return difference
+        if len(reference) != len(candidate):
+            return (f"{path}.length", len(reference), len(candidate))
+        return None
+
+    if type(reference) != type(candidate) and not (_isNumber(reference) and _isNumber(candidate)):
+        return (path, reference, candidate)
+    return None if reference == candidate else (path, reference, candidate)
+
+
+def _isNumber(value):
+    return hasattr(value, "__index__") or isinstance(value, float) or type(value).__module__ == "numpy"
+
+
+def compareOutputs(reference: Union[Language, Callable], candidate: Union[Language, Callable], texts: Iterable[str],
+                   fields: Optional[List[str]] = None, maxExamples: int = 10, batchSize: int = 1000,
+                   referenceKwargs: Optional[dict] = None, candidateKwargs: Optional[dict] = None) -> dict:
+    '''
+    Runs a reference pipeline and a candidate over the same texts, and compares their results field by field.
+    reference and candidate are pipelines, or callables taking a list of texts and returning docs or getDocResults
+    dictionaries in the same order (ie. PreforkPool(nlp).pipe, or ResultCache(nlp).pipe). The kwargs are passed on with
+    the texts, ie. candidateKwargs={"component_cfg": {"emr_sectionizer": {"sectionsIgnored": ["fam_history"]}}}.
+    The texts are processed batchSize at a time, each batch by the reference then by the candidate, and every batch is
+    timed separately.
+
+    Returns a report:
+    - documents, identical: numbers of documents compared, and with all fields equal
+    - mismatchesByField: number of documents with a difference, per field
+    - examples: the first maxExamples differences, with the document index, field, path, and both values
+    - referenceSeconds, candidateSeconds, speedup: processing times, and reference time over candidate time
+    '''
+    fields = fields or EQUIVALENCE_FIELDS
+    referenceKwargs = referenceKwargs or {}
+    candidateKwargs = candidateKwargs or {}
+    registry.get("misc", "ensureResultExtensions")()
+
+    report = {
+        "documents": 0,
+        "identical": 0,
+        "mismatchesByField": {field: 0 for field in fields},
+        "examples": [],
+        "referenceSeconds": 0.0,
+        "candidateSeconds": 0.0,
+    }
+
+    items = iter(texts)
+    while True:
+        batch = list(islice(items, batchSize))
+        if not batch:
+            break
+
+        referenceResults, referenceSeconds = _runPipeline(reference, batch, fields, referenceKwargs)
+        candidateResults, candidateSeconds = _runPipeline(candidate, batch, fields, candidateKwargs)
+        report["referenceSeconds"] += referenceSeconds
+        report["candidateSeconds"] += candidateSeconds
+        if len(referenceResults) != len(candidateResults):
+            raise ValueError(f"The reference returned {len(referenceResults)} results and the candidate {len(candidateResults)} for a batch of {len(batch)} texts.")
+
+        for referenceResult, candidateResult in zip(referenceResults, candidateResults):
+            identical = True
+            for field in fields:
+                difference = findFirstDifference(referenceResult.get(field), candidateResult.get(field))
+                if difference is None:
+                    continue
+                identical = False
+                report["mismatchesByField"][field] += 1
+                if len(report["examples"]) < maxExamples:
+                    path, referenceValue, candidateValue = difference
+                    report["examples"].append({"document": report["documents"], "field": field, "path": path,
+                                               "reference": referenceValue, "candidate": candidateValue})
+            report["identical"] += identical
+            report["documents"] += 1
+
+    report["speedup"] = report["referenceSeconds"] / report["candidateSeconds"] if report["candidateSeconds"] else 0.0
+    return report
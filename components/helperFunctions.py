@@ -1,4 +1,8 @@
 from spacy import registry
+from spacy.tokenizer import Tokenizer
+from spacy.vocab import Vocab
+from array import array
+import sys
 
 
 @registry.misc("flattenDictionary")
@@ -19,3 +23,93 @@ def flattenDictionary(nested, nestKey=None, collector=None):
         return flattenDictionary(nextLevel, nestKey, collector)
     else:
         return collector
+
+
+@registry.misc("getDeepSizeOf")
+def getDeepSizeOf(value, exclude=None):
+    '''
+    Returns the size in bytes of a value along with all the containers, strings and numbers it references, counting
+    each object once. Objects referenced by exclude (ie. strings already counted elsewhere) are not counted.
+    '''
+    seen = set()
+    if exclude is not None:
+        seen.add(id(exclude))
+        seen.update(id(i) for i in (exclude.values() if isinstance(exclude, dict) else exclude))
+
+    size = 0
+    stack = [value]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+        elif not isinstance(item, (str, bytes, int, float, array)) and hasattr(item, "__dict__"):
+            stack.append(item.__dict__)
+    return size
+
+
+@registry.misc("makeBuildTokenizer")
+def makeBuildTokenizer(nlp):
+    '''
+    Returns a copy of the pipeline tokenizer with a vocab of its own, for building rule assets on a background thread, or
+    making docs in a process that forks workers (see PreforkPool), without touching the vocab and tokenizer cache used by
+    the running pipeline. Matchers built with it match the
+    pipeline docs, since tokens are matched by string hashes. The vocab gets the lexical attribute getters of the pipeline
+    vocab, without which the LOWER and NORM hashes of new words would be 0.
+    '''
+    tokenizer = Tokenizer(Vocab(lex_attr_getters=nlp.vocab.lex_attr_getters))
+    tokenizer.from_bytes(nlp.tokenizer.to_bytes(exclude=["vocab"]), exclude=["vocab"])
+    return tokenizer
+
+
+@registry.misc("getScopedSpans")
+def getScopedSpans(doc):
+    '''
+    Returns the parts of a doc that rule-based components process: the doc itself, or the runs of consecutive sentences
+    within the sections selected for the call (see EmrSectionizer.getScope).
+    '''
+    scope = doc._.emrScope if doc.has_extension("emrScope") else None
+    if scope is None:
+        return [doc]
+    return [doc[start:end] for start, end in scope]
+
+
+@registry.misc("getScopedSentences")
+def getScopedSentences(doc):
+    '''Returns the sentences of a doc within the sections selected for the call, or all the sentences (see getScopedSpans).'''
+    scope = doc._.emrScope if doc.has_extension("emrScope") else None
+    if scope is None:
+        return list(doc.sents)
+    return [sent for sent in doc.sents if any(start <= sent.start and sent.end <= end for start, end in scope)]
+
+
+@registry.misc("getSentenceBoundaryWindows")
+def getSentenceBoundaryWindows(doc, maxLength):
+    '''
+    Returns [(boundary, window) ...]: for every sentence boundary within the parts of a doc returned by getScopedSpans,
+    the token index of the boundary and the span of the maxLength - 1 tokens on each side of it, within the part.
+    A match of at most maxLength tokens that crosses the boundary lies within its window, so matching the sentences
+    and the windows finds the same matches as matching the whole part.
+    '''
+    if maxLength < 2:
+        return []
+    windows = []
+    sentStarts = [sent.start for sent in getScopedSentences(doc)]
+    for part in getScopedSpans(doc):
+        partStart, partEnd = (0, len(doc)) if part is doc else (part.start, part.end)
+        for boundary in sentStarts:
+            if partStart < boundary < partEnd:
+                windows.append((boundary, doc[max(partStart, boundary - maxLength + 1):min(partEnd, boundary + maxLength - 1)]))
+    return windows
+
+
+@registry.misc("isRuleSkipped")
+def isRuleSkipped(doc):
+    '''Returns True if RulePrefilter found no rule phrase in the text of a doc, so that the rule-based components skip it.'''
+    return doc.has_extension("emrSkipRules") and doc._.emrSkipRules
@@ -0,0 +1,217 @@
+from difflib import SequenceMatcher
+from bisect import bisect_right
+from operator import itemgetter
+from spacy import registry
+from spacy.language import Language
+from spacy.tokens import Doc
+
+
+def reprocessAmendedNote(nlp: Language, previousText: str, previousResults: dict, newText: str) -> Doc:
+    '''
+    Returns a doc of newText with the pipeline results restored, reusing previousResults (as returned by
+    getDocResults for previousText) wherever the note was not amended.
+    The two texts are compared section by section (see EmrSectionizer). Rule-based components only run over the
+    sentences of the sections that were added or edited, and their output is merged with the results of the unchanged
+    sections, shifted to their new character offsets. The XGB models are re-scored over the whole text only if the
+    text changed.
+    Note that the statistical tagger only sees the changed sentences, so lemmas near the edges of an edit may differ
+    from those of a full run.
+    '''
+    setDocResults = registry.get("misc", "setDocResults")
+
+    if newText == previousText:
+        return setDocResults(nlp.make_doc(newText), previousResults)
+
+    sectionizer = nlp.get_pipe("emr_sectionizer")
+    sentencizer = nlp.get_pipe("custom_sentencizer")
+    previousDoc = sentencizer(nlp.make_doc(previousText))
+    newDoc = sentencizer(nlp.make_doc(newText))
+
+    reusedRanges = _getReusedRanges(sectionizer, previousDoc, newDoc)
+    merged = _getReusedResults(previousResults, reusedRanges)
+    pendingItems = []
+
+    for start, end in _getChangedRanges(reusedRanges, len(newText)):
+        if newText[start:end].strip():
+            _processChangedRange(nlp, newText, start, end, merged, pendingItems)
+
+    emrSections = sectionizer.getSections(newText)
+
+    if "post_process" in nlp.pipe_names:
+        postProcessor = nlp.get_pipe("post_process")
+        matches = postProcessor.emrPostProcessor(newDoc, pendingItems, emrSections=emrSections)
+        merged["items"] += registry.get("misc", "recordsToResults")("sentenceConditions", matches)
+
+    demograph = dict(sorted(merged["demograph"].items()))
+    results = {
+        "emrSections": emrSections,
+        "emrPhrases": dict(sorted(merged["emrPhrases"].items())),
+        "rule_based_emr_items": sorted(merged["items"], key=itemgetter('start')),
+        "rule_based_emr_by_sent": _makeSummary(merged["bySent"]),
+        "demograph": demograph,
+        "demograph_items": [item for items in demograph.values() for item in items],
+        "demograph_by_sent": _makeDemographSummary(merged["demographBySent"]),
+    }
+
+    if "xgb_binary_classifier" in nlp.pipe_names:
+        results["xgb_summary"] = nlp.get_pipe("xgb_binary_classifier").predict(newDoc)
+
+    return setDocResults(newDoc, results)
+
+
+def _getSectionRanges(sectionizer, text):
+    '''Returns (start, end) of every section of the text, covering the whole text.'''
+    sections = [(section.start, section.end) for section in sectionizer.getSections(text)]
+    return sections or [(0, len(text))]
+
+
+def _getSentenceStarts(doc):
+    starts = {sent.start_char for sent in doc.sents}
+    starts.add(len(doc.text))
+    return starts
+
+
+def _getReusedRanges(sectionizer, previousDoc, newDoc):
+    '''
+    Returns a sorted list of tuples (start, end, shift) representing ranges of the previous text whose results can be
+    reused, where shift is the offset to add to get positions in the new text.
+    A range is made of sections whose text is unchanged, trimmed to sentence boundaries common to both texts.
+    '''
+    previousSections = _getSectionRanges(sectionizer, previousDoc.text)
+    newSections = _getSectionRanges(sectionizer, newDoc.text)
+    previousStarts = _getSentenceStarts(previousDoc)
+    newStarts = _getSentenceStarts(newDoc)
+
+    matcher = SequenceMatcher(None,
+                              [previousDoc.text[start:end] for start, end in previousSections],
+                              [newDoc.text[start:end] for start, end in newSections],
+                              autojunk=False)
+    ranges = []
+
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != 'equal':
+            continue
+        rangeStart = previousSections[i1][0]
+        rangeEnd = previousSections[i2 - 1][1]
+        shift = newSections[j1][0] - rangeStart
+        bounds = sorted(i for i in previousStarts if rangeStart <= i <= rangeEnd and i + shift in newStarts)
+        if len(bounds) >= 2:
+            ranges.append((bounds[0], bounds[-1], shift))
+
+    return ranges
+
+
+def _getChangedRanges(reusedRanges, textLength):
+    '''Returns the ranges of the new text that are not covered by reused ranges.'''
+    changed = []
+    cursor = 0
+    for start, end, shift in reusedRanges:
+        if start + shift > cursor:
+            changed.append((cursor, start + shift))
+        cursor = end + shift
+    if cursor < textLength:
+        changed.append((cursor, textLength))
+    return changed
+
+
+def _getShift(position, reusedRanges, rangeStarts):
+    '''Returns the shift of the reused range containing the position, or None.'''
+    i = bisect_right(rangeStarts, position) - 1
+    if i >= 0:
+        start, end, shift = reusedRanges[i]
+        if start <= position < end:
+            return shift
+    return None
+
+
+def _shiftSpan(span, shift):
+    return (span[0] + shift, span[1] + shift)
+
+
+def _getReusedResults(previousResults, reusedRanges):
+    '''Collects the previous results that lie within reused ranges, shifted to positions in the new text.'''
+    rangeStarts = [i[0] for i in reusedRanges]
+    merged = {"emrPhrases": {}, "items": [], "bySent": [], "demograph": {}, "demographBySent": []}
+
+    for span, phrase in (previousResults.get("emrPhrases") or {}).items():
+        shift = _getShift(span[0], reusedRanges, rangeStarts)
+        if shift is not None:
+            merged["emrPhrases"][_shiftSpan(span, shift)] = phrase
+
+    for item in previousResults.get("rule_based_emr_items") or []:
+        shift = _getShift(item['start'], reusedRanges, rangeStarts)
+        if shift is not None:
+            merged["items"].append({**item, 'start': item['start'] + shift, 'end': item['end'] + shift})
+
+    for conceptName, payload in (previousResults.get("rule_based_emr_by_sent") or {}).items():
+        for sentence in payload['sentences']:
+            shift = _getShift(sentence['sentBound'][0], reusedRanges, rangeStarts)
+            if shift is not None:
+                merged["bySent"].append((conceptName, payload['concept_id'], _shiftSentence(sentence, shift)))
+
+    for span, items in (previousResults.get("demograph") or {}).items():
+        shift = _getShift(span[0], reusedRanges, rangeStarts)
+        if shift is not None:
+            merged["demograph"][_shiftSpan(span, shift)] = [
+                {**item, 'start': item['start'] + shift, 'end': item['end'] + shift} for item in items]
+
+    for category, labels in (previousResults.get("demograph_by_sent") or {}).items():
+        for label, payload in labels.items():
+            for sentence in payload['sentences']:
+                shift = _getShift(sentence['sentBound'][0], reusedRanges, rangeStarts)
+                if shift is not None:
+                    merged["demographBySent"].append((category, label, payload['concept_id'], _shiftSentence(sentence, shift)))
+
+    return merged
+
+
+def _shiftSentence(sentence, shift):
+    return {'sentBound': _shiftSpan(sentence['sentBound'], shift),
+            'tokens': [_shiftSpan(token, shift) for token in sentence['tokens']]}
+
+
+def _processChangedRange(nlp, text, start, end, merged, pendingItems):
+    '''
+    Runs the rule-based components over text[start:end] and merges the shifted results.
+    Condition matches are collected in pendingItems to be post-processed against the sections of the whole text.
+    '''
+    disabled = [name for name in ["post_process", "xgb_binary_classifier"] if name in nlp.pipe_names]
+    with nlp.select_pipes(disable=disabled):
+        doc = nlp(text[start:end])
+
+    for span, phrase in (getattr(doc._, "emrPhrases", None) or {}).items():
+        merged["emrPhrases"][_shiftSpan(span, start)] = phrase
+
+    for match in registry.get("misc", "getMatchRecords")(doc, "rule_based_emr_items") or []:
+        pendingItems.append(match.shift(start))
+
+    for conceptName, payload in (getattr(doc._, "rule_based_emr_by_sent", None) or {}).items():
+        for sentence in payload['sentences']:
+            merged["bySent"].append((conceptName, payload['concept_id'], _shiftSentence(sentence, start)))
+
+    for span, items in (getattr(doc._, "demograph", None) or {}).items():
+        merged["demograph"][_shiftSpan(span, start)] = [
+            {**item, 'start': item['start'] + start, 'end': item['end'] + start} for item in items]
+
+    for category, labels in (getattr(doc._, "demograph_by_sent", None) or {}).items():
+        for label, payload in labels.items():
+            for sentence in payload['sentences']:
+                merged["demographBySent"].append((category, label, payload['concept_id'], _shiftSentence(sentence, start)))
+
+
+def _makeSummary(entries):
+    '''Assembles (conceptName, conceptId, sentence) entries into the rule_based_emr_by_sent structure.'''
+    summary = {}
+    for conceptName, conceptId, sentence in sorted(entries, key=lambda i: i[2]['sentBound']):
+        payload = summary.setdefault(conceptName, {"concept_id": conceptId, "sentences": []})
+        payload["sentences"].append(sentence)
+    return summary
+
+
+def _makeDemographSummary(entries):
+    '''Assembles (category, label, conceptId, sentence) entries into the demograph_by_sent structure.'''
+    summary = {}
+    for category, label, conceptId, sentence in sorted(entries, key=lambda i: i[3]['sentBound']):
+        payload = summary.setdefault(category, {}).setdefault(label, {"concept_id": conceptId, "sentences": []})
+        payload["sentences"].append(sentence)
+    return summary
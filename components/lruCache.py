@@ -0,0 +1,66 @@
+from collections import OrderedDict
+from spacy import registry
+import threading
+
+
+@registry.misc("LruCache")
+class LruCache:
+    '''
+    A bounded mapping that evicts the least recently used entry once maxSize is exceeded, and counts hits and misses.
+    Safe to share between threads: an entry can be evicted by one thread while another one moves it to the end.
+    '''
+
+    def __init__(self, maxSize=10000):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def hitRate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def getSentenceMemoReport(nlp):
+    '''
+    Returns the sentence memoization counters of every pipeline component with memoization enabled, ie:
+    {"emr_phrase_matcher": {"hits": 9120, "misses": 880, "hitRate": 0.912, "entries": 880}}
+    The hit rate tells how much of the processed text is repeated template sentences.
+    '''
+    report = {}
+    for name, component in nlp.pipeline:
+        memo = getattr(component, "sentenceMemo", None)
+        if memo is not None:
+            report[name] = {"hits": memo.hits, "misses": memo.misses, "hitRate": memo.hitRate(), "entries": len(memo)}
+    return report
@@ -0,0 +1,226 @@
+from typing import NamedTuple, Tuple
+from itertools import groupby
+from operator import itemgetter
+from spacy import registry
+from spacy.tokens import Doc
+
+
+@registry.misc("TriggerToken")
+class TriggerToken(NamedTuple):
+    '''A token that triggered a condition, by character offsets.'''
+    start: int
+    end: int
+    text: str
+
+
+@registry.misc("ConditionMatch")
+class ConditionMatch(NamedTuple):
+    '''
+    A condition found in a sentence by MedCondDetect, with the tokens that triggered it sorted by position.
+    Converted to the documented annotations of rule_based_emr_items by toAnnotation, and of post-processed results by toCode.
+    '''
+    sentStart: int
+    sentEnd: int
+    conceptId: int
+    tag: str
+    triggers: Tuple[TriggerToken, ...]
+
+    @classmethod
+    def fromValue(cls, value):
+        '''Returns a record from a tuple of its fields, ie. as restored from the msgpack serialization of a doc.'''
+        if isinstance(value, cls):
+            return value
+        sentStart, sentEnd, conceptId, tag, triggers = value
+        return cls(sentStart, sentEnd, conceptId, tag, tuple(TriggerToken(*i) for i in triggers))
+
+    @property
+    def triggerText(self) -> str:
+        return ', '.join(i.text for i in self.triggers)
+
+    def shift(self, offset: int):
+        '''Returns the record with every position moved by offset characters.'''
+        triggers = tuple(TriggerToken(i.start + offset, i.end + offset, i.text) for i in self.triggers)
+        return self._replace(sentStart=self.sentStart + offset, sentEnd=self.sentEnd + offset, triggers=triggers)
+
+    def toAnnotation(self) -> dict:
+        '''
+        Returns the linked list of annotations documented for rule_based_emr_items, one per trigger token, ie:
+        {'start': 250, 'end': 262, 'tag': 'Essential hypertension', 'concept_id': 320128, 'triggers': 'Hypertension', 'next': {...}}
+        '''
+        annotations = [{"start": i.start, "end": i.end, "tag": self.tag, "concept_id": self.conceptId} for i in self.triggers]
+        annotations[0]['triggers'] = self.triggerText
+        for annotation, following in zip(annotations, annotations[1:]):
+            annotation['next'] = following
+        return annotations[0]
+
+    def toCode(self) -> dict:
+        return {'tag': self.tag, 'concept_id': self.conceptId, 'triggers': self.triggerText}
+
+
+@registry.misc("DemographMatch")
+class DemographMatch(NamedTuple):
+    '''A demographic phrase found in a sentence by DemographMatcher.'''
+    sentStart: int
+    sentEnd: int
+    start: int
+    end: int
+    text: str
+    conceptId: int
+    category: str
+    label: str
+
+    @classmethod
+    def fromValue(cls, value):
+        return value if isinstance(value, cls) else cls(*value)
+
+    def toDict(self) -> dict:
+        return {"text": self.text, "concept_id": self.conceptId, "type": self.category, "label": self.label,
+                "start": self.start, "end": self.end}
+
+
+class MatchRecords(NamedTuple):
+    '''Match records held by a result extension, with the name of the result they are converted to (see RECORD_FORMATS).'''
+    format: str
+    records: tuple
+
+
+def _groupTokensBySentence(tokens):
+    '''Returns [{sentBound: (sentStart, sentEnd), tokens: [(tokenStart, tokenEnd) ...]} ...] from (sentBound, token) pairs.'''
+    return [{'sentBound': sentBound, 'tokens': [token for _, token in group]}
+            for sentBound, group in groupby(sorted(tokens, key=itemgetter(0)), itemgetter(0))]
+
+
+def _getConditionItems(matches):
+    items = {}
+    for match in matches:
+        items.setdefault((match.sentStart, match.sentEnd), []).append(match.toAnnotation())
+    return items
+
+
+def _getSentenceConditions(matches):
+    return [{'start': sentStart, 'end': sentEnd, 'codes': [match.toCode() for match in group]}
+            for (sentStart, sentEnd), group in groupby(matches, lambda i: (i.sentStart, i.sentEnd))]
+
+
+def _getConditionSummary(matches):
+    '''{conceptName: {"concept_id": 0000, "sentences": [{sentBound: (sentStart, sentEnd), tokens: [(tokenStart, tokenEnd) ...]} ...]}}'''
+    names = {}
+    tokensByConcept = {}
+    for match in matches:
+        names[match.conceptId] = match.tag
+        tokensByConcept.setdefault(match.conceptId, []).extend(
+            ((match.sentStart, match.sentEnd), (i.start, i.end)) for i in match.triggers)
+
+    summary = {}
+    for conceptId, tokens in tokensByConcept.items():
+        payload = summary.setdefault(names[conceptId], {"concept_id": conceptId, "sentences": []})
+        payload["concept_id"] = conceptId
+        payload["sentences"].extend(_groupTokensBySentence(tokens))
+    return summary
+
+
+def _getDemographs(matches):
+    demographs = {}
+    for match in matches:
+        demographs.setdefault((match.sentStart, match.sentEnd), []).append(match.toDict())
+    return demographs
+
+
+def _getDemographSummary(matches):
+    '''{category: {label: {"concept_id": 0000, "sentences": [{sentBound: (sentStart, sentEnd), tokens: [(tokenStart, tokenEnd) ...]} ...]}}}'''
+    labels = {}
+    tokensByCategory = {}
+    for match in matches:
+        labels[match.conceptId] = match.label
+        tokensByCategory.setdefault(match.category, {}).setdefault(match.conceptId, []).append(
+            ((match.sentStart, match.sentEnd), (match.start, match.end)))
+
+    summary = {}
+    for category, tokensByConcept in tokensByCategory.items():
+        for conceptId, tokens in tokensByConcept.items():
+            payload = summary.setdefault(category, {}).setdefault(labels[conceptId], {"concept_id": conceptId, "sentences": []})
+            payload["concept_id"] = conceptId
+            payload["sentences"].extend(_groupTokensBySentence(tokens))
+    return summary
+
+
+RECORD_FORMATS = {
+    "conditionItems": (ConditionMatch, _getConditionItems),
+    "sentenceConditions": (ConditionMatch, _getSentenceConditions),
+    "conditionSummary": (ConditionMatch, _getConditionSummary),
+    "demographs": (DemographMatch, _getDemographs),
+    "demographItems": (DemographMatch, lambda matches: [i for items in _getDemographs(matches).values() for i in items]),
+    "demographSummary": (DemographMatch, _getDemographSummary),
+}
+'''Record type and conversion to the documented result, by name of the result held by MatchRecords.'''
+
+
+def _isMatchRecords(value):
+    return isinstance(value, tuple) and len(value) == 2 and isinstance(value[0], str) and value[0] in RECORD_FORMATS
+
+
+@registry.misc("recordsToResults")
+def recordsToResults(format, records):
+    '''Returns match records converted to the documented result named by format (see RECORD_FORMATS).'''
+    recordType, convert = RECORD_FORMATS[format]
+    return convert([recordType.fromValue(i) for i in records])
+
+
+def _getExtensionKey(extension):
+    return ("._.", extension, None, None)
+
+
+def _getRecordExtension(extension):
+    key = _getExtensionKey(extension)
+    resultsKey = ("emrResults", extension)
+
+    def getter(doc):
+        value = doc.user_data.get(key)
+        if not _isMatchRecords(value):
+            return value
+        # the result is converted on the first access, and kept along with the records it was converted from
+        cached = doc.user_data.get(resultsKey)
+        if cached is None or cached[0] is not value:
+            cached = doc.user_data[resultsKey] = (value, recordsToResults(*value))
+        return cached[1]
+
+    def setter(doc, value):
+        doc.user_data[key] = value
+
+    return getter, setter
+
+
+_recordExtensions = {}
+
+
+@registry.misc("registerRecordExtension")
+def registerRecordExtension(extension):
+    '''Registers a doc extension that reads match records in their documented shape, unless it is registered so already.'''
+    if extension not in _recordExtensions:
+        _recordExtensions[extension] = _getRecordExtension(extension)
+    getter, setter = _recordExtensions[extension]
+    if not Doc.has_extension(extension) or Doc.get_extension(extension)[2] is not getter:
+        Doc.set_extension(extension, getter=getter, setter=setter, force=True)
+
+
+@registry.misc("setMatchRecords")
+def setMatchRecords(doc, extension, format, records):
+    '''
+    Sets match records (ie. ConditionMatch) as the value of a result extension. The records are converted to the
+    documented result named by format (see RECORD_FORMATS) on the first access of the extension, and the result is kept
+    in doc.user_data for the next ones, so only the components reading them allocate dictionaries; until then the doc
+    holds plain tuples, which pickle and serialize cheaply.
+    Values assigned to the extension directly (ie. by setDocResults) are returned as they are.
+    '''
+    registerRecordExtension(extension)
+    doc.user_data[_getExtensionKey(extension)] = MatchRecords(format, records if isinstance(records, tuple) else tuple(records))
+
+
+@registry.misc("getMatchRecords")
+def getMatchRecords(doc, extension):
+    '''Returns the match records held by a result extension (see setMatchRecords), or None if it holds other values.'''
+    value = doc.user_data.get(_getExtensionKey(extension))
+    if not _isMatchRecords(value):
+        return None
+    recordType = RECORD_FORMATS[value[0]][0]
+    return [recordType.fromValue(i) for i in value[1]]
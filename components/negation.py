@@ -3,31 +3,53 @@ from collections import defaultdict
 from spacy.language import Language
 from spacy.tokens import Doc
 from spacy.matcher import Matcher
+from spacy import registry
 import pickle
 
 try:
-    @Language.factory("negation_matcher")
-    def createNegationMatcher(nlp: Language, name: str):
-        return NegationMatcher(nlp)
+    @Language.factory("negation_matcher", default_config={"memoSize": 0},
+                      requires=["doc._.emrPhrases", "token.is_sent_start", "token.lemma"],
+                      assigns=["doc._.emrPhrases"])
+    def createNegationMatcher(nlp: Language, name: str, memoSize: int):
+        return NegationMatcher(nlp, memoSize)
+
+    @Language.factory("negation_matcher_lemma_free", default_config={"memoSize": 0},
+                      requires=["doc._.emrPhrases", "token.is_sent_start"],
+                      assigns=["doc._.emrPhrases"])
+    def createLemmaFreeNegationMatcher(nlp: Language, name: str, memoSize: int):
+        '''Negation matcher whose patterns match the surface forms of lemmas, so that it does not require lemmas upstream.'''
+        return NegationMatcher(nlp, memoSize, lemmaFree=True)
 except:
     pass
 
 
 class NegationMatcher:
 
-    def __init__(self, nlp: Language):
+    def __init__(self, nlp: Language, memoSize: int = 0, lemmaFree: bool = False):
         self.nlp = nlp
         self.matcher = Matcher(nlp.vocab)
+        self.lemmaFree = lemmaFree
+        self.sentenceMemo = registry.get("misc", "LruCache")(memoSize) if memoSize > 0 else None
+        self.memoMatchers = None
 
-    def build(self):
-        self.matcher.add(Labels.NEGATION_FORWARD_LABEL, negation_forward_patterns)
-        self.matcher.add(Labels.NEGATION_BACKWARD_LABEL, negation_backward_patterns)
-        self.matcher.add(Labels.NEGATION_BIDIRECTION_LABEL, negation_bidirection_patterns)
-        self.matcher.add(Labels.CLOSURE_BUT_LABEL, closure_patterns)
+    def build(self, lemmaFree=None):
+        '''
+        Adds the negation patterns to the matcher. If lemmaFree is True, every LEMMA constraint is expanded into the
+        LOWER surface forms of the lemma (see expandLemmaPatterns), so that the matcher does not need a tagger and
+        lemmatizer upstream. If lemmaFree is None, it is True for the negation_matcher_lemma_free factory.
+        '''
+        if lemmaFree is not None:
+            self.lemmaFree = lemmaFree
+        transform = expandLemmaPatterns if self.lemmaFree else list
+        self.matcher.add(Labels.NEGATION_FORWARD_LABEL, transform(negation_forward_patterns))
+        self.matcher.add(Labels.NEGATION_BACKWARD_LABEL, transform(negation_backward_patterns))
+        self.matcher.add(Labels.NEGATION_BIDIRECTION_LABEL, transform(negation_bidirection_patterns))
+        self.matcher.add(Labels.CLOSURE_BUT_LABEL, transform(closure_patterns))
+        self.memoMatchers = None
 
     def to_disk(self, path, exclude=tuple()):
         dataPath = path.parent/"negationmatcher.bin"
-        assets = (self.matcher,)
+        assets = (self.matcher, self.lemmaFree)
         with open(dataPath, 'wb') as f:
             pickle.dump(assets, f)
 
@@ -35,15 +57,23 @@ class NegationMatcher:
         dataPath = path.parent/"negationmatcher.bin"
         with open(dataPath, 'rb') as f:
             assets = pickle.load(f)
-            self.matcher, = assets
+            self.matcher, self.lemmaFree = assets if len(assets) > 1 else (*assets, False)
+        self.memoMatchers = None
 
     def __call__(self, doc: Doc) -> Doc:
+        if registry.get("misc", "isRuleSkipped")(doc):
+            return doc
+        with registry.get("misc", "getStageBudget")(doc, "negation_matcher") as budget:
+            if self.sentenceMemo is not None:
+                negationPhrases = self._getMemoizedNegationPhrases(doc)
+            else:
+                negationPhrases = self._getFormattedNegationPhrases(doc)
+            negationBoundaries = self._getNegationBoundaries(doc, negationPhrases, budget)
 
-        negationPhrases = self._getFormattedNegationPhrases(doc)
-        negationBoundaries = self._getNegationBoundaries(doc, negationPhrases)
-
-        doc._.emrPhrases = self.filterPhrases(doc._.emrPhrases, negationBoundaries)
+            doc._.emrPhrases = self.filterPhrases(doc._.emrPhrases, negationBoundaries)
 
+        if budget.isExceeded:
+            registry.get("misc", "markDegraded")(doc, "negation_matcher")
         return doc
 
     def filterPhrases(self, phrases, negationBoundaries):
@@ -102,7 +132,13 @@ class NegationMatcher:
         '''
         output = defaultdict(list)
 
-        for matchId, start, end in self.matcher(doc):
+        if doc.has_extension("emrScope") and doc._.emrScope is not None:
+            matches = [(span.label, span.start, span.end)
+                       for part in registry.get("misc", "getScopedSpans")(doc) for span in self.matcher(part, as_spans=True)]
+        else:
+            matches = self.matcher(doc)
+
+        for matchId, start, end in matches:
             startToken = doc[start]
             endToken = doc[end-1]
             startChar = startToken.idx
@@ -118,8 +154,11 @@ class NegationMatcher:
 
         return output
 
-    def _getNegationBoundaries(self, doc, negationTerms):
-        '''Returns a list of negation boundaries, which are of type tuple (startCharPosition, endCharPosition, negationPhrase dictionary).'''
+    def _getNegationBoundaries(self, doc, negationTerms, budget=None):
+        '''
+        Returns a list of negation boundaries, which are of type tuple (startCharPosition, endCharPosition, negationPhrase dictionary).
+        Once the StageBudget is exceeded, the boundaries of the remaining negation phrases are not narrowed at closures.
+        '''
 
         sentenceIntervalTree = IntervalTree()
         sentences = doc.sents
@@ -141,6 +180,9 @@ class NegationMatcher:
 
             # populate list of negation boundaries
             for negationPhrase in negationPhrases:
+                if budget is not None and budget.exceeded():
+                    butClosurePhrases = []
+
                 negTermStartChar = negationPhrase['start']
                 negTermEndChar = negationPhrase['end']
 
@@ -158,6 +200,70 @@ class NegationMatcher:
 
         return negationBoundaries
 
+    def _getMemoMatchers(self):
+        '''
+        Returns (boundedMatcher, maxLength, unboundedMatcher): the patterns of the matcher split into those that match at
+        most maxLength tokens, and those with a "*" or "+" operator, which can match any number of tokens.
+        '''
+        if self.memoMatchers is None:
+            boundedMatcher = Matcher(self.nlp.vocab)
+            unboundedMatcher = Matcher(self.nlp.vocab)
+            maxLength = 0
+            for label in (Labels.NEGATION_FORWARD_LABEL, Labels.NEGATION_BACKWARD_LABEL,
+                          Labels.NEGATION_BIDIRECTION_LABEL, Labels.CLOSURE_BUT_LABEL):
+                entry = self.matcher.get(label)
+                if entry is None:
+                    continue
+                bounded, unbounded = [], []
+                for pattern in entry[1]:
+                    if any(tokenSpec.get("OP") not in (None, "1", "?", "!") for tokenSpec in pattern):
+                        unbounded.append(pattern)
+                    else:
+                        bounded.append(pattern)
+                        maxLength = max(maxLength, sum(tokenSpec.get("OP") != "!" for tokenSpec in pattern))
+                if bounded:
+                    boundedMatcher.add(label, bounded)
+                if unbounded:
+                    unboundedMatcher.add(label, unbounded)
+            self.memoMatchers = (boundedMatcher, maxLength, unboundedMatcher if len(unboundedMatcher) else None)
+        return self.memoMatchers
+
+    def _getMemoizedNegationPhrases(self, doc):
+        '''
+        Same as _getFormattedNegationPhrases, but matches the patterns of bounded length in each sentence separately, and
+        memoizes the sentence-relative matches by the tokens (text and lemma) of the sentence.
+        Matches spanning a sentence boundary are found in the tokens around the boundary (see getSentenceBoundaryWindows),
+        and patterns of unbounded length (ie. "rule * out") are matched over the doc, so the matches are the same as
+        those of _getFormattedNegationPhrases. Neither is memoized.
+        '''
+        boundedMatcher, maxLength, unboundedMatcher = self._getMemoMatchers()
+        matches = set()
+
+        for sent in registry.get("misc", "getScopedSentences")(doc):
+            sentStart = sent.start_char
+            key = tuple((token.text, token.lemma_, token.whitespace_) for token in sent)
+            relativeMatches = self.sentenceMemo.get(key)
+
+            if relativeMatches is None:
+                relativeMatches = [(span.label_, span.start_char - sentStart, span.end_char - sentStart)
+                                   for span in boundedMatcher(sent, as_spans=True)]
+                self.sentenceMemo.put(key, relativeMatches)
+
+            matches.update((label, start + sentStart, end + sentStart) for label, start, end in relativeMatches)
+
+        for boundary, window in registry.get("misc", "getSentenceBoundaryWindows")(doc, maxLength):
+            matches.update((span.label_, span.start_char, span.end_char)
+                           for span in boundedMatcher(window, as_spans=True) if span.start < boundary < span.end)
+
+        if unboundedMatcher is not None:
+            matches.update((span.label_, span.start_char, span.end_char)
+                           for part in registry.get("misc", "getScopedSpans")(doc) for span in unboundedMatcher(part, as_spans=True))
+
+        output = defaultdict(list)
+        for label, start, end in sorted(matches, key=lambda i: (i[1], i[2], i[0])):
+            output[label].append({"start": start, "end": end})
+        return output
+
     def _getNegationBoundary(self, negTag, negTermStart, negTermEnd, sentStart, sentEnd, butClosures):
         '''Helper function for determining the character position boundaries of a negation, returned as a tuple.'''
 
@@ -183,6 +289,73 @@ class NegationMatcher:
         return (negBoundStart, negBoundEnd)
 
 
+def getNegationAgreementReport(referenceNlp: Language, candidateNlp: Language, texts, maxExamples=20):
+    '''
+    Runs two pipelines over the same texts and compares the EMR phrases left after negation, ie. to check a
+    lemma-free pipeline against the lemma-based one. Returns a dictionary:
+    {
+        "documents": number of texts,
+        "documentsAgreeing": number of texts where both pipelines keep the same phrases,
+        "phrasesReference": number of phrases kept by the reference pipeline,
+        "phrasesCandidate": number of phrases kept by the candidate pipeline,
+        "onlyReference": number of phrases negated by the candidate pipeline only,
+        "onlyCandidate": number of phrases negated by the reference pipeline only,
+        "agreement": ratio of phrases kept by both pipelines to phrases kept by either,
+        "examples": [{"document": index, "onlyReference": [...], "onlyCandidate": [...]}, ...]
+    }
+    '''
+    texts = list(texts)
+    report = {"documents": len(texts), "documentsAgreeing": 0, "phrasesReference": 0, "phrasesCandidate": 0,
+              "onlyReference": 0, "onlyCandidate": 0, "agreement": 1.0, "examples": []}
+    common = 0
+
+    for i, (referenceDoc, candidateDoc) in enumerate(zip(referenceNlp.pipe(texts), candidateNlp.pipe(texts))):
+        referencePhrases = set(referenceDoc._.emrPhrases or {})
+        candidatePhrases = set(candidateDoc._.emrPhrases or {})
+        onlyReference = referencePhrases - candidatePhrases
+        onlyCandidate = candidatePhrases - referencePhrases
+
+        report["phrasesReference"] += len(referencePhrases)
+        report["phrasesCandidate"] += len(candidatePhrases)
+        report["onlyReference"] += len(onlyReference)
+        report["onlyCandidate"] += len(onlyCandidate)
+        common += len(referencePhrases & candidatePhrases)
+
+        if not onlyReference and not onlyCandidate:
+            report["documentsAgreeing"] += 1
+        elif len(report["examples"]) < maxExamples:
+            report["examples"].append({
+                "document": i,
+                "onlyReference": [referenceDoc.text[start:end] for start, end in sorted(onlyReference)],
+                "onlyCandidate": [candidateDoc.text[start:end] for start, end in sorted(onlyCandidate)],
+            })
+
+    either = common + report["onlyReference"] + report["onlyCandidate"]
+    if either:
+        report["agreement"] = common / either
+    return report
+
+
+def expandLemmaPatterns(patterns):
+    '''
+    Returns a copy of the Matcher patterns where every LEMMA constraint is replaced by a LOWER constraint on the
+    surface forms of the lemma, as listed in lemma_surface_forms. Lemmas that are not listed match their own form only.
+    '''
+    expanded = []
+    for pattern in patterns:
+        expandedPattern = []
+        for tokenSpec in pattern:
+            tokenSpec = dict(tokenSpec)
+            lemma = tokenSpec.pop("LEMMA", None)
+            if lemma is not None:
+                lemmas = lemma["IN"] if isinstance(lemma, dict) else [lemma]
+                forms = sorted({form for i in lemmas for form in lemma_surface_forms.get(i, [i])})
+                tokenSpec["LOWER"] = {"IN": forms}
+            expandedPattern.append(tokenSpec)
+        expanded.append(expandedPattern)
+    return expanded
+
+
 class Labels:
     NEGATION_LABEL = 'NEG'
     FORWARD_LABEL = 'F'
@@ -264,3 +437,35 @@ closure_patterns = [
     [{"TEXT": {"IN": ["apart", "aside"]}}, {"TEXT": "from"}],
     [{"ORTH": ","}]
 ]
+
+
+# Surface forms of the lemmas used in the patterns above, used to build lemma-free patterns.
+# Ambiguous clitics (ie. "'s", "'d") are left out, as without a tagger they cannot be told apart from possessives.
+lemma_surface_forms = {
+    "rule": ["rule", "rules", "ruled", "ruling"],
+    "deny": ["deny", "denies", "denied", "denying"],
+    "decline": ["decline", "declines", "declined", "declining"],
+    "avoid": ["avoid", "avoids", "avoided", "avoiding"],
+    "query": ["query", "queries", "queried", "querying"],
+    "quit": ["quit", "quits", "quitted", "quitting"],
+    "reject": ["reject", "rejects", "rejected", "rejecting"],
+    "refuse": ["refuse", "refuses", "refused", "refusing"],
+    "doubt": ["doubt", "doubts", "doubted", "doubting"],
+    "exclude": ["exclude", "excludes", "excluded", "excluding"],
+    "question": ["question", "questions", "questioned", "questioning"],
+    "suspect": ["suspect", "suspects", "suspected", "suspecting"],
+    "prevent": ["prevent", "prevents", "prevented", "preventing"],
+    "free": ["free", "frees", "freed", "freeing", "freer", "freest"],
+    "clear": ["clear", "clears", "cleared", "clearing", "clearer", "clearest"],
+    "absence": ["absence", "absences"],
+    "disappearance": ["disappearance", "disappearances"],
+    "resolution": ["resolution", "resolutions"],
+    "removal": ["removal", "removals"],
+    "drainage": ["drainage", "drainages"],
+    "suggestion": ["suggestion", "suggestions"],
+    "negative": ["negative", "negatives"],
+    "fail": ["fail", "fails", "failed", "failing"],
+    "not": ["not", "n't", "nt"],
+    "would": ["would"],
+    "be": ["be", "is", "am", "are", "was", "were", "been", "being", "'re", "'m"],
+}
@@ -0,0 +1,236 @@
+from typing import Iterable, Iterator, Optional, Tuple
+from heapq import merge
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from spacy.tokens import Doc
+import json
+import pickle
+
+# fields of a concept entry: [name, mentions, notes, firstSeq, firstNote, firstStart, lastSeq, lastNote, lastStart]
+# fields of a demograph entry: [category, label, mentions, notes, firstSeq, firstNote, firstStart, lastSeq, lastNote, lastStart]
+# fields of a model entry: [conceptId, positive, notes]
+
+
+def _getField(item, field):
+    '''Returns a result of a processed doc, or of results already collected by getDocResults (ie. from PreforkPool.pipe).'''
+    if isinstance(item, dict):
+        return item.get(field)
+    return getattr(item._, field) if Doc.has_extension(field) else None
+
+
+def _getSortKey(patientId):
+    return (type(patientId).__name__, patientId)
+
+
+def _getTokenStarts(sentences):
+    return [token[0] for sentence in sentences for token in sentence["tokens"]]
+
+
+def _foldMentions(entry, offset, sentences, starts, seq, noteId):
+    '''Adds the sentences of a concept found in one note to its entry, where offset is the index of the mentions field.'''
+    first, last = min(starts), max(starts)
+    entry[offset] += len(sentences)
+    entry[offset + 1] += 1
+    if entry[offset + 2] is None or (seq, first) < (entry[offset + 2], entry[offset + 4]):
+        entry[offset + 2:offset + 5] = [seq, noteId, first]
+    if entry[offset + 5] is None or (seq, last) > (entry[offset + 5], entry[offset + 7]):
+        entry[offset + 5:offset + 8] = [seq, noteId, last]
+
+
+def _mergeEntries(entry, other, offset):
+    entry[offset] += other[offset]
+    entry[offset + 1] += other[offset + 1]
+    if (other[offset + 2], other[offset + 4]) < (entry[offset + 2], entry[offset + 4]):
+        entry[offset + 2:offset + 5] = other[offset + 2:offset + 5]
+    if (other[offset + 5], other[offset + 7]) > (entry[offset + 5], entry[offset + 7]):
+        entry[offset + 5:offset + 8] = other[offset + 5:offset + 8]
+
+
+def _mergeAggregates(aggregate, other):
+    '''Merges the partial aggregate of a patient into another one.'''
+    aggregate[0] += other[0]
+    for conceptId, entry in other[1].items():
+        if conceptId in aggregate[1]:
+            _mergeEntries(aggregate[1][conceptId], entry, 1)
+        else:
+            aggregate[1][conceptId] = entry
+    for conceptId, entry in other[2].items():
+        if conceptId in aggregate[2]:
+            _mergeEntries(aggregate[2][conceptId], entry, 2)
+        else:
+            aggregate[2][conceptId] = entry
+    for name, entry in other[3].items():
+        if name in aggregate[3]:
+            aggregate[3][name][1] += entry[1]
+            aggregate[3][name][2] += entry[2]
+        else:
+            aggregate[3][name] = entry
+    return aggregate
+
+
+def _getSeen(entry, offset):
+    return {"note": entry[offset + 1], "start": entry[offset + 2]}
+
+
+def _makeRollup(aggregate) -> dict:
+    '''Returns the documented rollup of a patient aggregate (see PatientAggregator.results).'''
+    notes, conditions, demographs, models = aggregate
+    return {
+        "notes": notes,
+        "conditions": {conceptId: {"concept_name": entry[0], "mentions": entry[1], "notes": entry[2],
+                                   "first": _getSeen(entry, 3), "last": _getSeen(entry, 6)}
+                       for conceptId, entry in sorted(conditions.items())},
+        "demographs": {conceptId: {"category": entry[0], "label": entry[1], "mentions": entry[2], "notes": entry[3],
+                                   "first": _getSeen(entry, 4), "last": _getSeen(entry, 7)}
+                       for conceptId, entry in sorted(demographs.items())},
+        "xgb": {name: {"concept_id": entry[0], "positive": entry[1], "notes": entry[2]} for name, entry in sorted(models.items())},
+    }
+
+
+class PatientAggregator:
+    '''
+    Folds the results of a stream of notes into one rollup per patient, so that only the rollups need to be written
+    instead of the sentence level results of every note:
+    - conditions (from rule_based_emr_by_sent) and demographs (from demograph_by_sent), by concept id: the number of
+      sentences mentioning the concept, the number of notes, and where it was first and last seen (note, character offset)
+    - xgb models (from xgb_summary): the number of notes scored, and the number of notes with a positive output
+    Notes are identified by the note id given with them, or by their position in the stream.
+
+    Partial aggregates are held in memory until they hold more than maxEntries patients and concepts, then written to a
+    spill file sorted by patient id. results() merges the spill files and the aggregates in memory, a patient at a time,
+    so memory stays bounded whatever the number of patients. Patient ids must be comparable with each other (ie. all str or all int).
+    Usage:
+        with PatientAggregator() as aggregator:
+            aggregator.consume(nlp.pipe(((text, patientId) for text, patientId in notes), as_tuples=True))
+            aggregator.dump("patients.jsonl")
+
+    consume also takes (results, (patientId, noteId)) pairs, ie. results of PreforkPool.pipe zipped with their ids.
+    '''
+
+    def __init__(self, maxEntries: int = 1000000, spillDir: Optional[Path] = None):
+        self.maxEntries = maxEntries
+        self.spillDir = spillDir
+        self.tmpDir = None
+        self.aggregates = {}
+        self.entries = 0
+        self.spills = []
+        self.notes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        '''Removes the spill files.'''
+        if self.tmpDir is not None:
+            self.tmpDir.cleanup()
+            self.tmpDir = None
+        self.spills = []
+        self.aggregates = {}
+        self.entries = 0
+
+    def consume(self, items: Iterable[Tuple[object, object]]):
+        '''Adds (doc or results, context) pairs, where the context is a patient id or a tuple (patient id, note id).'''
+        for item, context in items:
+            patientId, noteId = context if isinstance(context, tuple) else (context, None)
+            self.add(patientId, item, noteId)
+
+    def add(self, patientId, item, noteId=None):
+        '''Adds the results of a note (a doc or getDocResults dictionary) to the aggregate of a patient.'''
+        seq = self.notes
+        noteId = seq if noteId is None else noteId
+        self.notes += 1
+
+        aggregate = self.aggregates.get(patientId)
+        if aggregate is None:
+            aggregate = self.aggregates[patientId] = [0, {}, {}, {}]
+            self.entries += 1
+        aggregate[0] += 1
+        before = len(aggregate[1]) + len(aggregate[2]) + len(aggregate[3])
+
+        for conceptName, payload in (_getField(item, "rule_based_emr_by_sent") or {}).items():
+            starts = _getTokenStarts(payload["sentences"])
+            if not starts:
+                continue
+            entry = aggregate[1].get(payload["concept_id"])
+            if entry is None:
+                entry = aggregate[1][payload["concept_id"]] = [conceptName, 0, 0, None, None, None, None, None, None]
+            _foldMentions(entry, 1, payload["sentences"], starts, seq, noteId)
+
+        for category, labels in (_getField(item, "demograph_by_sent") or {}).items():
+            for label, payload in labels.items():
+                starts = _getTokenStarts(payload["sentences"])
+                if not starts:
+                    continue
+                entry = aggregate[2].get(payload["concept_id"])
+                if entry is None:
+                    entry = aggregate[2][payload["concept_id"]] = [category, label, 0, 0, None, None, None, None, None, None]
+                _foldMentions(entry, 2, payload["sentences"], starts, seq, noteId)
+
+        for name, output in (_getField(item, "xgb_summary") or {}).items():
+            entry = aggregate[3].get(name)
+            if entry is None:
+                entry = aggregate[3][name] = [output["concept_id"], 0, 0]
+            entry[1] += int(output["output"] == 1)
+            entry[2] += 1
+
+        self.entries += len(aggregate[1]) + len(aggregate[2]) + len(aggregate[3]) - before
+        if self.entries > self.maxEntries:
+            self.spill()
+
+    def spill(self):
+        '''Writes the aggregates in memory to a spill file, sorted by patient id, and clears them.'''
+        if not self.aggregates:
+            return
+        if self.tmpDir is None:
+            self.tmpDir = TemporaryDirectory(prefix="patient-aggregates-", dir=self.spillDir)
+        spillPath = Path(self.tmpDir.name)/f"spill-{len(self.spills):05d}.bin"
+        with open(spillPath, 'wb') as f:
+            for patientId in sorted(self.aggregates, key=_getSortKey):
+                pickle.dump((patientId, self.aggregates[patientId]), f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.spills.append(spillPath)
+        self.aggregates = {}
+        self.entries = 0
+
+    @staticmethod
+    def _readSpill(spillPath: Path):
+        with open(spillPath, 'rb') as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+
+    def results(self) -> Iterator[Tuple[object, dict]]:
+        '''
+        Yields (patientId, rollup) for every patient, in patient id order, merging the spill files and the aggregates in
+        memory. A rollup reads:
+        {"notes": 3,
+         "conditions": {320128: {"concept_name": "320128", "mentions": 4, "notes": 2, "first": {"note": 0, "start": 47}, "last": {...}}},
+         "demographs": {4022069: {"category": "employment", "label": "retired", "mentions": 1, "notes": 1, "first": {...}, "last": {...}}},
+         "xgb": {"xgb_3000_hypertension": {"concept_id": 320128, "positive": 2, "notes": 3}}}
+        '''
+        inMemory = ((patientId, self.aggregates[patientId]) for patientId in sorted(self.aggregates, key=_getSortKey))
+        runs = [self._readSpill(spillPath) for spillPath in self.spills] + [inMemory]
+
+        patientId, aggregate = None, None
+        for nextPatientId, nextAggregate in merge(*runs, key=lambda i: _getSortKey(i[0])):
+            if aggregate is not None and nextPatientId == patientId:
+                _mergeAggregates(aggregate, nextAggregate)
+                continue
+            if aggregate is not None:
+                yield patientId, _makeRollup(aggregate)
+            patientId, aggregate = nextPatientId, nextAggregate
+        if aggregate is not None:
+            yield patientId, _makeRollup(aggregate)
+
+    def dump(self, path) -> int:
+        '''Writes the rollups to a JSON lines file, one {"patient_id": ..., **rollup} per line. Returns the number of patients.'''
+        patients = 0
+        with open(path, mode='w', encoding='utf-8') as f:
+            for patientId, rollup in self.results():
+                f.write(json.dumps({"patient_id": patientId, **rollup}, default=str) + "\n")
+                patients += 1
+        return patients
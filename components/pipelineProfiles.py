@@ -0,0 +1,155 @@
+from typing import Iterable, List, Tuple
+from itertools import islice
+from pathlib import Path
+from spacy.language import Language
+from spacy import registry
+from spacy.util import get_package_path, get_model_meta, is_package, load_config
+import importlib
+import spacy
+
+EMR_FACTORIES = [
+    "emr_boilerplate",
+    "emr_prefilter",
+    "emr_time_budget",
+    "custom_sentencizer",
+    "emr_sectionizer",
+    "emr_phrase_matcher",
+    "emr_spell_normalizer",
+    "demograph_matcher",
+    "negation_matcher",
+    "negation_matcher_lemma_free",
+    "med_cond_detect",
+    "post_process",
+    "xgb_binary_classifier",
+]
+'''Factories of this package, which declare what they require and assign. Other components (ie. the en_core_web_sm tagger and lemmatizer) are kept or dropped together.'''
+
+
+def _normalizeOutput(output: str) -> str:
+    '''Returns the attribute name of an output as declared by the factories, ie. "xgb_summary" -> "doc._.xgb_summary".'''
+    if output.startswith("doc.") or output.startswith("token."):
+        return output
+    return f"doc._.{output}"
+
+
+def resolvePipes(pipes: List[Tuple[str, str]], outputs: Iterable[str]) -> List[str]:
+    '''
+    Given the pipeline as a list of (component name, factory name) in order, and the desired outputs, returns the names
+    of the components needed to produce the outputs, in pipeline order.
+    Outputs are extension names (ie. "xgb_summary", "demograph_items") or attributes as declared by the factories.
+    A component is needed if it assigns an attribute required by the outputs or by a needed component downstream;
+    every earlier component assigning that attribute is kept, as some components rewrite the output of others.
+    Other components are only kept for attributes that no kept component of this package assigns, ie. they are not kept
+    for token.is_sent_start, which custom_sentencizer assigns, but they are for token.lemma.
+    Raises ValueError if an output is not assigned by any component, or if a kept component requires an extension
+    that no kept component upstream assigns.
+    '''
+    metas = [(name, factory, Language.get_factory_meta(factory)) for name, factory in pipes]
+    assigned = {attr for _, _, meta in metas for attr in meta.assigns}
+    needed = set(map(_normalizeOutput, outputs))
+
+    unknown = needed - assigned
+    if unknown:
+        raise ValueError(f"No component assigns {sorted(unknown)}. Available outputs: {sorted(assigned)}")
+
+    kept = set()
+    provided = set()
+    keepOthers = False
+
+    for name, factory, meta in reversed(metas):
+        if factory in EMR_FACTORIES:
+            if needed & set(meta.assigns):
+                kept.add(name)
+                needed |= set(meta.requires)
+                provided |= set(meta.assigns)
+        elif (needed - provided) & set(meta.assigns):
+            keepOthers = True
+
+    if keepOthers:
+        kept |= {name for name, factory, _ in metas if factory not in EMR_FACTORIES}
+
+    available = set()
+    for name, factory, meta in metas:
+        if name not in kept:
+            continue
+        missing = {i for i in meta.requires if i.startswith("doc._.") and i not in available}
+        if missing:
+            raise ValueError(f"Component '{name}' requires {sorted(missing)}, which no component before it assigns.")
+        available |= set(meta.assigns)
+
+    return [name for name, _, _ in metas if name in kept]
+
+
+def getPipesForOutputs(nlp: Language, outputs: Iterable[str]) -> List[str]:
+    '''Returns the names of the components of a loaded pipeline needed to produce the outputs.'''
+    return resolvePipes([(name, nlp.get_pipe_meta(name).factory) for name in nlp.pipe_names], outputs)
+
+
+def selectOutputs(nlp: Language, outputs: Iterable[str]):
+    '''
+    Returns a context manager that disables the components not needed to produce the outputs, ie:
+    with selectOutputs(nlp, ["xgb_summary"]):
+        docs = list(nlp.pipe(texts))
+    Result extensions of the skipped components read as None.
+    '''
+    registry.get("misc", "ensureResultExtensions")()
+    return nlp.select_pipes(enable=getPipesForOutputs(nlp, outputs))
+
+
+def pipeSkippingRules(nlp: Language, texts: Iterable[str], batchSize: int = 1000, **kwargs):
+    '''
+    Same as nlp.pipe(texts, **kwargs), but the notes that emr_prefilter skips (see RulePrefilter.skipsRules) are processed
+    with the components of other packages disabled, ie. the en_core_web_sm tagger and lemmatizer, which only the rule
+    stages need. Texts are read batchSize at a time, and the docs are yielded in input order. Without emr_prefilter,
+    yields from nlp.pipe.
+    '''
+    prefilterName = next((name for name in nlp.pipe_names if nlp.get_pipe_meta(name).factory == "emr_prefilter"), None)
+    if prefilterName is None:
+        yield from nlp.pipe(texts, **kwargs)
+        return
+
+    prefilter = nlp.get_pipe(prefilterName)
+    others = [name for name in nlp.pipe_names if nlp.get_pipe_meta(name).factory not in EMR_FACTORIES]
+    componentCfg = kwargs.pop("component_cfg", None) or {}
+    prefilterCfg = componentCfg.get(prefilterName, {})
+    items = iter(texts)
+
+    while True:
+        batch = list(islice(items, batchSize))
+        if not batch:
+            break
+        skips = [prefilter.skipsRules(text, prefilterCfg.get("enabled")) for text in batch]
+        # the decision is passed on to the prefilter, so that the docs processed without the tagger are those it skips
+        docs = {skip: nlp.pipe([text for text, i in zip(batch, skips) if i == skip], disable=others if skip else [],
+                               component_cfg={**componentCfg, prefilterName: {**prefilterCfg, "skip": skip}}, **kwargs)
+                for skip in (False, True)}
+        for skip in skips:
+            yield next(docs[skip])
+
+
+def loadForOutputs(name, outputs: Iterable[str], **kwargs) -> Language:
+    '''
+    Loads a pipeline package or directory with only the components needed to produce the outputs, ie:
+    nlp = loadForOutputs("en_emr_pipeline_nlp", ["demograph_items", "demograph_by_sent"])
+    The excluded components are not loaded at all, and neither are the components the package disables (ie. the
+    parser). Additional keyword arguments are passed on to spacy.load.
+    '''
+    modelPath = _getModelDataPath(name)
+    config = load_config(modelPath/"config.cfg")
+    exclude = list(kwargs.pop("exclude", [])) + list(config["nlp"].get("disabled", []))
+    pipes = [(pipeName, config["components"][pipeName]["factory"])
+             for pipeName in config["nlp"]["pipeline"] if pipeName not in exclude]
+    keep = resolvePipes(pipes, outputs)
+    exclude += [pipeName for pipeName, _ in pipes if pipeName not in keep]
+    registry.get("misc", "ensureResultExtensions")()
+    return spacy.load(name, exclude=exclude, **kwargs)
+
+
+def _getModelDataPath(name) -> Path:
+    '''Returns the directory holding config.cfg of a pipeline package or directory. Importing a package registers its factories.'''
+    if isinstance(name, str) and is_package(name):
+        importlib.import_module(name)
+        packagePath = get_package_path(name)
+        meta = get_model_meta(packagePath)
+        return packagePath/f"{meta['lang']}_{meta['name']}-{meta['version']}"
+    return Path(name)
@@ -1,9 +1,12 @@
 from intervaltree import IntervalTree
 from spacy.language import Language
 from spacy.tokens import Doc
+from spacy import registry
 
 try:
-    @Language.factory("post_process")
+    @Language.factory("post_process",
+                      requires=["doc._.rule_based_emr_items", "doc._.emrSections"],
+                      assigns=["doc._.rule_based_emr_items"])
     def createEmrPostProcessor(nlp: Language, name: str):
         return PostProcessor(nlp)
 except:
@@ -15,43 +18,40 @@ class PostProcessor:
 
     def __init__(self, nlp: Language):
         self.sectionsIgnored = ['fam_history']
+        self.getMatchRecords = registry.get("misc", "getMatchRecords")
+        self.setMatchRecords = registry.get("misc", "setMatchRecords")
 
     def __call__(self, doc: Doc) -> Doc:
-        doc._.rule_based_emr_items = self.emrPostProcessor(doc, getattr(doc._, "rule_based_emr_items", {}))
+        with registry.get("misc", "getStageBudget")(doc, "post_process") as budget:
+            matches = self.getMatchRecords(doc, "rule_based_emr_items") or []
+            self.setMatchRecords(doc, "rule_based_emr_items", "sentenceConditions", self.emrPostProcessor(doc, matches, budget=budget))
+        if budget.isExceeded:
+            registry.get("misc", "markDegraded")(doc, "post_process")
         return doc
 
-    def emrPostProcessor(self, doc: Doc, results):
-        emrSections = getattr(doc._, "emrSections", [])
-        results = self._removeEntitesFromIgnoredSections(results, emrSections)
-        results = self._filterEntitiesOfNestedTriggers(results)
-
-        icdCodes = self._makeSentenceResults(results)
+    def emrPostProcessor(self, doc: Doc, matches, emrSections=None, budget=None):
+        '''
+        Returns the condition matches (see ConditionMatch) that are kept, grouped by sentence. They read as a list of
+        sentences {start, end, codes: [{tag, concept_id, triggers} ...]} from doc._.rule_based_emr_items.
+        Once the StageBudget is exceeded, matches with nested triggers are no longer filtered.
+        '''
+        if emrSections is None:
+            emrSections = getattr(doc._, "emrSections", [])
 
-        return icdCodes
+        sentSpans = dict()
+        for match in matches:
+            sentSpans.setdefault((match.sentStart, match.sentEnd), []).append(match)
 
-    def _makeSentenceResults(self, sentSpans):
+        results = self._removeEntitesFromIgnoredSections(sentSpans, emrSections)
+        results = self._filterEntitiesOfNestedTriggers(results, budget)
 
-        output = []
-        for sentSpan, codes in sentSpans.items():
-            for code in codes:
-                code.pop('start', None)
-                code.pop('end', None)
-                code.pop('next', None)
-            sentStart, sentEnd = sentSpan
-            sentenceDict = {
-                'start': sentStart,
-                'end': sentEnd,
-                'codes': codes
-            }
-            output.append(sentenceDict)
-
-        return output
+        return tuple(match for codes in results.values() for match in codes)
 
     def _removeEntitesFromIgnoredSections(self, sentSpans, emrSections):
         '''
         Creates dictionary of sentence spans each containing a list of icdCodes, skipping those that are in EMR sections to be ignored.
         emrSections: list of namedtuple(start, end, type) describing EMR sections.
-        results: dictionary, key: (spanStart, spanEnd), value: list of dictionary {start, end, tag, type, triggers, next} describing ICD codes in document
+        results: dictionary, key: (spanStart, spanEnd), value: list of ConditionMatch describing ICD codes in document
         '''
         output = dict()
         sectionIntervalTree = IntervalTree()
@@ -74,15 +74,19 @@ class PostProcessor:
 
         return output
 
-    def _filterEntitiesOfNestedTriggers(self, sentSpans):
-        '''Filter the entity linked list to remove items with nested trigger words.'''
+    def _filterEntitiesOfNestedTriggers(self, sentSpans, budget=None):
+        '''Filter the condition matches to remove items with nested trigger words, until the StageBudget is exceeded.'''
 
         for sentSpan, codeList in sentSpans.items():
+            if budget is not None and budget.exceeded():
+                break
 
             sortedList = sorted(codeList,  key=lambda item: self._getLinkDepth(item), reverse=True)
             removalIndices = set()
 
             for i, item in enumerate(sortedList):
+                if budget is not None and budget.exceeded():
+                    break
                 compareIndex = i + 1
 
                 while compareIndex < len(sortedList):
@@ -93,8 +97,8 @@ class PostProcessor:
                     elif nestStatus < 0:
                         removalIndices.add(i)
                     else:
-                        itemText = item.get('triggers') or item.get('text')
-                        compareText = sortedList[compareIndex].get('triggers') or sortedList[compareIndex].get('text')
+                        itemText = item.triggerText
+                        compareText = sortedList[compareIndex].triggerText
                         if self._checkTriggerTokenNested(itemText, compareText) > 0:
                             removalIndices.add(compareIndex)
                     # elif overlapStatus > 0:
@@ -109,37 +113,22 @@ class PostProcessor:
 
         return sentSpans
 
-    def _getLinkDepth(self, head):
-        '''Helper method to return depth of an element in a linked list.'''
-        cursor = head
-        i = 1
-        while 'next' in cursor:
-            i += 1
-            cursor = cursor['next']
-        return i
+    def _getLinkDepth(self, match):
+        '''Helper method to return the number of trigger tokens of a match.'''
+        return len(match.triggers)
 
-    def _checkSpanNested(self, headA, headB):
+    def _checkSpanNested(self, matchA, matchB):
         '''
             Helper method that check if two sets of annotations are nested.
-            Given the heads of two linked set of annotations. Compare the spans of the two sets,
+            Given two condition matches, compare the spans of their trigger tokens,
             return 1 if the first set is larger and overlaps all of the second set;
             return -1 if the second set is larger and overlaps all of the first set;
             return 0 otherwise (including when the two sets have equal spans).
             Note: a span is a tuple of start and end position numbers, ie: (2,7)
         '''
 
-        spansA = self._getSpanTuple(headA)
-        spansB = self._getSpanTuple(headB)
-
-        cursor = headA
-        while 'next' in cursor:
-            spansA.extend(self._getSpanTuple(cursor['next']))
-            cursor = cursor['next']
-
-        cursor = headB
-        while 'next' in cursor:
-            spansB.extend(self._getSpanTuple(cursor['next']))
-            cursor = cursor['next']
+        spansA = [i for trigger in matchA.triggers for i in self._getSpanTuple(trigger)]
+        spansB = [i for trigger in matchB.triggers for i in self._getSpanTuple(trigger)]
 
         aSet = set(spansA)
         bSet = set(spansB)
@@ -170,9 +159,9 @@ class PostProcessor:
         captured as "ST" or Non-ST", and this would prevent comparison based on simple tuple objects.
         '''
 
-    def _getSpanTuple(self, annot):
-        '''Helper method that returns 'start' and 'end' members as a tuple.'''
-        return list(range(annot['start'], annot['end']))
+    def _getSpanTuple(self, trigger):
+        '''Helper method that returns the character positions covered by a trigger token.'''
+        return list(range(trigger.start, trigger.end))
 
     def _checkTriggerTokenNested(self, tokens, otherTokens):
         '''Check two lists of strings and see if they are nested.'''
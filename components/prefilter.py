@@ -0,0 +1,205 @@
+from typing import Dict, Iterable, List
+from collections import deque
+from spacy.language import Language
+from spacy.tokens import Doc
+from spacy import registry
+import pickle
+import threading
+
+try:
+    @Language.factory("emr_prefilter", default_config={"enabled": True}, assigns=["doc._.emrSkipRules"])
+    def createRulePrefilter(nlp: Language, name: str, enabled: bool):
+        return RulePrefilter(nlp, enabled)
+except:
+    pass
+
+
+def compactText(text: str) -> str:
+    '''
+    Returns a text lowercased without whitespace. The PhraseMatchers match the lowercased tokens of a phrase in sequence,
+    whatever the whitespace between them (ie. "heart-failure" and "heart - failure"), so a phrase matched in a note is
+    always found in the compacted note by its compacted form.
+    '''
+    return "".join(text.lower().split())
+
+
+class AhoCorasick:
+    '''
+    Aho-Corasick automaton over a set of keys, telling whether a text contains any of them in a single pass over it.
+    States are numbered from the root (0); transitions holds the characters leading out of every state, fail the state
+    to fall back to when a character has no transition, and final whether a key ends at the state (or at a state it falls
+    back to). Held as plain lists and dicts, so that it pickles without this class.
+    '''
+
+    def __init__(self, transitions: List[Dict[str, int]], fail: List[int], final: List[bool]):
+        self.transitions = transitions
+        self.fail = fail
+        self.final = final
+
+    @classmethod
+    def fromKeys(cls, keys: Iterable[str]):
+        transitions = [{}]
+        final = [False]
+        for key in keys:
+            if not key:
+                continue
+            state = 0
+            for character in key:
+                nextState = transitions[state].get(character)
+                if nextState is None:
+                    nextState = len(transitions)
+                    transitions[state][character] = nextState
+                    transitions.append({})
+                    final.append(False)
+                state = nextState
+            final[state] = True
+
+        fail = [0] * len(transitions)
+        queue = deque(transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for character, nextState in transitions[state].items():
+                fallback = fail[state]
+                while fallback and character not in transitions[fallback]:
+                    fallback = fail[fallback]
+                fail[nextState] = transitions[fallback].get(character, 0)
+                final[nextState] = final[nextState] or final[fail[nextState]]
+                queue.append(nextState)
+        return cls(transitions, fail, final)
+
+    def toData(self):
+        return (self.transitions, self.fail, self.final)
+
+    @classmethod
+    def fromData(cls, data):
+        return cls(*data)
+
+    def __len__(self):
+        return len(self.transitions)
+
+    def contains(self, text: str) -> bool:
+        '''Returns True as soon as a key is found in the text.'''
+        transitions, fail, final = self.transitions, self.fail, self.final
+        state = 0
+        for character in text:
+            while state and character not in transitions[state]:
+                state = fail[state]
+            state = transitions[state].get(character, 0)
+            if final[state]:
+                return True
+        return False
+
+
+class RulePrefilter:
+    '''
+    Scans the raw text of a note for the phrases that can produce a rule-based result: the phrases of every level of the
+    condition rules, which EmrPhraseMatcher lists in doc._.emrPhrases, and the demographic phrases. When a note contains
+    none of them, doc._.emrSkipRules is set, and EmrPhraseMatcher, DemographMatcher, NegationMatcher and MedCondDetect
+    return empty results for it without matching (see isRuleSkipped). Sentences, sections and the XGB scores are still
+    produced. To be placed first, so that the skipped stages never see the note. pipeSkippingRules (see
+    pipelineProfiles) also skips the tagger and lemmatizer for these notes.
+
+    Phrases are looked up in their compacted form (see compactText) by an AhoCorasick automaton built with the rules, so
+    that no note with a phrase match is skipped. Misspelled phrases are not looked up, so no note is skipped while the
+    pipeline has a SpellNormalizer, which could correct one (ie. "hypetension").
+    getReport() returns the fraction of notes skipped.
+    '''
+
+    def __init__(self, nlp: Language, enabled: bool = True):
+        self.nlp = nlp
+        self.enabled = enabled
+        self.documents = 0
+        self.skipped = 0
+        self.countLock = threading.Lock()
+        self.ruleAssets = registry.get("misc", "RuleAssets")(self)
+        self.setAssets((None,))
+        if not Doc.has_extension("emrSkipRules"):
+            Doc.set_extension("emrSkipRules", default=False)
+
+    def to_disk(self, path, exclude=tuple()):
+        dataPath = path.parent/"ruleprefilter.bin"
+        assets = (self.automaton.toData() if self.automaton is not None else None,)
+        with open(dataPath, 'wb') as f:
+            pickle.dump(assets, f)
+
+    def from_disk(self, path, exclude=tuple()):
+        dataPath = path.parent/"ruleprefilter.bin"
+        with open(dataPath, 'rb') as f:
+            assets = pickle.load(f)
+        self.setAssets(assets)
+
+    def build(self):
+        self.setAssets(self.buildAssets())
+
+    def buildAssets(self, tokenizer=None):
+        '''
+        Returns new assets (automaton data,) built from the phrases of the 'getRuleBasedPhrases' (or
+        'getRuleBasedSearchAsset') and 'getDemographRules' registry functions.
+        '''
+        if registry.has("misc", "getRuleBasedPhrases"):
+            phrases = list(registry.get("misc", "getRuleBasedPhrases")())
+        elif registry.has("misc", "getRuleBasedSearchAsset"):
+            _, terms, _ = registry.get("misc", "getRuleBasedSearchAsset")()
+            phrases = list(terms)
+        else:
+            print("\033[91m WARNING:\033[0m Building without 'getRuleBasedSearchAsset' method provided via spaCy registry will result in non-function of RulePrefilter component.")
+            return (None,)
+
+        if registry.has("misc", "getDemographRules"):
+            phrases.extend(phrase for rule in registry.get("misc", "getDemographRules")() for phrase in rule['phrases'])
+        return (AhoCorasick.fromKeys(sorted({compactText(phrase) for phrase in phrases})).toData(),)
+
+    def setAssets(self, assets, generation=None):
+        '''Sets the assets (automaton data,), right away or for the docs of a rule generation (see RuleAssets).'''
+        data, = assets
+        self.automaton = AhoCorasick.fromData(data) if data is not None else None
+        self.ruleAssets.set(self.automaton, generation)
+
+    def reload(self, background=True):
+        '''Builds new rule assets from the registry functions and swaps them in for the next documents. See reloadRules.'''
+        return self.ruleAssets.reload(background)
+
+    def hasCandidates(self, text: str, automaton=False) -> bool:
+        '''
+        Returns False if the text contains none of the rule phrases, looked up with the automaton of a rule generation, the
+        latest one by default. Always True without an automaton.
+        '''
+        automaton = self.automaton if automaton is False else automaton
+        return automaton is None or automaton.contains(compactText(text))
+
+    def skipsRules(self, text: str, enabled: bool = None, automaton=False) -> bool:
+        '''
+        Returns True if the rule stages skip a text: the prefilter is enabled, the pipeline has no SpellNormalizer, and the
+        text contains none of the rule phrases (see hasCandidates).
+        '''
+        enabled = self.enabled if enabled is None else enabled
+        return enabled and not self._hasSpellNormalizer() and not self.hasCandidates(text, automaton)
+
+    def _hasSpellNormalizer(self) -> bool:
+        return any(self.nlp.get_pipe_meta(name).factory == "emr_spell_normalizer" for name in self.nlp.pipe_names)
+
+    def __call__(self, doc: Doc, enabled: bool = None, skip: bool = None) -> Doc:
+        '''
+        Sets doc._.emrSkipRules (see skipsRules), or to skip if given, ie. as decided by pipeSkippingRules before
+        processing the doc. Can be turned off per call, ie. nlp(text, component_cfg={"emr_prefilter": {"enabled": False}}).
+        '''
+        with registry.get("misc", "getStageBudget")(doc, "emr_prefilter"):
+            automaton = self.ruleAssets.get(doc)[1]
+            doc._.emrSkipRules = self.skipsRules(doc.text, enabled, automaton) if skip is None else skip
+        with self.countLock:
+            self.documents += 1
+            self.skipped += doc._.emrSkipRules
+        return doc
+
+    def getReport(self) -> dict:
+        '''Returns the numbers of notes seen and skipped by this process since the last reset, and the fraction skipped.'''
+        return {
+            "documents": self.documents,
+            "skipped": self.skipped,
+            "skippedFraction": self.skipped / self.documents if self.documents else 0.0,
+        }
+
+    def resetReport(self):
+        with self.countLock:
+            self.documents = 0
+            self.skipped = 0
@@ -0,0 +1,214 @@
+from typing import Iterable, Optional
+from pathlib import Path
+from itertools import islice
+from tempfile import TemporaryDirectory
+from spacy import registry
+from spacy.language import Language
+import hashlib
+import json
+import pickle
+import sqlite3
+
+
+def getReloadedGenerations(nlp: Language) -> list:
+    '''Returns [(component name, generation) ...] of the components whose rules were reloaded (see reloadRules).'''
+    return [(name, component.ruleAssets.reloadedGeneration) for name, component in nlp.pipeline
+            if hasattr(component, "ruleAssets") and component.ruleAssets.reloadedGeneration is not None]
+
+
+def getPipelineFingerprint(nlp: Language, salt: str = "") -> str:
+    '''
+    Returns a hex digest identifying the loaded pipeline and its rule and model assets.
+    The digest covers the pipeline meta, the component names, and the content of every serialized component asset
+    (.bin files, and the .npy arrays of the XGB vocabulary).
+    If the pipeline was not loaded from disk, its components are serialized to a temporary directory to be hashed. Some
+    of them serialize their matchers along with the vocab, which grows as notes are processed, so the digest of such a
+    pipeline changes over time; load the pipeline from disk, or pass a fingerprint to ResultCache, to share a SQLite file.
+    Rules reloaded since the pipeline was loaded (see reloadRules) are not in its files, so the digest also covers the
+    reloaded generations of the process (see getReloadedGenerations). Results cached with reloaded rules are therefore
+    only read by the process that reloaded them.
+    The salt can be used to invalidate the cache when something outside of the pipeline changes, ie. the
+    'getConceptMap' registry function.
+    '''
+    digest = hashlib.sha256()
+    meta = {"name": nlp.meta.get("name"), "version": nlp.meta.get("version"), "pipeline": nlp.pipe_names}
+    digest.update(json.dumps(meta, sort_keys=True).encode("utf-8"))
+    digest.update(salt.encode("utf-8"))
+    reloaded = getReloadedGenerations(nlp)
+    if reloaded:
+        digest.update(json.dumps([registry.get("misc", "RuleGenerations").runId, reloaded]).encode("utf-8"))
+
+    def _hashAssets(directory: Path):
+        for assetPath in sorted([*directory.glob("*.bin"), *directory.glob("*.npy")]):
+            digest.update(assetPath.name.encode("utf-8"))
+            with open(assetPath, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+
+    modelPath = getattr(nlp, "path", None)
+    if modelPath is not None and any(Path(modelPath).glob("*.bin")):
+        _hashAssets(Path(modelPath))
+    else:
+        with TemporaryDirectory() as tmp:
+            for name, component in nlp.pipeline:
+                if hasattr(component, "to_disk") and not hasattr(component, "model"):
+                    component.to_disk(Path(tmp)/name)
+            _hashAssets(Path(tmp))
+
+    return digest.hexdigest()
+
+
+class ResultCache:
+    '''
+    Content-addressed cache of pipeline results, with an in-memory LRU tier and an optional SQLite tier on disk.
+    Results are keyed by a hash of the note text and the pipeline fingerprint, so a rebuilt pipeline never reads
+    results cached by another build. The text is hashed as-is: all results carry character offsets into the
+    original text, so no normalization that changes offsets can be applied.
+    Results of documents that ran out of their time budget (see TimeBudget) are not cached.
+    Once rules are reloaded, the fingerprint is computed again, so results cached with the previous rules are no longer
+    read, by this cache or by a new one on the same SQLite file. A fingerprint given to the cache is used as is, and
+    must be changed by the caller after a reload.
+
+    Usage:
+        cache = ResultCache(nlp, path="results.sqlite")
+        for doc in cache.pipe(texts):
+            ...
+        print(cache.report())
+    '''
+
+    def __init__(self, nlp: Language, maxSize: int = 10000, path: Optional[Path] = None, fingerprint: Optional[str] = None):
+        self.nlp = nlp
+        self.fixedFingerprint = fingerprint
+        self.reloaded = getReloadedGenerations(nlp)
+        self.fingerprint = fingerprint or getPipelineFingerprint(nlp)
+        self.memory = registry.get("misc", "LruCache")(maxSize)
+        self.getDocResults = registry.get("misc", "getDocResults")
+        self.setDocResults = registry.get("misc", "setDocResults")
+        self.path = path
+        self.connection = None
+        self.memoryHits = 0
+        self.diskHits = 0
+        self.misses = 0
+        self.bytesSaved = 0
+
+        if path is not None:
+            self.connection = sqlite3.connect(str(path))
+            self.connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB)")
+            self.connection.commit()
+
+    def getKey(self, text: str, componentCfg: Optional[dict] = None) -> str:
+        '''Returns the cache key of a text, processed with the per-call component_cfg if given (ie. section scoping).'''
+        self._checkReloads()
+        digest = hashlib.sha256(self.fingerprint.encode("utf-8"))
+        if componentCfg:
+            digest.update(json.dumps(componentCfg, sort_keys=True, default=str).encode("utf-8"))
+        digest.update(text.encode("utf-8"))
+        return digest.hexdigest()
+
+    def _checkReloads(self):
+        '''Computes the fingerprint again if rules were reloaded since it was computed.'''
+        reloaded = getReloadedGenerations(self.nlp)
+        if reloaded != self.reloaded:
+            self.reloaded = reloaded
+            if self.fixedFingerprint is None:
+                self.fingerprint = getPipelineFingerprint(self.nlp)
+
+    def get(self, key: str):
+        '''Returns cached results for the key from the memory tier, then the disk tier, or None.'''
+        results = self.memory.get(key)
+        if results is not None:
+            self.memoryHits += 1
+            return results
+
+        if self.connection is not None:
+            row = self.connection.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                results = pickle.loads(row[0])
+                self.memory.put(key, results)
+                self.diskHits += 1
+                return results
+
+        return None
+
+    def put(self, key: str, results: dict):
+        self.memory.put(key, results)
+        if self.connection is not None:
+            self.connection.execute("INSERT OR REPLACE INTO results (key, value) VALUES (?, ?)",
+                                    (key, pickle.dumps(results, protocol=pickle.HIGHEST_PROTOCOL)))
+
+    def pipe(self, texts: Iterable, as_tuples: bool = False, batch_size: int = 1000, **kwargs):
+        '''
+        Same as nlp.pipe, except that texts with cached results skip all pipeline components: the doc is only tokenized
+        and the result extensions are restored from the cache. Docs are yielded in input order.
+        Additional keyword arguments are passed on to nlp.pipe for the texts that are not cached.
+        '''
+        items = iter(texts)
+        while True:
+            window = list(islice(items, batch_size))
+            if not window:
+                break
+            yield from self._pipeWindow(window, as_tuples, **kwargs)
+            if self.connection is not None:
+                self.connection.commit()
+
+    def _pipeWindow(self, window, as_tuples, **kwargs):
+        texts = [i[0] for i in window] if as_tuples else window
+        keys = [self.getKey(text, kwargs.get("component_cfg")) for text in texts]
+        cached = {}
+        missed = {}
+
+        for key, text in zip(keys, texts):
+            if key in cached or key in missed:
+                continue
+            results = self.get(key)
+            if results is None:
+                missed[key] = text
+            else:
+                cached[key] = results
+
+        processed = {}
+        for key, doc in zip(missed.keys(), self.nlp.pipe(missed.values(), **kwargs)):
+            results = self.getDocResults(doc)
+            if not results.get("emr_degraded"):  # results of a stage that ran out of time are not reused
+                self.put(key, results)
+            processed[key] = doc
+            cached[key] = results
+            self.misses += 1
+
+        restored = set()
+        for i, (key, text) in enumerate(zip(keys, texts)):
+            doc = processed.pop(key, None)
+            if doc is None:
+                if key in restored or key in missed:  # a repeat of a text seen earlier in this window
+                    self.memoryHits += 1
+                restored.add(key)
+                doc = self.setDocResults(self.nlp.make_doc(text), cached[key])
+                self.bytesSaved += len(text.encode("utf-8"))
+
+            yield (doc, window[i][1]) if as_tuples else doc
+
+    def report(self) -> dict:
+        '''Returns hit counters, hit rate and the number of text bytes that did not need to be processed.'''
+        hits = self.memoryHits + self.diskHits
+        lookups = hits + self.misses
+        return {
+            "hits": hits,
+            "memoryHits": self.memoryHits,
+            "diskHits": self.diskHits,
+            "misses": self.misses,
+            "hitRate": hits / lookups if lookups else 0.0,
+            "bytesSaved": self.bytesSaved,
+            "memoryEntries": len(self.memory),
+        }
+
+    def clear(self):
+        self.memory.clear()
+        if self.connection is not None:
+            self.connection.execute("DELETE FROM results")
+            self.connection.commit()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.commit()
+            self.connection.close()
+            self.connection = None
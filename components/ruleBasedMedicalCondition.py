@@ -1,27 +1,41 @@
-from typing import TypedDict, Dict, List, NamedTuple
+from typing import TypedDict, Dict, List, NamedTuple, Optional
 from collections import defaultdict
 import csv
 from spacy.language import Language
 from spacy.tokens import Doc
 from intervaltree import IntervalTree
 from spacy.matcher import PhraseMatcher
-from itertools import groupby
 from operator import itemgetter
 from spacy import registry
+from array import array
 import pickle
+import threading
+import time
 
 try:
-    @Language.factory("emr_phrase_matcher")
-    def createEmrPhraseMatcher(nlp: Language, name: str):
-        return EmrPhraseMatcher(nlp)
-
-    @Language.factory("med_cond_detect")
-    def createMedCondDetect(nlp: Language, name: str):
-        return MedCondDetect(nlp)
+    @Language.factory("emr_phrase_matcher", default_config={"memoSize": 0},
+                      requires=["token.is_sent_start"],
+                      assigns=["doc._.emrPhrases"])
+    def createEmrPhraseMatcher(nlp: Language, name: str, memoSize: int):
+        return EmrPhraseMatcher(nlp, memoSize)
+
+    @Language.factory("med_cond_detect", default_config={"memoSize": 0, "accounting": False},
+                      requires=["doc._.emrPhrases", "token.is_sent_start"],
+                      assigns=["doc._.rule_based_emr_items", "doc._.rule_based_emr_by_sent"])
+    def createMedCondDetect(nlp: Language, name: str, memoSize: int, accounting: bool):
+        return MedCondDetect(nlp, memoSize, accounting)
 except:
     pass
 
 
+def getRulePhrases():
+    '''Returns an iterable of the phrases of the rule table, streamed by the 'getRuleBasedPhrases' registry function if provided.'''
+    if registry.has("misc", "getRuleBasedPhrases"):
+        return registry.get("misc", "getRuleBasedPhrases")()
+    _, terms, _ = getSearchAsset()
+    return terms
+
+
 def getSearchAsset():
     if registry.has("misc", "getRuleBasedSearchAsset"):
         return registry.get("misc", "getRuleBasedSearchAsset")()
@@ -46,15 +60,125 @@ class SpanTuple(NamedTuple):
 MatchedEntitiesBySentSpan = Dict[SpanTuple, List[MatchEntity]]
 
 
+class CompactSearchAsset:
+    '''
+    Compact form of the search asset (see getRuleBasedSearchAsset) used by MedCondDetect.
+    Phrases and seq_ids are interned to integer ids, their positions in the sorted phrase and seq_id tables.
+    Level 1 maps each phrase id to seq ids, and every deeper level maps each seq id to phrase ids; each level is held in
+    two flat typed arrays, where the entries of id i are values[offsets[i]:offsets[i + 1]].
+    Only plain tuples, lists and arrays are serialized (see toData), so the asset loads without this class being importable
+    under the same module path.
+    Seq ids without a concept read as '', as from the defaultdict(str) of the dictionary layout.
+    '''
+
+    NO_CONCEPT = -1
+    NULL_CONCEPT = -2
+    '''Concept id of seq ids whose concept id in the table is empty (None), as opposed to seq ids missing from it.'''
+
+    def __init__(self, phrases, seqIds, conceptIds, levelOffsets, levelValues):
+        self.phrases = phrases
+        self.phraseIds = {phrase: i for i, phrase in enumerate(phrases)}
+        self.seqIds = seqIds
+        self.conceptIds = conceptIds
+        self.levelOffsets = levelOffsets
+        self.levelValues = levelValues
+
+    @classmethod
+    def fromSearchAsset(cls, searchAsset):
+        '''Returns the compact form of a search asset made of dictionaries of lists.'''
+        seqToCond, levelOne, deeperLevels = searchAsset[0], searchAsset[1], searchAsset[2:]
+
+        phrases = sorted(set(levelOne) | {phrase for level in deeperLevels for levelPhrases in level.values() for phrase in levelPhrases})
+        phraseIds = {phrase: i for i, phrase in enumerate(phrases)}
+        seqIds = sorted(set(seqToCond) | {seqId for seqs in levelOne.values() for seqId in seqs} | {seqId for level in deeperLevels for seqId in level})
+        seqIndex = {seqId: i for i, seqId in enumerate(seqIds)}
+
+        conceptIds = array('q', (cls._getConceptCode(seqToCond, seqId) for seqId in seqIds))
+        levelOffsets = [None, *(array('l', [0]) for _ in range(len(searchAsset) - 1))]
+        levelValues = [None, *(array('l') for _ in range(len(searchAsset) - 1))]
+
+        for phrase in phrases:
+            levelValues[1].extend(seqIndex[seqId] for seqId in levelOne.get(phrase, []))
+            levelOffsets[1].append(len(levelValues[1]))
+
+        for level, levelDictionary in enumerate(deeperLevels, start=2):
+            for seqId in seqIds:
+                levelValues[level].extend(phraseIds[phrase] for phrase in levelDictionary.get(seqId, []))
+                levelOffsets[level].append(len(levelValues[level]))
+
+        return cls(phrases, seqIds, conceptIds, levelOffsets, levelValues)
+
+    @classmethod
+    def _getConceptCode(cls, seqToCond, seqId) -> int:
+        if seqId not in seqToCond or seqToCond[seqId] == '':
+            return cls.NO_CONCEPT
+        return cls.NULL_CONCEPT if seqToCond[seqId] is None else seqToCond[seqId]
+
+    def toData(self):
+        return (self.phrases, self.seqIds, self.conceptIds, self.levelOffsets, self.levelValues)
+
+    @classmethod
+    def fromData(cls, data):
+        return cls(*data)
+
+    @property
+    def levelCount(self):
+        '''Number of levels, counted the same way as len(searchAsset).'''
+        return len(self.levelOffsets)
+
+    def getPhraseId(self, phrase: str) -> int:
+        '''Returns the id of a lowercased phrase, or -1 if the phrase is not in any rule.'''
+        return self.phraseIds.get(phrase, -1)
+
+    def getSeqIndices(self, phraseId: int):
+        '''Returns the seq ids (as indices into seqIds) having the phrase at level 1.'''
+        offsets = self.levelOffsets[1]
+        return self.levelValues[1][offsets[phraseId]:offsets[phraseId + 1]]
+
+    def hasLevel(self, level: int, seqIndex: int) -> bool:
+        offsets = self.levelOffsets[level]
+        return offsets[seqIndex + 1] > offsets[seqIndex]
+
+    def getLevelPhraseIds(self, level: int, seqIndex: int):
+        '''Returns the ids of the phrases of a seq id at a level of 2 and beyond.'''
+        offsets = self.levelOffsets[level]
+        return self.levelValues[level][offsets[seqIndex]:offsets[seqIndex + 1]]
+
+    def getConceptId(self, seqIndex: int):
+        conceptId = self.conceptIds[seqIndex]
+        if conceptId == self.NO_CONCEPT:
+            return ''
+        return None if conceptId == self.NULL_CONCEPT else conceptId
+
+
+def measureSearchAssetMemory(searchAsset) -> dict:
+    '''
+    Returns the memory in bytes held by a search asset in the dictionary-of-lists layout, and by its compact form
+    (see CompactSearchAsset), including all the strings, lists and arrays they reference.
+    '''
+    getDeepSizeOf = registry.get("misc", "getDeepSizeOf")
+    compact = CompactSearchAsset.fromSearchAsset(searchAsset)
+    dictionaries = getDeepSizeOf(searchAsset)
+    compactSize = getDeepSizeOf(compact.toData()) + getDeepSizeOf(compact.phraseIds, exclude=compact.phrases)
+    return {"dictOfLists": dictionaries, "compact": compactSize, "ratio": compactSize / dictionaries if dictionaries else 0.0}
+
+
 class EmrPhraseMatcher:
 
-    def __init__(self, nlp: Language):
+    def __init__(self, nlp: Language, memoSize: int = 0):
         self.nlp = nlp
-        self.matcher = PhraseMatcher(self.nlp.vocab, attr="LOWER")
+        self.sentenceMemo = registry.get("misc", "LruCache")(memoSize) if memoSize > 0 else None
+        self.ruleAssets = registry.get("misc", "RuleAssets")(self)
+        self.setAssets((PhraseMatcher(self.nlp.vocab, attr="LOWER"), array('Q'), array('Q', [0])))
+        if not Doc.has_extension("emrPhrases"):
+            Doc.set_extension("emrPhrases", default=None)
 
     def to_disk(self, path, exclude=tuple()):
         dataPath = path.parent/"emrphrasematcher.bin"
-        assets = (self.matcher,)
+        if self.patternHashes is None:
+            assets = (self.matcher,)
+        else:
+            assets = (self.patternHashes, self.patternOffsets)
         with open(dataPath, 'wb') as f:
             pickle.dump(assets, f)
 
@@ -62,21 +186,85 @@ class EmrPhraseMatcher:
         dataPath = path.parent/"emrphrasematcher.bin"
         with open(dataPath, 'rb') as f:
             assets = pickle.load(f)
-            self.matcher, = assets
+        if len(assets) == 1:  # pipelines saved with the pickled matcher
+            self.setAssets((assets[0], None, None))
+        else:
+            patternHashes, patternOffsets = assets
+            self.setAssets((self.makeMatcher(self.nlp.vocab, patternHashes, patternOffsets), patternHashes, patternOffsets))
 
-    def build(self):
-        _, terms, _ = getSearchAsset()
-        patterns = [self.nlp.make_doc(text) for text in terms]
-        self.matcher.add("emr_phrase", patterns)
+    def build(self, chunkSize=10000):
+        self.setAssets(self.buildAssets(chunkSize=chunkSize))
+
+    def buildAssets(self, tokenizer=None, chunkSize=10000):
+        '''Returns new assets (matcher, patternHashes, patternOffsets) built from the phrases of the rule table (see getRulePhrases).'''
+        if tokenizer is None:
+            tokenizer = self.nlp.tokenizer
+        return self.buildAssetsFromPhrases(getRulePhrases(), tokenizer, chunkSize)
+
+    def buildAssetsFromPhrases(self, phrases, tokenizer, chunkSize=10000):
+        '''
+        Returns new assets (matcher, patternHashes, patternOffsets) for an iterable of phrases, which is consumed as a stream.
+        Phrases are tokenized in batches, and only the LOWER hashes of their tokens are kept: the tokens of pattern i are
+        patternHashes[patternOffsets[i]:patternOffsets[i + 1]]. The hashes are then added to the matcher chunkSize
+        patterns at a time, so that pattern docs are never held in memory all at once.
+        The hashes are what gets saved to disk, instead of the pickled matcher and the vocab it references.
+        '''
+        patternHashes = array('Q')
+        patternOffsets = array('Q', [0])
+
+        for doc in tokenizer.pipe(phrases, batch_size=1000):
+            if len(doc):
+                patternHashes.extend(token.lower for token in doc)
+                patternOffsets.append(len(patternHashes))
+
+        return (self.makeMatcher(tokenizer.vocab, patternHashes, patternOffsets, chunkSize), patternHashes, patternOffsets)
+
+    @staticmethod
+    def makeMatcher(vocab, patternHashes, patternOffsets, chunkSize=10000):
+        '''Returns a PhraseMatcher on LOWER made of the patterns given as token hashes (see buildAssetsFromPhrases).'''
+        matcher = PhraseMatcher(vocab, attr="LOWER")
+        patternCount = len(patternOffsets) - 1
+        for chunkStart in range(0, patternCount, chunkSize):
+            chunk = [tuple(patternHashes[patternOffsets[i]:patternOffsets[i + 1]])
+                     for i in range(chunkStart, min(chunkStart + chunkSize, patternCount))]
+            matcher.add("emr_phrase", chunk)
+        return matcher
+
+    def setAssets(self, assets, generation=None):
+        '''
+        Sets the assets (matcher, patternHashes, patternOffsets), right away or for the docs of a rule generation (see
+        RuleAssets). Pipelines saved with the pickled matcher have no pattern hashes, so the length of their longest
+        pattern is unknown.
+        '''
+        self.matcher, self.patternHashes, self.patternOffsets = assets
+        if self.patternOffsets is None:
+            self.maxPatternLength = None
+        else:
+            self.maxPatternLength = max((j - i for i, j in zip(self.patternOffsets, self.patternOffsets[1:])), default=0)
+        if self.sentenceMemo is not None:
+            self.sentenceMemo.clear()
+        self.ruleAssets.set((self.matcher, self.maxPatternLength), generation)
+
+    def reload(self, background=True):
+        '''Builds new rule assets from the registry functions and swaps them in for the next documents. See reloadRules.'''
+        return self.ruleAssets.reload(background)
 
     def __call__(self, doc: Doc) -> Doc:
-        doc.set_extension("emrPhrases", default=None, force=True)
-        doc._.emrPhrases = self.medicalPhraseMatcher(doc)
+        with registry.get("misc", "getStageBudget")(doc, "emr_phrase_matcher"):
+            doc._.emrPhrases = {} if registry.get("misc", "isRuleSkipped")(doc) else self.medicalPhraseMatcher(doc)
         return doc
 
     def medicalPhraseMatcher(self, doc):
+        '''Returns the EMR phrases of a doc, matched with the assets of its rule generation (see RuleAssets).'''
+        generation, (matcher, maxPatternLength) = self.ruleAssets.get(doc)
+        if self.sentenceMemo is not None and maxPatternLength is not None:
+            return self._memoizedPhraseMatcher(doc, generation, matcher, maxPatternLength)
+
         outputMatches = {}
-        spans = [doc[start:end] for _, start, end in self.matcher(doc)]
+        if doc.has_extension("emrScope") and doc._.emrScope is not None:
+            spans = [span for part in registry.get("misc", "getScopedSpans")(doc) for span in matcher(part, as_spans=True)]
+        else:
+            spans = [doc[start:end] for _, start, end in matcher(doc)]
 
         for i in spans:
             start_token = doc[i.start]
@@ -88,19 +276,124 @@ class EmrPhraseMatcher:
 
         return outputMatches
 
+    def _memoizedPhraseMatcher(self, doc, generation, matcher, maxPatternLength):
+        '''
+        Same as medicalPhraseMatcher, but matches each sentence separately and memoizes the sentence-relative match
+        offsets by the lowercased tokens of the sentence, so that repeated template sentences are only matched once.
+        Phrases spanning a sentence boundary are matched in the tokens around the boundary, which are never memoized
+        (see getSentenceBoundaryWindows), so the matches are the same as those of medicalPhraseMatcher.
+        Pipelines saved with the pickled matcher do not know the length of their patterns, and are not memoized.
+        Memoized matches are keyed by rule generation too, so that docs of different generations never share them.
+        '''
+        outputMatches = {}
+
+        for boundary, window in registry.get("misc", "getSentenceBoundaryWindows")(doc, maxPatternLength):
+            for span in matcher(window, as_spans=True):
+                if span.start < boundary < span.end:
+                    outputMatches[(span.start_char, span.end_char)] = {"text": span.text, "type": "medical_phrase"}
+
+        for sent in registry.get("misc", "getScopedSentences")(doc):
+            sentStart = sent.start_char
+            key = (generation, tuple((token.lower_, token.whitespace_) for token in sent))
+            relativeSpans = self.sentenceMemo.get(key)
+
+            if relativeSpans is None:
+                relativeSpans = [(span.start_char - sentStart, span.end_char - sentStart)
+                                 for span in matcher(sent, as_spans=True)]
+                self.sentenceMemo.put(key, relativeSpans)
+
+            for start, end in relativeSpans:
+                start_char = start + sentStart
+                end_char = end + sentStart
+                text = doc.text[start_char:end_char]
+                outputMatches[(start_char, end_char)] = {"text": text, "type": "medical_phrase"}
+
+        return outputMatches
+
+
+class RuleAccounting:
+    '''
+    Counts, per seq_id of the rule table (a row of phrase_to_condition.csv) and per level, how many times MedCondDetect
+    evaluates the level and how many times the level matches, along with the time spent, and how many times the rule
+    fires (all its levels match). A rule is evaluated from level 2 on whenever its level 1 phrase is in a sentence, so
+    level 1 is counted as one evaluation and one hit.
+    '''
+
+    def __init__(self):
+        self.levels = {}
+        '''{(seqId, level): [evaluations, hits, seconds]}'''
+        self.fires = {}
+        self.lock = threading.Lock()
+
+    def record(self, seqId, level: int, hit: bool, seconds: float = 0.0):
+        with self.lock:
+            entry = self.levels.get((seqId, level))
+            if entry is None:
+                entry = self.levels[(seqId, level)] = [0, 0, 0.0]
+            entry[0] += 1
+            entry[1] += hit
+            entry[2] += seconds
+
+    def recordFire(self, seqId):
+        with self.lock:
+            self.fires[seqId] = self.fires.get(seqId, 0) + 1
+
+    def clear(self):
+        with self.lock:
+            self.levels.clear()
+            self.fires.clear()
+
+    def getReport(self, rules, sortBy: str = "seconds") -> List[dict]:
+        '''
+        Returns a row for each of the rules, given as (seqId, conceptId, levelCount), sorted by sortBy in descending
+        order ("seconds", "evaluations", "fires"), then by seq_id:
+        {"seqId": "S0001", "conceptId": 320128, "evaluations": 12, "fires": 3, "seconds": 0.0021,
+         "levels": {2: {"evaluations": 12, "hits": 5, "seconds": 0.0012}, 3: {...}}}
+        where evaluations is the number of times the level 1 phrase was found, and seconds the time spent on the deeper
+        levels (the level 1 lookup is not timed, see MedCondDetect.dumpAccountingReport). Rules that never fired have 0 fires.
+        '''
+        with self.lock:
+            entries = {key: tuple(entry) for key, entry in self.levels.items()}
+            fires = dict(self.fires)
+
+        report = []
+        for seqId, conceptId, levelCount in rules:
+            levels = {}
+            for level in range(2, levelCount):
+                entry = entries.get((seqId, level))
+                if entry is not None:
+                    levels[level] = {"evaluations": entry[0], "hits": entry[1], "seconds": entry[2]}
+            report.append({
+                "seqId": seqId,
+                "conceptId": conceptId,
+                "evaluations": entries.get((seqId, 1), (0,))[0],
+                "fires": fires.get(seqId, 0),
+                "seconds": sum(i["seconds"] for i in levels.values()),
+                "levels": levels,
+            })
+        report.sort(key=lambda i: str(i["seqId"]))
+        report.sort(key=lambda i: i[sortBy], reverse=True)
+        return report
+
 
 class MedCondDetect:
 
-    def __init__(self, nlp: Language):
-        self.searchAsset = [{}, {}, {}]
-        self.conceptMap = {}
-        self.conceptIds = []
+    def __init__(self, nlp: Language, memoSize: int = 0, accounting: bool = False):
+        self.nlp = nlp
+        self.compact = False
         self.runtimeConceptMap = {}
-        self.flattenDictionary = registry.get("misc", "flattenDictionary")
+        self.setMatchRecords = registry.get("misc", "setMatchRecords")
+        self.sentenceMemo = registry.get("misc", "LruCache")(memoSize) if memoSize > 0 else None
+        self.accounting = RuleAccounting() if accounting else None
+        self.ruleAssets = registry.get("misc", "RuleAssets")(self)
+        self.setAssets(([{}, {}, {}], {}, [], None))
 
     def to_disk(self, path, exclude=tuple()):
         dataPath = path.parent/"medconddetect.bin"
-        assets = (self.searchAsset, self.conceptMap)
+        if self.compactAsset is not None:
+            assets = (None, self.conceptMap, self.compactAsset.toData())
+        else:
+            assets = (self.searchAsset, self.conceptMap)
         with open(dataPath, 'wb') as f:
             pickle.dump(assets, f)
 
@@ -108,12 +401,39 @@ class MedCondDetect:
         dataPath = path.parent/"medconddetect.bin"
         with open(dataPath, 'rb') as f:
             assets = pickle.load(f)
-            self.searchAsset, self.conceptMap = assets
+        compactAsset = CompactSearchAsset.fromData(assets[2]) if len(assets) > 2 else None
+        self.setAssets((assets[0], assets[1], self.conceptIds, compactAsset))
+        self.compact = compactAsset is not None
         self.runtimeConceptMap = self.getConceptMap(self.conceptIds)
 
-    def build(self):
-        self.searchAsset, _, self.conceptIds = getSearchAsset()
-        self.conceptMap = self.getConceptMap(self.conceptIds)
+    def build(self, compact=False):
+        '''
+        Builds the rule assets. With compact=True, the rules are held as a CompactSearchAsset instead of dictionaries
+        of lists, which gives the same matches and takes less memory for large rule tables (see measureSearchAssetMemory).
+        '''
+        self.compact = compact
+        self.setAssets(self.buildAssets())
+
+    def buildAssets(self, tokenizer=None):
+        '''Returns new assets (searchAsset, conceptMap, conceptIds, compactAsset) built from the 'getRuleBasedSearchAsset' registry function.'''
+        searchAsset, _, conceptIds = getSearchAsset()
+        if self.compact:
+            return (None, self.getConceptMap(conceptIds), conceptIds, CompactSearchAsset.fromSearchAsset(searchAsset))
+        return (searchAsset, self.getConceptMap(conceptIds), conceptIds, None)
+
+    def setAssets(self, assets, generation=None):
+        '''
+        Sets the assets (searchAsset, conceptMap, conceptIds, compactAsset), right away or for the docs of a rule
+        generation (see RuleAssets).
+        '''
+        self.searchAsset, self.conceptMap, self.conceptIds, self.compactAsset = assets
+        if self.sentenceMemo is not None:
+            self.sentenceMemo.clear()
+        self.ruleAssets.set((self.searchAsset, self.conceptMap, self.compactAsset), generation)
+
+    def reload(self, background=True):
+        '''Builds new rule assets from the registry functions and swaps them in for the next documents. See reloadRules.'''
+        return self.ruleAssets.reload(background)
 
     def getConceptMap(self, conceptIds):
         if registry.has("misc", "getConceptMap"):
@@ -122,48 +442,60 @@ class MedCondDetect:
             print("\033[93m WARNING:\033[0m Running without 'getConceptMap' method provided via spaCy, MedCondDetect will provide concept id in place of concept label where applicable.")
             return {}
 
-    def __call__(self, doc: Doc) -> Doc:
-        doc.set_extension("rule_based_emr_items", default=None, force=True)
-        doc._.rule_based_emr_items = self.findConditions(doc)
-        doc.set_extension("rule_based_emr_by_sent", default=None, force=True)
-        doc._.rule_based_emr_by_sent = self._conditionSummary(doc._.rule_based_emr_items)
-        return doc
-
-    def _conditionSummary(self, sentSpans: MatchedEntitiesBySentSpan):
-
-        conditionDictionary = defaultdict(lambda: defaultdict(list))
+    def startAccounting(self) -> RuleAccounting:
         '''
-        A dictionary where key is the condition id, and value is a dictionary['name', 'tokens'], ie:
-        {320128: {
-                    'name': 'Essential hypertension', 
-                    'tokens': [
-                                {'start': 250, 'end': 262, 'tag': 'Essential hypertension', 'concept_id': 320128, 'triggers': 'Hypertension', 'sentBound': (250, 263)},
-                            ]
-                }
-        }
+        Starts counting rule evaluations, hits and time (see RuleAccounting) over the documents processed from now on.
+        Sentence memoization is bypassed while counting, so that every sentence is evaluated.
         '''
-        for sentSpan, entities in sentSpans.items():
-            sentStart, sentEnd = sentSpan
-            for entity in entities:
-                conceptId = entity['concept_id']
-                concept = entity['tag']
-                # flatten deep nested matches into flat list of dictionaries, and put sentence boundaires as an attribute onto the dictionary
-                flattened = [{**d, 'sentBound': (sentStart, sentEnd)} for d in self.flattenDictionary(entity)]
-                conditionDictionary[conceptId]["name"] = concept
-                conditionDictionary[conceptId]["tokens"].extend(flattened)
-
-        # group the dictionaries by sentence boundaries. Each sentence is represented as a dictionary with sentBound
-
-        summary = defaultdict(lambda: defaultdict(list))
-        for conceptId, conditionDict in conditionDictionary.items():
-            conceptName = conditionDict['name']
-            tokens = conditionDict['tokens']
-            sortedTokens = sorted(tokens, key=itemgetter('sentBound'))
-            for sentBound, group in groupby(sortedTokens, itemgetter('sentBound')):
-                sentDict = {'sentBound': sentBound, 'tokens': list(map(lambda i: (i['start'], i['end']), group))}
-                summary[conceptName]["concept_id"] = conceptId
-                summary[conceptName]["sentences"].append(sentDict)
-        return summary
+        self.accounting = RuleAccounting()
+        return self.accounting
+
+    def stopAccounting(self) -> Optional[RuleAccounting]:
+        accounting, self.accounting = self.accounting, None
+        return accounting
+
+    def getRules(self):
+        '''Returns (seqId, conceptId, levelCount) of every rule of the loaded assets, where levelCount is counted the same way as len(searchAsset).'''
+        if self.compactAsset is not None:
+            asset = self.compactAsset
+            return [(seqId, asset.getConceptId(i), asset.levelCount) for i, seqId in enumerate(asset.seqIds)]
+        seqIds = set(self.searchAsset[0]) | {seqId for seqs in self.searchAsset[1].values() for seqId in seqs}
+        return [(seqId, self.searchAsset[0].get(seqId), len(self.searchAsset)) for seqId in sorted(seqIds)]
+
+    def getAccountingReport(self, sortBy: str = "seconds") -> List[dict]:
+        '''Returns the rule accounting report of every rule (see RuleAccounting.getReport). Accounting must have been started.'''
+        if self.accounting is None:
+            raise ValueError("Rule accounting is not started, see MedCondDetect.startAccounting.")
+        return self.accounting.getReport(self.getRules(), sortBy)
+
+    def dumpAccountingReport(self, path, sortBy: str = "seconds"):
+        '''
+        Writes the rule accounting report to a CSV file, one row per seq_id sorted by sortBy, with the evaluations,
+        hits and seconds of every level in columns, ie. level2_evaluations, level2_hits, level2_seconds.
+        The seconds column is the sum of the seconds of levels 2 and deeper. Level 1 is not timed per rule: its phrase
+        is looked up once per sentence token for all the rules, so the time of a rule does not include it.
+        '''
+        report = self.getAccountingReport(sortBy)
+        levels = sorted({level for row in report for level in row["levels"]})
+        header = ["seq_id", "concept_id", "evaluations", "fires", "seconds"]
+        header += [f"level{level}_{field}" for level in levels for field in ("evaluations", "hits", "seconds")]
+
+        with open(path, mode='w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            for row in report:
+                values = [row["seqId"], row["conceptId"], row["evaluations"], row["fires"], row["seconds"]]
+                for level in levels:
+                    entry = row["levels"].get(level, {"evaluations": 0, "hits": 0, "seconds": 0.0})
+                    values += [entry["evaluations"], entry["hits"], entry["seconds"]]
+                writer.writerow(values)
+
+    def __call__(self, doc: Doc) -> Doc:
+        with registry.get("misc", "getStageBudget")(doc, "med_cond_detect"):
+            matches = () if registry.get("misc", "isRuleSkipped")(doc) else self.findConditions(doc)
+            self.setMatchRecords(doc, "rule_based_emr_items", "conditionItems", matches)
+            self.setMatchRecords(doc, "rule_based_emr_by_sent", "conditionSummary", matches)
+        return doc
 
     def _handleNormalizedPhrases(self, textToken):
         '''
@@ -211,7 +543,12 @@ class MedCondDetect:
         return keywordsInSentences
 
     def findConditions(self, doc: Doc):
-
+        '''
+        Returns a ConditionMatch for every condition found, by sentence, with the trigger tokens sorted by position.
+        Rules are looked up in the assets of the rule generation of the doc (see RuleAssets).
+        '''
+        generation, assets = self.ruleAssets.get(doc)
+        conceptMap = assets[1]
         keywordsInSentences = self._getKeywordBySentenceSpans(doc)
         '''
         A dictionary where key is tuple representing sentence spans, value is a list of dictionaries
@@ -241,53 +578,62 @@ class MedCondDetect:
         conceptIds = set()  # a dictionary that maps concept id to concept description
 
         for sentSpan, keywords in keywordsInSentences.items():
-            results = self.getConditionsForListOfTokens(keywords)
+            results = self._getConditionsForSentence(keywords, generation, assets)
             conceptIds |= set(map(itemgetter(0), results))
             emrCondTuplesInSentSpans[sentSpan] = results
 
-        if not emrCondTuplesInSentSpans:
-            return {}
-
-        emrConditionsBySentSpans = defaultdict(list)
+        ConditionMatch = registry.get("misc", "ConditionMatch")
+        TriggerToken = registry.get("misc", "TriggerToken")
+        matches = []
 
         for sentSpan, emrCondTuples in emrCondTuplesInSentSpans.items():
+            sentStart, sentEnd = sentSpan
 
-            for emrCondTuple in emrCondTuples:
-                conceptId, meta = emrCondTuple
-                meta.sort(key=lambda x: x['start'], reverse=False)
-                textTokens = map(lambda x: x['text'], meta)
-                textString = ', '.join(textTokens)
-
-                for i, annotation in enumerate(meta):
+            for conceptId, meta in emrCondTuples:
+                if not meta:
+                    continue
+                triggers = tuple(TriggerToken(i['start'], i['end'], i['text']) for i in sorted(meta, key=itemgetter('start')))
+                tag = self.runtimeConceptMap.get(conceptId) or conceptMap.get(conceptId) or str(conceptId)
+                matches.append(ConditionMatch(sentStart, sentEnd, conceptId, tag, triggers))
 
-                    annot = {
-                        "start": annotation['start'],
-                        "end": annotation['end'],
-                        "tag": self.runtimeConceptMap.get(conceptId) or self.conceptMap.get(conceptId) or str(conceptId),
-                        "concept_id": conceptId
-                    }
+        return tuple(matches)
 
-                    if i == 0:  # putting the 'triggers' key only on the head annotation
-                        annot['triggers'] = textString
-                        # only append head item to the output list (making it a linked list)
-                        emrConditionsBySentSpans[sentSpan].append(annot)
+    def _getConditionsForSentence(self, keywords, generation, assets):
+        '''
+        Returns getConditionsForListOfTokens(keywords, assets). If memoization is enabled, the conditions are memoized by
+        the rule generation and the lowercased keyword texts of the sentence, with the trigger tokens stored as positions
+        in the keyword list.
+        '''
+        if self.sentenceMemo is None or self.accounting is not None:
+            return self.getConditionsForListOfTokens(keywords, assets)
 
-                    if i > 0:
-                        prevAnnot['next'] = annot
+        key = (generation, tuple(keyword['text'].__str__().lower() for keyword in keywords))
+        memoized = self.sentenceMemo.get(key)
 
-                    prevAnnot = annot
+        if memoized is None:
+            results = self.getConditionsForListOfTokens(keywords, assets)
+            positions = {id(keyword): i for i, keyword in enumerate(keywords)}
+            memoized = [(conceptId, [positions[id(token)] for token in tokens]) for conceptId, tokens in results]
+            self.sentenceMemo.put(key, memoized)
+            return results
 
-        return emrConditionsBySentSpans
+        return [(conceptId, [keywords[i] for i in indices]) for conceptId, indices in memoized]
 
-    def getConditionsForListOfTokens(self, searchTokens):
+    def getConditionsForListOfTokens(self, searchTokens, assets=None):
         '''
         Params:
         - a list of search tokens, such as words from a single sentence. 
         This could be a string, or a dictionary containing the key 'text' that maps to a string.
+        - the assets (searchAsset, conceptMap, compactAsset) of a rule generation, the latest ones by default.
         Returns:
         - a list of tuples, where the first element of the tuple is an EMR concept and
         the second element is a list of tokens that triggered the condition.
         '''
+        # accounting is read once, so that stopAccounting on another thread does not change it halfway through the tokens
+        searchAsset, _, compactAsset = (self.searchAsset, self.conceptMap, self.compactAsset) if assets is None else assets
+        accounting = self.accounting
+        if compactAsset is not None:
+            return self._getConditionsFromCompactAsset(searchTokens, compactAsset, accounting)
 
         valid_seq_tuples = []
 
@@ -306,16 +652,21 @@ class MedCondDetect:
                 return
 
             # search level 1 keywords
-            if searchTerm in self.searchAsset[1]:
+            if searchTerm in searchAsset[1]:
 
-                seq_ids = self.searchAsset[1][searchTerm]
+                seq_ids = searchAsset[1][searchTerm]
 
                 # for each level 1 match of seq_id
                 for seq_id in seq_ids:
 
                     level = 2
                     matched_terms = self._recursiveLevelSearch(
-                        searchTokens, seq_id, level)
+                        searchTokens, seq_id, level, searchAsset, accounting)
+
+                    if accounting is not None:
+                        accounting.record(seq_id, 1, True)
+                        if 'FINAL_LEVEL_REACHED' in matched_terms:
+                            accounting.recordFire(seq_id)
 
                     if 'FINAL_LEVEL_REACHED' in matched_terms:
                         matched_terms.insert(0, searchToken)
@@ -327,40 +678,48 @@ class MedCondDetect:
         for seq_id_tuple in valid_seq_tuples:
 
             seq_id, tokens = seq_id_tuple
-            emr_conditions.append((self.searchAsset[0][seq_id], tokens))
+            emr_conditions.append((searchAsset[0][seq_id], tokens))
 
         return [i for n, i in enumerate(emr_conditions) if i not in emr_conditions[n + 1:]]  # remove duplicate
 
-    def _recursiveLevelSearch(self, searchTokens, seq_id, level):
+    def _recursiveLevelSearch(self, searchTokens, seq_id, level, searchAsset=None, accounting=None):
         '''
         Helper functions that recursively checks deeper levels* of a sequence_id for matching keywords.
         Params:
         - searchTokens: a list of search tokens as input.
         - seq_id: seq_id to be checked against.
         - level: the level to start checking on.
+        - searchAsset, accounting: as read by the caller, the loaded ones by default.
         Returns:
         -
         * This method is for level 2 and beyond, as searchAsset level 0 & 1 dictionaries have different data structures.
         '''
+        if searchAsset is None:
+            searchAsset, accounting = self.searchAsset, self.accounting
 
         # no more levels
-        if level >= len(self.searchAsset):
+        if level >= len(searchAsset):
             return ["FINAL_LEVEL_REACHED"]
         # there is no deeper level for the sequence id, return True
-        elif not (seq_id in self.searchAsset[level]):
+        elif not (seq_id in searchAsset[level]):
             # print("No furthur level for seq_id, returning True.")
             return ["FINAL_LEVEL_REACHED"]
         else:
-            current_level_phrases = self.searchAsset[level][seq_id]
+            current_level_phrases = searchAsset[level][seq_id]
 
-            trigger_token = self._findTriggerTokenFromLevelPhrases(
-                searchTokens, current_level_phrases)
+            if accounting is not None:
+                start = time.perf_counter()
+                trigger_token = self._findTriggerTokenFromLevelPhrases(searchTokens, current_level_phrases)
+                accounting.record(seq_id, level, trigger_token is not None, time.perf_counter() - start)
+            else:
+                trigger_token = self._findTriggerTokenFromLevelPhrases(
+                    searchTokens, current_level_phrases)
 
             if trigger_token:
                 # print(f"Going to next level, level {level + 1}")
                 return [
                     trigger_token, *self._recursiveLevelSearch(
-                        searchTokens, seq_id, level + 1)
+                        searchTokens, seq_id, level + 1, searchAsset, accounting)
                 ]
             else:
                 # print(f"Did not find matching keyword for level {level}, returning False.")
@@ -388,6 +747,65 @@ class MedCondDetect:
 
         return None
 
+    def _getConditionsFromCompactAsset(self, searchTokens, asset=None, accounting=None):
+        '''Same as getConditionsForListOfTokens, looking the search terms up in the compact asset by phrase id.'''
+        if asset is None:
+            asset, accounting = self.compactAsset, self.accounting
+        phraseIds = []
+
+        for searchToken in searchTokens:
+            if type(searchToken) == str:
+                searchTerm = searchToken.lower()
+            elif type(searchToken) == dict and 'text' in searchToken:
+                searchTerm = searchToken['text'].__str__().lower()
+            else:
+                return
+            phraseIds.append(asset.getPhraseId(searchTerm))
+
+        emr_conditions = []
+
+        for searchToken, phraseId in zip(searchTokens, phraseIds):
+            if phraseId < 0:
+                continue
+
+            for seqIndex in asset.getSeqIndices(phraseId):
+                matched_terms = self._levelSearchFromCompactAsset(searchTokens, phraseIds, seqIndex, asset, accounting)
+                if accounting is not None:
+                    accounting.record(asset.seqIds[seqIndex], 1, True)
+                    if matched_terms is not None:
+                        accounting.recordFire(asset.seqIds[seqIndex])
+                if matched_terms is not None:
+                    emr_conditions.append((asset.getConceptId(seqIndex), [searchToken, *matched_terms]))
+
+        return [i for n, i in enumerate(emr_conditions) if i not in emr_conditions[n + 1:]]  # remove duplicate
+
+    def _levelSearchFromCompactAsset(self, searchTokens, phraseIds, seqIndex, asset=None, accounting=None):
+        '''
+        Same as _recursiveLevelSearch from level 2, returns the trigger tokens of the deeper levels of a seq id, or None
+        if the final level is not reached.
+        '''
+        if asset is None:
+            asset, accounting = self.compactAsset, self.accounting
+        triggers = []
+        level = 2
+
+        while level < asset.levelCount and asset.hasLevel(level, seqIndex):
+            start = time.perf_counter() if accounting is not None else 0.0
+            levelPhraseIds = asset.getLevelPhraseIds(level, seqIndex)
+            for token, phraseId in zip(searchTokens, phraseIds):
+                if phraseId >= 0 and phraseId in levelPhraseIds:
+                    triggers.append(token)
+                    break
+            else:
+                if accounting is not None:
+                    accounting.record(asset.seqIds[seqIndex], level, False, time.perf_counter() - start)
+                return None
+            if accounting is not None:
+                accounting.record(asset.seqIds[seqIndex], level, True, time.perf_counter() - start)
+            level += 1
+
+        return triggers
+
 
 def createSearchAssetFromCSV():
     '''
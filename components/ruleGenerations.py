@@ -0,0 +1,123 @@
+from operator import itemgetter
+from spacy import registry
+from spacy.tokens import Doc
+from uuid import uuid4
+import threading
+
+
+@registry.misc("startReload")
+def startReload(reload, background=True):
+    '''Runs the reload function on a daemon thread and returns the thread, or runs it right away if background is False.'''
+    if not background:
+        reload()
+        return None
+    thread = threading.Thread(target=reload, daemon=True)
+    thread.start()
+    return thread
+
+
+@registry.misc("RuleGenerations")
+class RuleGenerations:
+    '''
+    Numbers the versions of the rule assets loaded in the process. A reload stages the new assets of every component under
+    a new generation, then publishes it. A doc takes the generation published when it reaches the first reloadable
+    component (see RuleAssets.get), and every reloadable component processes it with its assets of that generation.
+    Generations are numbered per process; runId tells apart the generations of different processes.
+    '''
+    lock = threading.Lock()
+    runId = uuid4().hex
+    latest = 0
+    published = 0
+
+    @classmethod
+    def next(cls) -> int:
+        '''Returns a new generation, to stage assets under before publishing it.'''
+        with cls.lock:
+            cls.latest += 1
+            return cls.latest
+
+    @classmethod
+    def publish(cls, generation: int):
+        '''Makes docs that have not reached a reloadable component yet take the generation.'''
+        with cls.lock:
+            cls.published = max(cls.published, generation)
+
+
+@registry.misc("RuleAssets")
+class RuleAssets:
+    '''
+    The rule assets of a reloadable component by generation (see RuleGenerations). A component sets its assets with
+    set(state), where state holds what it reads to process a doc, and processes each doc with the state returned by
+    get(doc). The component must have nlp, buildAssets(tokenizer) and setAssets(assets, generation=None).
+    The state of the generation before the latest one is kept for the docs still in flight when a reload is published.
+    A doc that has been in flight for two reloads gets the oldest state kept.
+    reloadedGeneration is the generation of the assets of the last reload, or None if the component has the assets it
+    was built or loaded with.
+    '''
+
+    def __init__(self, component):
+        self.component = component
+        self.states = []
+        '''[(generation, state) ...] in order of generation, replaced as a whole so that it is read without a lock.'''
+        self.lock = threading.Lock()
+        self.reloadedGeneration = None
+        if not Doc.has_extension("emrRuleGeneration"):
+            Doc.set_extension("emrRuleGeneration", default=None)
+
+    def set(self, state, generation=None):
+        '''
+        Stages the state under a generation, to be used once the generation is published. Without a generation, ie. when
+        the component is built or loaded, the state replaces every other one right away.
+        '''
+        with self.lock:
+            if generation is None:
+                generation = RuleGenerations.next()
+                RuleGenerations.publish(generation)
+                self.states = [(generation, state)]
+                self.reloadedGeneration = None
+            else:
+                self.states = sorted(self.states + [(generation, state)], key=itemgetter(0))[-2:]
+                self.reloadedGeneration = max(generation, self.reloadedGeneration or 0)
+
+    def get(self, doc):
+        '''Returns (generation, state): the latest state staged no later than the generation of the doc.'''
+        generation = doc._.emrRuleGeneration
+        if generation is None:
+            generation = doc._.emrRuleGeneration = RuleGenerations.published
+        states = self.states
+        for entry in reversed(states):
+            if entry[0] <= generation:
+                return entry
+        return states[0]
+
+    def reload(self, background=True):
+        '''Builds new assets from the registry functions and publishes them. See reloadRules.'''
+        return _reloadComponents(self.component.nlp, [self.component], background)
+
+
+def _reloadComponents(nlp, components, background=True):
+    tokenizer = registry.get("misc", "makeBuildTokenizer")(nlp)
+
+    def _reload():
+        built = [(component, component.buildAssets(tokenizer)) for component in components]
+        generation = RuleGenerations.next()
+        for component, assets in built:
+            component.setAssets(assets, generation)
+        RuleGenerations.publish(generation)
+
+    return startReload(_reload, background)
+
+
+def reloadRules(nlp, names=None, background=True):
+    '''
+    Rebuilds the rule assets (ie. from phrase_to_condition.csv, demographs.csv and sections.csv) of every reloadable
+    component of the pipeline, or of the named components only, without reloading the pipeline.
+    All assets are built first, then staged together under a new generation, which is published once every component
+    has staged its assets (see RuleGenerations). A doc is processed with the assets of a single generation by every
+    component, so a doc already in flight keeps the previous assets in the components it has not reached yet.
+    If a build fails, nothing is staged and the pipeline keeps running with the current assets.
+    Returns the background thread, which can be joined to wait for the new assets to be published.
+    '''
+    components = [component for name, component in nlp.pipeline
+                  if hasattr(component, "ruleAssets") and (names is None or name in names)]
+    return _reloadComponents(nlp, components, background)
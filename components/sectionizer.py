@@ -8,18 +8,26 @@ from pathlib import Path
 import pickle
 
 try:
-    @Language.factory("emr_sectionizer")
+    @Language.factory("emr_sectionizer", assigns=["doc._.emrSections", "doc._.emrScope"])
     def createEmrSectionizer(nlp: Language, name: str):
         return EmrSectionizer(nlp)
 except:
     pass
 
 
+DocumentSection = namedtuple("DocumentSection", ['start', 'end', 'type'])
+
+
 class EmrSectionizer:
 
     def __init__(self, nlp: Language):
-        self.headerMaps = {}
-        self.sectionHeaderRegex = []
+        self.nlp = nlp
+        self.ruleAssets = registry.get("misc", "RuleAssets")(self)
+        self.setAssets(({}, []))
+        if not Doc.has_extension("emrSections"):
+            Doc.set_extension("emrSections", default=None)
+        if not Doc.has_extension("emrScope"):
+            Doc.set_extension("emrScope", default=None)
 
     def to_disk(self, path: Path, exclude=tuple()):
         dataPath = path.parent/"emrsectionizer.bin"
@@ -31,11 +39,24 @@ class EmrSectionizer:
         dataPath = path.parent/"emrsectionizer.bin"
         with open(dataPath, 'rb') as f:
             assets = pickle.load(f)
-            self.headerMaps, self.sectionHeaderRegex = assets
+        self.setAssets(assets)
 
     def build(self):
-        self.headerMaps = self.getSectionHeaders()
-        self._buildRegexPatterns
+        self.setAssets(self.buildAssets())
+
+    def buildAssets(self, tokenizer=None):
+        '''Returns new assets (headerMaps, sectionHeaderRegex) built from the 'getSectionHeaders' registry function.'''
+        headerMaps = self.getSectionHeaders()
+        return (headerMaps, self._makeRegexPatterns(headerMaps))
+
+    def setAssets(self, assets, generation=None):
+        '''Sets the assets, right away or for the docs of a rule generation (see RuleAssets).'''
+        self.headerMaps, self.sectionHeaderRegex = assets
+        self.ruleAssets.set(assets, generation)
+
+    def reload(self, background=True):
+        '''Builds new rule assets from the registry functions and swaps them in for the next documents. See reloadRules.'''
+        return self.ruleAssets.reload(background)
 
     def getSectionHeaders(self):
         if registry.has("misc", "getSectionHeaders"):
@@ -45,30 +66,34 @@ class EmrSectionizer:
             return {}
 
     def _buildRegexPatterns(self):
-        self.sectionHeaderRegex = []
-        for sectionHeader in self.headerMaps:
+        self.sectionHeaderRegex = self._makeRegexPatterns(self.headerMaps)
+
+    def _makeRegexPatterns(self, headerMaps):
+        sectionHeaderRegex = []
+        for sectionHeader in headerMaps:
             expressions = self._makeRegularExpression(sectionHeader)
-            self.sectionHeaderRegex += expressions
+            sectionHeaderRegex += expressions
+        return sectionHeaderRegex
 
     def _makeRegularExpression(self, sectionHeader):
         return [
             '(\n|^)(?P<section>' + sectionHeader + ')(:|\n)\s*'
         ]
 
-    def _findSectionHeaders(self, doc):
+    def _findSectionHeaders(self, docText, sectionHeaderRegex=None):
         '''Returns a list of tuples representing section headings (start, end, text).'''
         sectionHeadings = []
 
         Header = namedtuple('SectionHeader', ['start', 'end', 'text'])
 
-        for expression in self.sectionHeaderRegex:
-            for match in re.finditer(expression, doc.text, re.IGNORECASE):
+        for expression in self.sectionHeaderRegex if sectionHeaderRegex is None else sectionHeaderRegex:
+            for match in re.finditer(expression, docText, re.IGNORECASE):
                 start, end = match.span('section')
-                text = doc.text[start:end]
+                text = docText[start:end]
                 sectionHeadings.append(Header(start=start, end=end, text=text))
-        return self._cleanOverlapSpans(sectionHeadings, doc, updateText=False)
+        return self._cleanOverlapSpans(sectionHeadings, docText, updateText=False)
 
-    def _cleanOverlapSpans(self, spanTuples, doc, updateText=True):
+    def _cleanOverlapSpans(self, spanTuples, docText, updateText=True):
         '''
         Given a list of tuples representing spans (start, end, text), check for overlap, returns cleaned list.
         This method will keep the longer span if two spans overlap.
@@ -100,7 +125,7 @@ class EmrSectionizer:
             elif start < lastSpanEnd and end > lastSpanEnd:  # partial overlap
                 lastSpan = output.pop()
                 if updateText:
-                    newText = doc.text[start, lastSpanEnd]
+                    newText = docText[start:lastSpanEnd]
                 else:
                     newText = _getLongestSpanText([(start, end, text), lastSpan])
                 combinedSpan = TextSpan(start=start, end=lastSpanEnd, text=newText)
@@ -119,33 +144,73 @@ class EmrSectionizer:
 
         return output
 
-    def _makeSectionsFromHeaders(self, doc, headers):
+    def _makeSectionsFromHeaders(self, docText, headers, headerMaps=None):
         sections = []
-        Section = namedtuple("DocumentSection", ['start', 'end', 'type'])
+        if headerMaps is None:
+            headerMaps = self.headerMaps
 
         for i, header in enumerate(headers):
             nextHeader = headers[i+1] if i + 1 < len(headers) else None
 
             if i == 0 and header.start > 0:
-                sections.append(Section(start=0, end=header.start, type=None))
+                sections.append(DocumentSection(start=0, end=header.start, type=None))
 
             if nextHeader:
-                sections.append(Section(start=header.start, end=nextHeader.start,
-                                        type=self.headerMaps.get(header.text.lower())))
+                sections.append(DocumentSection(start=header.start, end=nextHeader.start,
+                                                type=headerMaps.get(header.text.lower())))
             else:  # reached last header, before the end of the document
-                sections.append(Section(start=header.start, end=len(doc.text),
-                                        type=self.headerMaps.get(header.text.lower())))
+                sections.append(DocumentSection(start=header.start, end=len(docText),
+                                                type=headerMaps.get(header.text.lower())))
 
         return sections
 
-    def _emrSectionsGetter(self, doc):
-        '''Returns a list of namedtuples (start, end, type) representing document sections.'''
-        headers = self._findSectionHeaders(doc)
-        sections = self._makeSectionsFromHeaders(doc, headers)
+    def getSections(self, text: str, assets=None):
+        '''
+        Returns a list of namedtuples (start, end, type) representing the sections of a text, found with the given
+        assets (headerMaps, sectionHeaderRegex), or with the latest ones.
+        '''
+        headerMaps, sectionHeaderRegex = (self.headerMaps, self.sectionHeaderRegex) if assets is None else assets
+        headers = self._findSectionHeaders(text, sectionHeaderRegex)
+        sections = self._makeSectionsFromHeaders(text, headers, headerMaps)
         return sections
 
-    def __call__(self, doc: Doc) -> Doc:
-        doc.set_extension("emrSections", getter=self._emrSectionsGetter, force=True)
+    def getScope(self, doc: Doc, sections, sectionsIgnored=None, sectionsAllowed=None):
+        '''
+        Returns the token spans (start, end) of the runs of consecutive sentences that are in an allowed section
+        (if sectionsAllowed is given) and not in an ignored section (if sectionsIgnored is given).
+        As in PostProcessor, a sentence belongs to the first section it overlaps. A sentence before the first header
+        belongs to a section of type None.
+        '''
+        scope = []
+        for sent in doc.sents:
+            section = next((i for i in sections if i.start < sent.end_char and i.end > sent.start_char), None)
+            sectionType = section.type if section else None
+
+            if sectionsIgnored is not None and sectionType in sectionsIgnored:
+                continue
+            if sectionsAllowed is not None and sectionType not in sectionsAllowed:
+                continue
+
+            if scope and scope[-1][1] == sent.start:
+                scope[-1] = (scope[-1][0], sent.end)
+            else:
+                scope.append((sent.start, sent.end))
+        return scope
+
+    def __call__(self, doc: Doc, sectionsIgnored=None, sectionsAllowed=None) -> Doc:
+        '''
+        Sets doc._.emrSections, found with the assets of the rule generation of the doc (see RuleAssets).
+        If sectionsIgnored or sectionsAllowed (lists of section types) are passed for the call,
+        ie. nlp(text, component_cfg={"emr_sectionizer": {"sectionsAllowed": ["assessment", "plan"]}}), also sets
+        doc._.emrScope to the sentences that EmrPhraseMatcher, SpellNormalizer and NegationMatcher process (see getScope),
+        so that the sentences of the other sections are skipped instead of being filtered out after matching.
+        '''
+        with registry.get("misc", "getStageBudget")(doc, "emr_sectionizer"):
+            _, assets = self.ruleAssets.get(doc)
+            doc._.emrSections = self.getSections(doc.text, assets)
+
+            if sectionsIgnored is not None or sectionsAllowed is not None:
+                doc._.emrScope = self.getScope(doc, doc._.emrSections, sectionsIgnored, sectionsAllowed)
 
         return doc
 
@@ -1,8 +1,9 @@
 from spacy.language import Language
 from spacy.tokens import Doc
+from spacy import registry
 
 try:
-    @Language.factory("custom_sentencizer")
+    @Language.factory("custom_sentencizer", assigns=["token.is_sent_start"])
     def createCustomSentencizer(nlp: Language, name: str):
         return CustomSentencizer(nlp)
 except:
@@ -14,13 +15,14 @@ class CustomSentencizer:
         self.delimiters = ['\n\n', '\n\n\n', '.', ':', '!', ';']
 
     def __call__(self, doc: Doc) -> Doc:
-        # Explicit rules
-        for token in doc:
-            if token.i + 1 < len(doc):
-                if token.text in self.delimiters:
-                    self._set_start(doc[token.i+1], True)
-                else:
-                    self._set_start(doc[token.i+1], False)
+        with registry.get("misc", "getStageBudget")(doc, "custom_sentencizer"):
+            # Explicit rules
+            for token in doc:
+                if token.i + 1 < len(doc):
+                    if token.text in self.delimiters:
+                        self._set_start(doc[token.i+1], True)
+                    else:
+                        self._set_start(doc[token.i+1], False)
 
         return doc
 
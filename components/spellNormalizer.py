@@ -0,0 +1,198 @@
+from typing import Dict, List, Tuple
+from spacy.language import Language
+from spacy.tokens import Doc
+from spacy import registry
+import pickle
+
+try:
+    @Language.factory("emr_spell_normalizer", default_config={"memoSize": 10000, "minLength": 5},
+                      requires=["doc._.emrPhrases"],
+                      assigns=["doc._.emrPhrases"])
+    def createSpellNormalizer(nlp: Language, name: str, memoSize: int, minLength: int):
+        return SpellNormalizer(nlp, memoSize, minLength)
+except:
+    pass
+
+
+def getDeletes(word: str, maxEditDistance: int) -> set:
+    '''Returns the word and every string made by deleting up to maxEditDistance characters from it.'''
+    deletes = {word}
+    frontier = {word}
+    for _ in range(maxEditDistance):
+        frontier = {i[:n] + i[n + 1:] for i in frontier for n in range(len(i))}
+        deletes |= frontier
+    return deletes
+
+
+def getEditDistance(source: str, target: str, maxEditDistance: int) -> int:
+    '''
+    Returns the optimal string alignment distance (Levenshtein distance counting a transposition of two adjacent
+    characters as one edit) between two strings, or maxEditDistance + 1 if it is greater than maxEditDistance.
+    '''
+    if abs(len(source) - len(target)) > maxEditDistance:
+        return maxEditDistance + 1
+
+    previousRow = None
+    row = list(range(len(target) + 1))
+    for i in range(1, len(source) + 1):
+        previousRow, row = row, [i] + [0] * len(target)
+        for j in range(1, len(target) + 1):
+            cost = 0 if source[i - 1] == target[j - 1] else 1
+            row[j] = min(row[j - 1] + 1, previousRow[j] + 1, previousRow[j - 1] + cost)
+            if i > 1 and j > 1 and source[i - 1] == target[j - 2] and source[i - 2] == target[j - 1]:
+                row[j] = min(row[j], twoRowsBack[j - 2] + 1)
+        twoRowsBack = previousRow
+        if min(row) > maxEditDistance:
+            return maxEditDistance + 1
+
+    return row[-1] if row[-1] <= maxEditDistance else maxEditDistance + 1
+
+
+class SpellNormalizer:
+    '''
+    Corrects misspelled tokens (ie. "hypetension") against the single-word phrases of the rule table, and adds each
+    corrected token to doc._.emrPhrases with the corrections under 'normalizedTo', where MedCondDetect picks them up as
+    keywords (see MedCondDetect._handleNormalizedPhrases).
+
+    Corrections are looked up in a SymSpell deletion index built with the rules: every rule word is indexed under all
+    the strings made by deleting up to maxEditDistance characters from it. A token only needs its own deletes to be
+    looked up, so the cost of a correction does not depend on the size of the rule vocabulary. Candidates are then
+    checked with the actual edit distance, and the closest ones are kept.
+
+    Only alphabetic tokens of at least minLength characters that are not words of any rule phrase, and not already part
+    of a matched phrase, are corrected. Tokens shorter than longWordLength are corrected within one edit only.
+    Corrections are memoized by rule generation and token text.
+    '''
+
+    def __init__(self, nlp: Language, memoSize: int = 10000, minLength: int = 5):
+        self.nlp = nlp
+        self.minLength = minLength
+        self.maxEditDistance = 2
+        self.longWordLength = 8
+        self.corrections = registry.get("misc", "LruCache")(memoSize) if memoSize > 0 else None
+        self.ruleAssets = registry.get("misc", "RuleAssets")(self)
+        self.setAssets(([], set(), {}, self.maxEditDistance, self.longWordLength))
+
+    def to_disk(self, path, exclude=tuple()):
+        dataPath = path.parent/"spellnormalizer.bin"
+        assets = (self.words, self.knownWords, self.deletes, self.maxEditDistance, self.longWordLength)
+        with open(dataPath, 'wb') as f:
+            pickle.dump(assets, f)
+
+    def from_disk(self, path, exclude=tuple()):
+        dataPath = path.parent/"spellnormalizer.bin"
+        with open(dataPath, 'rb') as f:
+            assets = pickle.load(f)
+        self.setAssets(assets)
+
+    def build(self, maxEditDistance=2, longWordLength=8):
+        self.maxEditDistance = maxEditDistance
+        self.longWordLength = longWordLength
+        self.setAssets(self.buildAssets())
+
+    def buildAssets(self, tokenizer=None):
+        '''
+        Returns new assets (words, knownWords, deletes, maxEditDistance, longWordLength) built from the phrases of the
+        'getRuleBasedSearchAsset' and 'getDemographRules' registry functions.
+        '''
+        phrases = self._getRulePhrases()
+        knownWords = {word for phrase in phrases for word in phrase.split()}
+        words = sorted({phrase for phrase in phrases if phrase.isalpha()})
+        deletes = {}
+
+        for wordId, word in enumerate(words):
+            for delete in getDeletes(word, self.maxEditDistance):
+                deletes.setdefault(delete, []).append(wordId)
+
+        deletes = {delete: tuple(wordIds) for delete, wordIds in deletes.items()}
+        return (words, knownWords, deletes, self.maxEditDistance, self.longWordLength)
+
+    def _getRulePhrases(self) -> List[str]:
+        phrases = []
+        if registry.has("misc", "getRuleBasedSearchAsset"):
+            _, terms, _ = registry.get("misc", "getRuleBasedSearchAsset")()
+            phrases.extend(terms)
+        else:
+            print("\033[91m WARNING:\033[0m Building without 'getRuleBasedSearchAsset' method provided via spaCy registry will result in non-function of SpellNormalizer component.")
+        if registry.has("misc", "getDemographRules"):
+            phrases.extend(phrase for rule in registry.get("misc", "getDemographRules")() for phrase in rule['phrases'])
+        return [phrase.lower().strip() for phrase in phrases]
+
+    def setAssets(self, assets, generation=None):
+        '''
+        Sets the assets (words, knownWords, deletes, maxEditDistance, longWordLength), right away or for the docs of a
+        rule generation (see RuleAssets).
+        '''
+        self.words, self.knownWords, self.deletes, self.maxEditDistance, self.longWordLength = assets
+        if self.corrections is not None:
+            self.corrections.clear()
+        self.ruleAssets.set(tuple(assets), generation)
+
+    def reload(self, background=True):
+        '''Builds new rule assets from the registry functions and swaps them in for the next documents. See reloadRules.'''
+        return self.ruleAssets.reload(background)
+
+    def __call__(self, doc: Doc) -> Doc:
+        if not registry.get("misc", "isRuleSkipped")(doc):
+            with registry.get("misc", "getStageBudget")(doc, "emr_spell_normalizer"):
+                doc._.emrPhrases = self.normalizePhrases(doc, doc._.emrPhrases)
+        return doc
+
+    def normalizePhrases(self, doc: Doc, emrPhrases: Dict[Tuple[int, int], dict]) -> Dict[Tuple[int, int], dict]:
+        '''Returns the EMR phrases with an entry added for every corrected token, ie. {(2, 13): {"text": "hypetension", "type": "normalized_phrase", "normalizedTo": ["hypertension"]}}'''
+        generation, assets = self.ruleAssets.get(doc)
+        if not assets[2]:
+            return emrPhrases
+
+        covered = set()
+        for start, end in emrPhrases:
+            covered.update(range(start, end))
+
+        normalized = {}
+        for token in (token for part in registry.get("misc", "getScopedSpans")(doc) for token in part):
+            if len(token) < self.minLength or not token.is_alpha or token.idx in covered:
+                continue
+            corrections = self.getCorrections(token.lower_, generation, assets)
+            if corrections:
+                normalized[(token.idx, token.idx + len(token))] = {"text": token.text, "type": "normalized_phrase", "normalizedTo": corrections}
+
+        if not normalized:
+            return emrPhrases
+        return dict(sorted({**emrPhrases, **normalized}.items()))
+
+    def getCorrections(self, term: str, generation=None, assets=None) -> List[str]:
+        '''
+        Returns the rule words closest to a lowercased term, or an empty list if the term is a rule word or no rule word is
+        close enough. The words are looked up in the assets of a rule generation, the latest ones by default.
+        '''
+        if assets is None:
+            generation, assets = self.ruleAssets.states[-1]
+        if term in assets[1]:
+            return []
+        if self.corrections is None:
+            return self._lookup(term, assets)
+
+        corrections = self.corrections.get((generation, term))
+        if corrections is None:
+            corrections = self._lookup(term, assets)
+            self.corrections.put((generation, term), corrections)
+        return corrections
+
+    def _lookup(self, term: str, assets) -> List[str]:
+        words, _, deletes, maxEditDistance, longWordLength = assets
+        maxEditDistance = maxEditDistance if len(term) >= longWordLength else min(1, maxEditDistance)
+        candidates = set()
+        for delete in getDeletes(term, maxEditDistance):
+            candidates.update(deletes.get(delete, ()))
+
+        closest = []
+        bestDistance = maxEditDistance + 1
+        for wordId in candidates:
+            word = words[wordId]
+            distance = getEditDistance(term, word, maxEditDistance)
+            if distance < bestDistance:
+                closest, bestDistance = [word], distance
+            elif distance == bestDistance and distance <= maxEditDistance:
+                closest.append(word)
+
+        return sorted(closest)
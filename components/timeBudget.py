@@ -0,0 +1,105 @@
+from typing import Dict, Optional
+from spacy.language import Language
+from spacy.tokens import Doc
+from spacy import registry
+import time
+
+try:
+    @Language.factory("emr_time_budget", default_config={"budgetMs": 0, "shares": {"negation_matcher": 0.5, "post_process": 0.25}},
+                      assigns=["doc._.emrTimeBudget", "doc._.emr_degraded"])
+    def createTimeBudget(nlp: Language, name: str, budgetMs: int, shares: Dict[str, float]):
+        return TimeBudget(nlp, budgetMs, shares)
+except:
+    pass
+
+
+class TimeBudget:
+    '''
+    Gives every document a time budget, to be placed first. The budget is spent by the time the stages of this package
+    take on the document itself (see StageBudget), not by wall-clock time, so that a document does not pay for the other
+    documents of its nlp.pipe batch, ie. while a batching stage such as the en_core_web_sm tagger processes the batch
+    before the next stages process its documents one at a time. The time of stages of other packages is not counted.
+    Stages that have a cheaper path check their StageBudget (see getStageBudget) as they go; a stage may spend its share
+    of budgetMs, and never more than what the earlier stages left of the budget. A stage that runs out of time finishes
+    the document on its cheaper path and is listed in doc._.emr_degraded:
+    - negation_matcher: negation scopes are no longer narrowed at closures (ie. "but", ",")
+    - post_process: matches with nested triggers are no longer filtered
+    Stages without a share may spend what is left of the budget. With budgetMs of 0, documents have no time budget and
+    doc._.emr_degraded is an empty list.
+
+    The budget can be set per call, ie. nlp(text, component_cfg={"emr_time_budget": {"budgetMs": 200}}).
+    '''
+
+    def __init__(self, nlp: Language, budgetMs: int = 0, shares: Optional[Dict[str, float]] = None):
+        self.budgetMs = budgetMs
+        self.shares = dict(shares or {})
+        if not Doc.has_extension("emrTimeBudget"):
+            Doc.set_extension("emrTimeBudget", default=None)
+        if not Doc.has_extension("emr_degraded"):
+            Doc.set_extension("emr_degraded", default=None)
+
+    def __call__(self, doc: Doc, budgetMs: Optional[int] = None) -> Doc:
+        budgetMs = self.budgetMs if budgetMs is None else budgetMs
+        seconds = budgetMs / 1000
+
+        if seconds > 0:
+            doc._.emrTimeBudget = {"seconds": seconds, "spent": 0.0, "shares": self.shares}
+        else:
+            doc._.emrTimeBudget = None
+        doc._.emr_degraded = []
+        return doc
+
+
+@registry.misc("StageBudget")
+class StageBudget:
+    '''
+    The time a pipeline stage has left for a doc (see TimeBudget), counted from when the stage starts on the doc.
+    exceeded() turns True once the stage has run for longer than seconds, and stays True, so a stage can check it in its
+    loops and switch to a cheaper path. Used as a context manager around the work of the stage on the doc, it adds the
+    time of the stage to the time spent by the doc (timeBudget, the doc._.emrTimeBudget). Without seconds it is never
+    exceeded.
+    '''
+    __slots__ = ("timeBudget", "seconds", "start", "isExceeded")
+
+    def __init__(self, timeBudget=None, seconds=None):
+        self.timeBudget = timeBudget
+        self.seconds = seconds
+        self.start = time.perf_counter()
+        self.isExceeded = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if self.timeBudget is not None:
+            self.timeBudget["spent"] += time.perf_counter() - self.start
+
+    def exceeded(self) -> bool:
+        if not self.isExceeded and self.seconds is not None and time.perf_counter() - self.start > self.seconds:
+            self.isExceeded = True
+        return self.isExceeded
+
+
+@registry.misc("getStageBudget")
+def getStageBudget(doc, stage):
+    '''
+    Returns the StageBudget of a stage (a factory name, ie. "negation_matcher") starting on a doc: its share of the doc
+    time budget, and never more than the time the stages before it left of the budget. The budget has no limit if the
+    doc has no time budget.
+    '''
+    budget = doc._.emrTimeBudget if doc.has_extension("emrTimeBudget") else None
+    if budget is None:
+        return StageBudget()
+    seconds = budget["seconds"] - budget["spent"]
+    share = budget["shares"].get(stage)
+    if share is not None:
+        seconds = min(seconds, share * budget["seconds"])
+    return StageBudget(budget, seconds)
+
+
+@registry.misc("markDegraded")
+def markDegraded(doc, stage):
+    '''Records in doc._.emr_degraded (registered by TimeBudget) that a stage took its cheaper path for the doc.'''
+    degraded = doc._.emr_degraded or []
+    if stage not in degraded:
+        doc._.emr_degraded = degraded + [stage]
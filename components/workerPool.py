@@ -0,0 +1,559 @@
+from typing import Iterable, List, Optional
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
+from pathlib import Path
+from spacy import registry
+from spacy.language import Language
+import gc
+import multiprocessing
+import os
+import queue
+import random
+import threading
+import time
+import traceback
+
+
+def getProcessMemory(pid: int) -> Optional[dict]:
+    '''
+    Returns the memory of a process in bytes from /proc/<pid>/smaps_rollup (or /proc/<pid>/smaps on older kernels):
+    - rss: resident memory
+    - pss: resident memory, with every shared page divided among the processes sharing it
+    - uss: memory private to the process, which is freed when the process exits
+    - shared: resident memory shared with other processes
+    Returns None where /proc is not available.
+    '''
+    fields = {"Rss": 0, "Pss": 0, "Private_Clean": 0, "Private_Dirty": 0, "Shared_Clean": 0, "Shared_Dirty": 0}
+    procPath = Path(f"/proc/{pid}")
+    smapsPath = procPath/"smaps_rollup" if (procPath/"smaps_rollup").exists() else procPath/"smaps"
+
+    try:
+        with open(smapsPath, mode='r') as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in fields:
+                    fields[key] += int(value.split()[0]) * 1024
+    except OSError:
+        return None
+
+    return {
+        "rss": fields["Rss"],
+        "pss": fields["Pss"],
+        "uss": fields["Private_Clean"] + fields["Private_Dirty"],
+        "shared": fields["Shared_Clean"] + fields["Shared_Dirty"],
+    }
+
+
+CHARS_PER_TOKEN = 4
+'''Rough number of characters per token, used to estimate the tokens of a text from its length.'''
+
+
+def makeLengthBatches(texts: List[str], tokenBudget: int, maxBatchSize: int) -> List[List[int]]:
+    '''
+    Returns batches of indices of texts, longest texts first. Texts are sorted by length and cut into batches of at most
+    maxBatchSize texts and tokenBudget estimated tokens, so each batch holds texts of similar lengths and takes about
+    the same time. A text longer than the budget makes a batch of its own.
+    '''
+    batches = []
+    batch = []
+    tokens = 0
+    for i in sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True):
+        estimate = len(texts[i]) // CHARS_PER_TOKEN + 1
+        if batch and (tokens + estimate > tokenBudget or len(batch) >= maxBatchSize):
+            batches.append(batch)
+            batch = []
+            tokens = 0
+        batch.append(i)
+        tokens += estimate
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _getWorkerStats(nlp: Language, baseline: dict, texts: int, batches: int) -> dict:
+    '''
+    Returns the growth of a worker since it was forked: the strings added to the vocab, and its unique memory, along with
+    both per text processed. Unique memory is measured from the end of the first batch, once lazily made state is in place.
+    '''
+    memory = getProcessMemory(os.getpid())
+    uss = memory["uss"] if memory else 0
+    if "uss" not in baseline:
+        baseline.update(uss=uss, texts=texts)
+    measuredTexts = texts - baseline["texts"]
+    newStrings = len(nlp.vocab.strings) - baseline["strings"]
+    return {
+        "pid": os.getpid(),
+        "texts": texts,
+        "batches": batches,
+        "newStrings": newStrings,
+        "stringsPerText": newStrings / texts if texts else 0.0,
+        "uss": uss,
+        "ussGrowthPerText": (uss - baseline["uss"]) / measuredTexts if measuredTexts else 0.0,
+        "seconds": time.monotonic() - baseline["time"],
+    }
+
+
+def _runWorker(nlp: Language, tasks, results, retire, maxNewStrings: Optional[int] = None, maxBatches: Optional[int] = None):
+    '''
+    Worker process loop: processes batches of texts until it receives None, and sends back the getDocResults of every doc
+    along with the worker stats (see _getWorkerStats).
+    The worker retires, sending (None, None, None, stats), once it has added more than maxNewStrings strings to the
+    vocab, processed maxBatches batches, or once its retire event is set (see PreforkPool.recycle). The event is checked
+    between batches, and every second while the worker waits for one.
+    '''
+    getDocResults = registry.get("misc", "getDocResults")
+    baseline = {"strings": len(nlp.vocab.strings), "time": time.monotonic()}
+    texts = 0
+    batches = 0
+    stats = None
+    while not retire.is_set():
+        try:
+            task = tasks.get(timeout=1.0)
+        except queue.Empty:
+            continue
+        if task is None:
+            return
+        batchId, batchTexts, kwargs = task
+        try:
+            payload = [getDocResults(doc) for doc in nlp.pipe(batchTexts, **kwargs)]
+            error = None
+        except Exception:
+            payload, error = None, traceback.format_exc()
+        texts += len(batchTexts)
+        batches += 1
+        stats = _getWorkerStats(nlp, baseline, texts, batches)
+        results.put((batchId, payload, error, stats))
+        if (maxNewStrings is not None and stats["newStrings"] > maxNewStrings) or (maxBatches is not None and batches >= maxBatches):
+            break
+    results.put((None, None, None, stats or _getWorkerStats(nlp, baseline, texts, batches)))
+
+
+class PreforkPool:
+    '''
+    Pool of worker processes forked from a parent process that has loaded the pipeline, so that the workers share the
+    memory pages of the vocab, the matchers, the rule assets and the XGB models instead of loading copies of their own.
+    Before forking, the garbage collector is run and frozen (gc.freeze), so that collections in the workers do not write
+    to the pages of the objects loaded by the parent, which would make private copies of them.
+    Pages that a worker writes to (ie. strings added to the vocab by new texts) become private to that worker;
+    report() returns the unique and shared memory of every worker to check how much is still shared.
+
+    Workers return the results of getDocResults, in input order. Usage:
+        nlp = spacy.load("en_emr_pipeline_nlp")
+        with PreforkPool(nlp, workers=8) as pool:
+            for results in pool.pipe(texts):
+                ...
+            print(pool.report())
+
+    For corpora of notes of very different lengths, pool.pipe(texts, tokenBudget=20000) batches texts of similar
+    lengths by estimated tokens instead of by count (see makeLengthBatches).
+
+    Every new token is interned into the vocab of the worker that processes it, and spaCy cannot drop strings from a
+    loaded vocab, as its lexemes keep referring to them. Workers are recycled instead: a worker that has added more than
+    maxNewStrings strings, or processed maxBatchesPerWorker batches, exits once its batch is done, and a fresh worker is
+    forked from the parent. A fresh worker holds the strings of the parent vocab: those of the loaded pipeline and the
+    warmup texts, and of any text the application processes with nlp in the parent. The pool itself tokenizes the docs
+    of pipe(asDocs=True) with a copy of the tokenizer that has a vocab of its own, so they do not add to it.
+    Workers are forked on a thread of the pool that does nothing else, so that a fork never copies a lock held by the
+    forking thread, ie. the lock of the threads waiting for results. recycle() retires every worker on demand, and
+    report()["growth"] returns the growth of the vocab and memory of the workers per text.
+    The pool also serves single notes from several threads, ie. pool(text) returns the results of one note.
+    Only available on platforms that support forking (Linux, macOS).
+    '''
+
+    def __init__(self, nlp: Language, workers: Optional[int] = None, batchSize: int = 32, warmupTexts: Iterable[str] = ("Patient is a 80-year-old retired firefighter.",),
+                 maxNewStrings: Optional[int] = None, maxBatchesPerWorker: Optional[int] = None):
+        self.nlp = nlp
+        self.workers = workers or os.cpu_count() or 1
+        self.batchSize = batchSize
+        self.warmupTexts = list(warmupTexts)
+        self.maxNewStrings = maxNewStrings
+        self.maxBatchesPerWorker = maxBatchesPerWorker
+        self.context = None
+        self.processes = []
+        self.retireEvents = {}
+        self.retiredPids = set()
+        self.processLock = threading.Lock()
+        self.forkRequests = queue.Queue()
+        self.forkThread = None
+        self.tokenizer = None
+        self.tokenizerStrings = 0
+        self.workerStats = {}
+        self.retired = []
+        self.tasks = None
+        self.results = None
+        self.finished = {}
+        self.receiving = False
+        self.condition = threading.Condition()
+        self.batchIds = iter(range(1 << 62))
+        self.batchIdLock = threading.Lock()
+        self.startLock = threading.Lock()
+
+    def start(self):
+        '''Forks the workers. Texts in warmupTexts are processed first so that lazily created state is made before forking.'''
+        with self.startLock:
+            if self.forkThread is None:
+                self._start()
+        return self
+
+    def _start(self):
+        self.context = multiprocessing.get_context("fork")
+        if self.warmupTexts:
+            list(self.nlp.pipe(self.warmupTexts))
+        registry.get("misc", "ensureResultExtensions")()
+
+        self.tasks = self.context.Queue()
+        self.results = self.context.Queue()
+
+        gc.collect()
+        gc.freeze()
+
+        self.forkThread = threading.Thread(target=self._forkWorkers, name="emr-pipeline-fork", daemon=True)
+        self.forkThread.start()
+        for _ in range(self.workers):
+            self.forkRequests.put(True)
+
+    def _forkWorkers(self):
+        '''Fork thread loop: forks a worker for every request, until it receives None.'''
+        for _ in iter(self.forkRequests.get, None):
+            retire = self.context.Event()
+            process = self.context.Process(target=_runWorker, args=(self.nlp, self.tasks, self.results, retire, self.maxNewStrings, self.maxBatchesPerWorker), daemon=True)
+            process.start()
+            with self.processLock:
+                # a worker may retire before it is listed, in which case it is joined here instead
+                retired = process.pid in self.retiredPids
+                self.retiredPids.discard(process.pid)
+                if not retired:
+                    self.processes.append(process)
+                    self.retireEvents[process.pid] = retire
+            if retired:
+                process.join()
+
+    def _replaceWorker(self, stats: dict):
+        '''Joins a retired worker, keeps its final stats, and has the fork thread fork a fresh worker in its place.'''
+        with self.processLock:
+            retiredProcesses = [process for process in self.processes if process.pid == stats["pid"]]
+            for process in retiredProcesses:
+                self.processes.remove(process)
+                self.retireEvents.pop(process.pid, None)
+            if not retiredProcesses:
+                self.retiredPids.add(stats["pid"])
+        for process in retiredProcesses:
+            process.join()
+        self.workerStats.pop(stats["pid"], None)
+        self.retired.append(stats)
+        self.forkRequests.put(True)
+
+    def recycle(self):
+        '''
+        Asks every running worker to exit once it is done with its current batch, to be replaced by a fresh fork.
+        Workers forked after the call are not retired.
+        '''
+        with self.processLock:
+            for retire in self.retireEvents.values():
+                retire.set()
+
+    def close(self):
+        '''Stops the workers once they are done with the submitted batches.'''
+        with self.startLock:
+            if self.forkThread is not None:
+                self._close()
+
+    def _close(self):
+        self.forkRequests.put(None)
+        self.forkThread.join()
+        self.forkThread = None
+        with self.processLock:
+            processes, self.processes, self.retireEvents = self.processes, [], {}
+        for _ in processes:
+            self.tasks.put(None)
+        for process in processes:
+            process.join()
+        self.tasks.close()
+        self.results.close()
+        gc.unfreeze()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, texts: List[str], **kwargs) -> int:
+        '''Sends a batch of texts to the workers, returns the batch id to pass to wait(). Keyword arguments are passed on to nlp.pipe.'''
+        if self.forkThread is None:
+            self.start()
+        with self.batchIdLock:
+            batchId = next(self.batchIds)
+        self.tasks.put((batchId, list(texts), kwargs))
+        return batchId
+
+    def wait(self, batchId: int) -> List[dict]:
+        '''
+        Returns the results of a submitted batch, blocking until a worker is done with it.
+        Several threads can wait at the same time: one thread at a time reads the result queue and hands the results of
+        other batches over to the threads waiting for them.
+        '''
+        with self.condition:
+            while batchId not in self.finished:
+                if self.receiving:
+                    self.condition.wait()
+                    continue
+                self.receiving = True
+                self.condition.release()
+                try:
+                    item = self._receive()
+                finally:
+                    self.condition.acquire()
+                    self.receiving = False
+                    self.condition.notify_all()
+                self.finished[item[0]] = item
+            _, payload, error, _ = self.finished.pop(batchId)
+
+        if error is not None:
+            raise RuntimeError(f"Worker failed to process batch {batchId}:\n{error}")
+        return payload
+
+    def _receive(self):
+        '''Returns the next batch result, replacing the workers that retire in the meantime.'''
+        while True:
+            try:
+                item = self.results.get(timeout=1.0)
+            except queue.Empty:
+                with self.processLock:
+                    dead = [process.pid for process in self.processes if not process.is_alive()]
+                if not dead:
+                    continue
+                try:
+                    # a retiring worker may have exited right after sending its stats
+                    item = self.results.get(timeout=1.0)
+                except queue.Empty:
+                    raise RuntimeError(f"Worker processes {dead} exited unexpectedly.")
+
+            batchId, _, _, stats = item
+            if batchId is None:
+                self._replaceWorker(stats)
+                continue
+            self.workerStats[stats["pid"]] = stats
+            return item
+
+    def __call__(self, text: str, **kwargs) -> dict:
+        '''Returns the results of a single note.'''
+        return self.wait(self.submit([text], **kwargs))[0]
+
+    def pipe(self, texts: Iterable[str], asDocs: bool = False, tokenBudget: Optional[int] = None, **kwargs):
+        '''
+        Yields the results of every text, in input order, as returned by getDocResults. With asDocs=True, yields docs
+        tokenized in this process with the results restored onto them (see setDocResults).
+        At most two batches per worker are in flight at a time, so texts can be a generator of any length.
+        With a tokenBudget, batches are formed by length instead of by count (see _pipeByLength).
+        '''
+        setDocResults = registry.get("misc", "setDocResults")
+        results = self._pipeByLength(texts, tokenBudget, **kwargs) if tokenBudget else self._pipeByCount(texts, **kwargs)
+        for text, result in results:
+            yield setDocResults(self._getTokenizer()(text), result) if asDocs else result
+
+    def _getTokenizer(self):
+        '''
+        Returns the copy of the pipeline tokenizer, with a vocab of its own, that docs are made with in this process (see
+        makeBuildTokenizer). The copy is replaced once it has added more than maxNewStrings strings, the same as a worker.
+        '''
+        tokenizer = self.tokenizer
+        if tokenizer is None or (self.maxNewStrings is not None and len(tokenizer.vocab.strings) - self.tokenizerStrings > self.maxNewStrings):
+            tokenizer = registry.get("misc", "makeBuildTokenizer")(self.nlp)
+            self.tokenizer, self.tokenizerStrings = tokenizer, len(tokenizer.vocab.strings)
+        return tokenizer
+
+    def _pipeByCount(self, texts: Iterable[str], **kwargs):
+        items = iter(texts)
+        inFlight = []
+
+        while True:
+            while len(inFlight) < 2 * self.workers:
+                batch = list(islice(items, self.batchSize))
+                if not batch:
+                    break
+                inFlight.append((self.submit(batch, **kwargs), batch))
+
+            if not inFlight:
+                break
+
+            batchId, batch = inFlight.pop(0)
+            yield from zip(batch, self.wait(batchId))
+
+    def _pipeByLength(self, texts: Iterable[str], tokenBudget: int, **kwargs):
+        '''
+        Reads the texts a window of 4 * batchSize texts per worker at a time, and cuts each window into batches of texts
+        of similar lengths within tokenBudget estimated tokens (see makeLengthBatches), submitted longest first.
+        Idle workers take the next batch from the shared queue, so a worker held up by a long note does not hold up
+        the others, and short notes are not held back in a batch with a long one.
+        Results are yielded in input order as soon as the batches holding them are done. The next window is submitted
+        before the results of the current one are collected, to keep the workers busy.
+        '''
+        items = iter(texts)
+        windowSize = 4 * self.batchSize * self.workers
+        windows = deque()
+
+        while True:
+            while len(windows) < 2:
+                window = list(islice(items, windowSize))
+                if not window:
+                    break
+                batchIds = [None] * len(window)
+                for batch in makeLengthBatches(window, tokenBudget, self.batchSize):
+                    batchId = self.submit([window[i] for i in batch], **kwargs)
+                    for position, i in enumerate(batch):
+                        batchIds[i] = (batchId, position)
+                windows.append((window, batchIds))
+
+            if not windows:
+                break
+
+            window, batchIds = windows.popleft()
+            collected = {}
+            for text, (batchId, position) in zip(window, batchIds):
+                if batchId not in collected:
+                    collected[batchId] = self.wait(batchId)
+                yield text, collected[batchId][position]
+
+    def report(self) -> dict:
+        '''
+        Returns the memory of the parent and of every worker (see getProcessMemory), along with:
+        - workerUnique: total memory private to the workers
+        - sharedRatio: the fraction of the workers' resident memory that is shared
+        - growth: the latest stats of every running worker (see _getWorkerStats), the number of workers retired so far,
+          and the strings added to the vocab and unique memory gained per text, averaged over the running workers
+        '''
+        with self.processLock:
+            pids = [process.pid for process in self.processes]
+        workers = {pid: getProcessMemory(pid) for pid in pids}
+        measured = [i for i in workers.values() if i is not None]
+        rss = sum(i["rss"] for i in measured)
+        stats = list(self.workerStats.values())
+        return {
+            "parent": getProcessMemory(os.getpid()),
+            "workers": workers,
+            "workerUnique": sum(i["uss"] for i in measured),
+            "sharedRatio": sum(i["shared"] for i in measured) / rss if rss else 0.0,
+            "growth": {
+                "workers": self.workerStats,
+                "retired": len(self.retired),
+                "stringsPerText": sum(i["stringsPerText"] for i in stats) / len(stats) if stats else 0.0,
+                "ussGrowthPerText": sum(i["ussGrowthPerText"] for i in stats) / len(stats) if stats else 0.0,
+            },
+        }
+
+
+class ThreadedPool:
+    '''
+    Pool of threads serving one loaded pipeline, the in-process counterpart of PreforkPool. The components keep no
+    per-document state on themselves, and their memos and counters are locked, so several threads can run nlp.pipe on
+    the same pipeline. Threads only run in parallel while the GIL is released, ie. in the spaCy matchers, in numpy and in
+    xgboost; benchmarkServing.py compares the throughput of both pools, and stressThreads checks the results of the
+    threads against a single thread. Usage:
+        with ThreadedPool(nlp, threads=4) as pool:
+            for results in pool.pipe(texts):
+                ...
+
+    Results are those of getDocResults, in input order; with asDocs=True, the processed docs themselves are yielded.
+    pool(text) returns the results of one note, and can be called from several threads.
+    '''
+
+    def __init__(self, nlp: Language, threads: Optional[int] = None, batchSize: int = 8, warmupTexts: Iterable[str] = ("Patient is a 80-year-old retired firefighter.",)):
+        self.nlp = nlp
+        self.threads = threads or os.cpu_count() or 1
+        self.batchSize = batchSize
+        self.warmupTexts = list(warmupTexts)
+        self.executor = None
+        self.startLock = threading.Lock()
+
+    def start(self):
+        '''Starts the threads. Texts in warmupTexts are processed first, so that lazily created state is made on one thread.'''
+        with self.startLock:
+            if self.executor is None:
+                if self.warmupTexts:
+                    list(self.nlp.pipe(self.warmupTexts))
+                registry.get("misc", "ensureResultExtensions")()
+                self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="emr-pipeline")
+        return self
+
+    def close(self):
+        '''Stops the threads once they are done with the submitted batches.'''
+        with self.startLock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _runBatch(self, texts: List[str], asDocs: bool, kwargs: dict) -> list:
+        docs = self.nlp.pipe(texts, **kwargs)
+        if asDocs:
+            return list(docs)
+        getDocResults = registry.get("misc", "getDocResults")
+        return [getDocResults(doc) for doc in docs]
+
+    def submit(self, texts: List[str], asDocs: bool = False, **kwargs) -> Future:
+        '''Sends a batch of texts to the threads, returns a Future of their results. Keyword arguments are passed on to nlp.pipe.'''
+        if self.executor is None:
+            self.start()
+        return self.executor.submit(self._runBatch, list(texts), asDocs, kwargs)
+
+    def __call__(self, text: str, **kwargs) -> dict:
+        '''Returns the results of a single note.'''
+        return self.submit([text], **kwargs).result()[0]
+
+    def pipe(self, texts: Iterable[str], asDocs: bool = False, **kwargs):
+        '''Yields the results of every text, in input order. At most two batches per thread are in flight at a time.'''
+        items = iter(texts)
+        inFlight = deque()
+
+        while True:
+            while len(inFlight) < 2 * self.threads:
+                batch = list(islice(items, self.batchSize))
+                if not batch:
+                    break
+                inFlight.append(self.submit(batch, asDocs, **kwargs))
+
+            if not inFlight:
+                break
+
+            yield from inFlight.popleft().result()
+
+
+def runSingleThread(nlp: Language, texts: List[str]):
+    '''Returns the getDocResults of every text processed with nlp.pipe on this thread, and the seconds it took.'''
+    getDocResults = registry.get("misc", "getDocResults")
+    start = time.perf_counter()
+    results = [getDocResults(doc) for doc in nlp.pipe(texts)]
+    return results, time.perf_counter() - start
+
+
+def stressThreads(nlp: Language, texts: List[str], reference: List[dict], threads: int, rounds: int, seed: int = 0,
+                  fields: Optional[List[str]] = None) -> dict:
+    '''
+    Processes every text rounds times in shuffled order on a ThreadedPool, so that threads process the same texts and
+    different texts at the same time, and compares the results of every text with reference, ie. from runSingleThread.
+    Returns the number of texts whose fields (all those of reference by default) differ, with the first difference.
+    '''
+    findFirstDifference = registry.get("misc", "findFirstDifference")
+    order = [i for _ in range(rounds) for i in range(len(texts))]
+    random.Random(seed).shuffle(order)
+
+    with ThreadedPool(nlp, threads=threads, batchSize=1) as pool:
+        results = list(pool.pipe(texts[i] for i in order))
+
+    mismatches = 0
+    example = None
+    for i, result in zip(order, results):
+        for field in fields or reference[i]:
+            difference = findFirstDifference(reference[i].get(field), result.get(field))
+            if difference is not None:
+                mismatches += 1
+                example = example or {"note": i, "field": field, "difference": difference}
+                break
+    return {"notes": len(order), "mismatches": mismatches, "example": example}
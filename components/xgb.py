@@ -1,12 +1,25 @@
-from typing import Union, TypedDict, Dict
+from typing import Union, TypedDict, Dict, List
+from pathlib import Path
+from tempfile import TemporaryDirectory
 from spacy.language import Language
 from spacy.tokens import Doc
-from scipy.sparse import csr_matrix
+from spacy.util import minibatch
+from scipy.sparse import csr_matrix, vstack
 from spacy import registry
+from hashlib import blake2b
+from uuid import uuid4
+import copy
+import json
+import numpy as np
+import os
 import pickle
+import re
+import struct
+import threading
+import zipfile
 
 try:
-    @Language.factory("xgb_binary_classifier")
+    @Language.factory("xgb_binary_classifier", assigns=["doc._.xgb_summary"])
     def createXgbBinaryClassifier(nlp: Language, name: str):
         return XgbBinaryClassifier(nlp)
 except:
@@ -22,15 +35,434 @@ class XgbSummaryConceptItem(TypedDict):
 XgbSummary = Dict[str, XgbSummaryConceptItem]
 
 
+class NumPyTreeEnsemble:
+    '''
+    Evaluates a binary:logistic XGBoost model from flat node arrays with NumPy, without the xgboost runtime.
+    The nodes of all the trees are concatenated: tree t starts at node treeRoots[t], and a node is a leaf if its left
+    child is -1, in which case its split condition holds the leaf value.
+
+    Predictions follow xgboost's CPU predictor so that outputs are the same: feature values and leaf values are float32,
+    entries absent from the sparse input are missing values (routed to the default child), the margin is accumulated in
+    float32 from the base margin, tree by tree in order, and the output is 1 if the float32 sigmoid of the margin is
+    greater than 0.5.
+    Rows are evaluated a block of trees at a time, all rows and trees of a block at once. After each block, a row whose
+    output can no longer change whatever the leaves of the remaining trees are (bounded by the smallest and largest leaf
+    of each remaining tree, plus the float32 rounding error) is done and is not evaluated further.
+    '''
+
+    def __init__(self, leftChildren, rightChildren, splitFeatures, splitConditions, defaultLeft, treeRoots, baseMargin, classes, blockSize=16):
+        self.leftChildren = np.asarray(leftChildren, dtype=np.int32)
+        self.rightChildren = np.asarray(rightChildren, dtype=np.int32)
+        self.splitFeatures = np.asarray(splitFeatures, dtype=np.int32)
+        self.splitConditions = np.asarray(splitConditions, dtype=np.float32)
+        self.defaultLeft = np.asarray(defaultLeft, dtype=bool)
+        self.treeRoots = np.asarray(treeRoots, dtype=np.int32)
+        self.baseMargin = np.float32(baseMargin)
+        self.classes = np.asarray(classes)
+        self.blockSize = blockSize
+
+        # features used by any split, as columns of the dense matrix the trees are evaluated on
+        isSplit = self.leftChildren >= 0
+        self.usedFeatures = np.unique(self.splitFeatures[isSplit])
+        self.splitColumns = np.where(isSplit, np.searchsorted(self.usedFeatures, self.splitFeatures), 0).astype(np.int32)
+
+        # smallest and largest leaf value of the trees from t on, and bound on the float32 rounding error
+        nodeTrees = np.repeat(np.arange(len(self.treeRoots)), np.diff(np.append(self.treeRoots, len(self.leftChildren))))
+        leafValues = np.where(isSplit, np.nan, self.splitConditions.astype(np.float64))
+        treeMin = np.array([np.nanmin(leafValues[nodeTrees == t]) for t in range(len(self.treeRoots))])
+        treeMax = np.array([np.nanmax(leafValues[nodeTrees == t]) for t in range(len(self.treeRoots))])
+        self.suffixMin = np.append(np.cumsum(treeMin[::-1])[::-1], 0.0)
+        self.suffixMax = np.append(np.cumsum(treeMax[::-1])[::-1], 0.0)
+        self.suffixAbs = np.append(np.cumsum(np.maximum(np.abs(treeMin), np.abs(treeMax))[::-1])[::-1], 0.0)
+        self.maxDepth = self._getMaxDepth()
+
+    @classmethod
+    def fromXgbModel(cls, model, blockSize=16):
+        '''
+        Returns the ensemble of a fitted xgboost.XGBClassifier with the binary:logistic objective, read from the model
+        saved as JSON. Only the trees used by model.predict are kept (up to best_iteration if the model has one).
+        '''
+        booster = model.get_booster()
+        with TemporaryDirectory() as tmp:
+            modelPath = Path(tmp)/"model.json"
+            booster.save_model(str(modelPath))
+            with open(modelPath, mode='r', encoding='utf-8') as f:
+                learner = json.load(f)["learner"]
+
+        objective = learner["objective"]["name"]
+        if objective != "binary:logistic":
+            raise ValueError(f"NumPyTreeEnsemble only evaluates binary:logistic models, got '{objective}'.")
+
+        gbtree = learner["gradient_booster"]["model"]
+        trees = gbtree["trees"]
+        bestIteration = getattr(model, "best_iteration", None)
+        if bestIteration is not None:
+            treesPerIteration = int(gbtree["gbtree_model_param"].get("num_parallel_tree", 1))
+            trees = trees[:(bestIteration + 1) * treesPerIteration]
+
+        columns = {"left_children": [], "right_children": [], "split_indices": [], "split_conditions": [], "default_left": []}
+        treeRoots = []
+        for tree in trees:
+            offset = len(columns["left_children"])
+            treeRoots.append(offset)
+            columns["left_children"].extend(i + offset if i >= 0 else -1 for i in tree["left_children"])
+            columns["right_children"].extend(i + offset if i >= 0 else -1 for i in tree["right_children"])
+            for key in ["split_indices", "split_conditions", "default_left"]:
+                columns[key].extend(tree[key])
+
+        baseScore = np.float32(float(learner["learner_model_param"]["base_score"]))
+        baseMargin = -np.log(np.float32(1.0) / baseScore - np.float32(1.0))  # ProbToMargin of binary:logistic, in float32
+        labelEncoder = getattr(model, "_le", None)  # predict returns the encoded labels if the model has a label encoder
+        classes = np.array([0, 1]) if labelEncoder is None else np.asarray(labelEncoder.classes_)
+
+        return cls(columns["left_children"], columns["right_children"], columns["split_indices"],
+                   columns["split_conditions"], columns["default_left"], treeRoots, baseMargin, classes, blockSize)
+
+    def toData(self):
+        return (self.leftChildren, self.rightChildren, self.splitFeatures, self.splitConditions, self.defaultLeft,
+                self.treeRoots, self.baseMargin, self.classes, self.blockSize)
+
+    @classmethod
+    def fromData(cls, data):
+        return cls(*data)
+
+    def _getMaxDepth(self):
+        depth = 0
+        nodes = self.treeRoots
+        while len(nodes):
+            nodes = nodes[self.leftChildren[nodes] >= 0]
+            nodes = np.concatenate([self.leftChildren[nodes], self.rightChildren[nodes]])
+            depth += 1
+        return depth
+
+    def _getDenseFeatures(self, X: csr_matrix):
+        '''Returns the used features of the rows of X as a dense float32 matrix, with NaN for the entries absent from X.'''
+        X = csr_matrix(X)
+        dense = np.full((X.shape[0], len(self.usedFeatures)), np.nan, dtype=np.float32)
+        rows = np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+        columns = np.searchsorted(self.usedFeatures, X.indices)
+        used = columns < len(self.usedFeatures)
+        used[used] = self.usedFeatures[columns[used]] == X.indices[used]
+        dense[rows[used], columns[used]] = X.data[used].astype(np.float32)
+        return dense
+
+    @staticmethod
+    def _decide(margins):
+        '''Returns 1 where the float32 sigmoid of the margins is greater than 0.5, as xgboost does for binary:logistic.'''
+        margins = np.asarray(margins, dtype=np.float32)
+        with np.errstate(over='ignore'):
+            probabilities = np.float32(1.0) / (np.float32(1.0) + np.exp(-margins))
+        return (probabilities > np.float32(0.5)).astype(np.int64)
+
+    def _getLeafValues(self, dense, rows, treeStart, treeEnd):
+        '''Returns the leaf value of every tree in [treeStart, treeEnd) for every row, shaped (rows, trees).'''
+        nodes = np.broadcast_to(self.treeRoots[treeStart:treeEnd], (len(rows), treeEnd - treeStart)).copy()
+        for _ in range(self.maxDepth):
+            left = self.leftChildren[nodes]
+            isLeaf = left < 0
+            if isLeaf.all():
+                break
+            values = dense[rows[:, None], self.splitColumns[nodes]]
+            goLeft = np.where(np.isnan(values), self.defaultLeft[nodes], values < self.splitConditions[nodes])
+            nodes = np.where(isLeaf, nodes, np.where(goLeft, left, self.rightChildren[nodes]))
+        return self.splitConditions[nodes]
+
+    def predict(self, X: csr_matrix):
+        '''Returns the predicted class of every row of X, the same as XGBClassifier.predict.'''
+        dense = self._getDenseFeatures(X)
+        treeCount = len(self.treeRoots)
+        margins = np.full(dense.shape[0], self.baseMargin, dtype=np.float32)
+        decisions = np.zeros(dense.shape[0], dtype=np.int64)
+        active = np.arange(dense.shape[0])
+
+        for treeStart in range(0, treeCount, self.blockSize):
+            treeEnd = min(treeStart + self.blockSize, treeCount)
+            leaves = self._getLeafValues(dense, active, treeStart, treeEnd)
+            partial = np.concatenate([margins[active, None], leaves], axis=1)
+            margins[active] = np.cumsum(partial, axis=1, dtype=np.float32)[:, -1]
+
+            current = margins[active].astype(np.float64)
+            rounding = (treeCount - treeEnd + 1) * np.finfo(np.float32).eps * (np.abs(current) + self.suffixAbs[treeEnd])
+            lower = self._decide(current + self.suffixMin[treeEnd] - rounding)
+            upper = self._decide(current + self.suffixMax[treeEnd] + rounding)
+            done = (lower == upper) if treeEnd < treeCount else np.ones(len(active), dtype=bool)
+            decisions[active[done]] = self._decide(margins[active[done]])
+            active = active[~done]
+            if not len(active):
+                break
+
+        return self.classes[decisions]
+
+
+class CompactVocabulary:
+    '''
+    Vocabulary of a fitted sklearn CountVectorizer or TfidfVectorizer held in four flat arrays instead of a dict of strings:
+    - hashes: the sorted 64-bit blake2b hashes of the terms, and columns: the column of the term of each hash
+    - strings: the UTF-8 bytes of all the terms in column order, and offsets: where the term of each column starts
+    A term is looked up by binary search on its hash, and the bytes of the term found are compared with it, so a hash
+    collision never maps a term to the wrong column.
+    The arrays are saved as .npy files and loaded memory-mapped, so loading does not unpickle a dictionary, and the
+    pages are shared by every process that loads the pipeline.
+    '''
+
+    ARRAYS = ("hashes", "columns", "offsets", "strings")
+
+    def __init__(self, hashes, columns, offsets, strings):
+        self.hashes = hashes
+        self.columns = columns
+        self.offsets = offsets
+        self.strings = strings
+
+    @staticmethod
+    def getHashes(encodedTerms: List[bytes]) -> np.ndarray:
+        return np.fromiter((int.from_bytes(blake2b(i, digest_size=8).digest(), 'little') for i in encodedTerms),
+                           dtype=np.uint64, count=len(encodedTerms))
+
+    @classmethod
+    def fromVectorizer(cls, vectorizer):
+        '''Returns the compact form of the vocabulary_ of a fitted vectorizer.'''
+        terms = [term.encode("utf-8") for term, _ in sorted(vectorizer.vocabulary_.items(), key=lambda i: i[1])]
+        hashes = cls.getHashes(terms)
+        if len(np.unique(hashes)) != len(hashes):
+            raise ValueError("Terms of the vectorizer vocabulary have the same 64-bit hash.")
+        order = np.argsort(hashes)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum([len(i) for i in terms], out=offsets[1:])
+        strings = np.frombuffer(b"".join(terms), dtype=np.uint8).copy()
+        return cls(hashes[order], order.astype(np.int32), offsets, strings)
+
+    def save(self, directory: Path, prefix: str):
+        for name in self.ARRAYS:
+            # written next to the target and renamed, so that processes mapping the previous file keep reading it
+            tmpPath = directory/f"{prefix}.{name}.tmp.npy"
+            np.save(tmpPath, getattr(self, name))
+            os.replace(tmpPath, directory/f"{prefix}.{name}.npy")
+
+    @classmethod
+    def load(cls, directory: Path, prefix: str, mmap: bool = True):
+        return cls(*(np.load(directory/f"{prefix}.{name}.npy", mmap_mode='r' if mmap else None) for name in cls.ARRAYS))
+
+    def __len__(self):
+        return len(self.columns)
+
+    def getTerm(self, column: int) -> str:
+        return self.strings[self.offsets[column]:self.offsets[column + 1]].tobytes().decode("utf-8")
+
+    def getColumns(self, terms: List[str]) -> np.ndarray:
+        '''Returns the column of every term, or -1 for terms that are not in the vocabulary.'''
+        encoded = [term.encode("utf-8") for term in terms]
+        hashes = self.getHashes(encoded)
+        if not len(self.hashes):
+            return np.full(len(terms), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.hashes, hashes), len(self.hashes) - 1)
+        columns = np.where(self.hashes[positions] == hashes, self.columns[positions], -1).astype(np.int64)
+
+        found = np.flatnonzero(columns >= 0)
+        if not len(found):
+            return columns
+
+        # compare the bytes of the terms with the strings of the columns their hashes were found at
+        lengths = np.fromiter((len(encoded[i]) for i in found), dtype=np.int64, count=len(found))
+        starts = self.offsets[columns[found]]
+        matched = self.offsets[columns[found] + 1] - starts == lengths
+        termOfByte = np.repeat(np.arange(len(found)), lengths)
+        byteInTerm = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        stringBytes = self.strings[np.minimum(np.repeat(starts, lengths) + byteInTerm, len(self.strings) - 1)]
+        termBytes = np.frombuffer(b"".join(encoded[i] for i in found), dtype=np.uint8)
+        matched &= np.bincount(termOfByte[stringBytes != termBytes], minlength=len(found)) == 0
+        columns[found[~matched]] = -1
+        return columns
+
+
+def _mapNpzMember(path: Path, name: str) -> np.ndarray:
+    '''
+    Returns an array of an .npz file memory-mapped. np.load does not map the members of an .npz file, but np.savez stores
+    them uncompressed, so the .npy data of a member is a contiguous range of the file, found from its zip local header.
+    '''
+    with zipfile.ZipFile(path) as archive:
+        info = archive.getinfo(f"{name}.npy")
+    if info.compress_type != zipfile.ZIP_STORED:
+        with np.load(path) as arrays:
+            return arrays[name]
+
+    with open(path, 'rb') as f:
+        f.seek(info.header_offset)
+        nameLength, extraLength = struct.unpack("<HH", f.read(30)[26:30])
+        f.seek(info.header_offset + 30 + nameLength + extraLength)
+        version = np.lib.format.read_magic(f)
+        readHeader = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortranOrder, dtype = readHeader(f)
+        offset = f.tell()
+    if dtype.hasobject:
+        raise ValueError(f"Member {name} of {path} holds Python objects and cannot be memory-mapped.")
+    if not int(np.prod(shape)):
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape, order='F' if fortranOrder else 'C')
+
+
+class FeatureStore:
+    '''
+    Writes the feature vectors of notes (see XgbBinaryClassifier.vectorize) with their note ids to chunked .npz shards,
+    so that models can be scored over a corpus again without vectorizing its text (see scoreFeatureStore).
+    Every shard (features-00000-<run>.npz, ...) holds at least shardSize rows, except the last one, as the CSR arrays of
+    their matrix (data, indices, indptr, shape) and noteIds. Shards are written uncompressed, next to the target and
+    renamed, and read back memory-mapped, so reading a shard only pages in the rows being scored.
+    Shards are numbered after those already in the directory, and rows without a note id are numbered after the rows
+    already stored, so a store can be extended over several runs. The shard names hold a random id of the store, which
+    keeps apart the shards of stores written to the same directory at the same time.
+    A store is written by the process that created it only: its buffer is not shared with forked processes (ie. the
+    workers of PreforkPool), so append and flush raise a RuntimeError in them.
+    Usage:
+        with FeatureStore("features") as store:
+            store.append(X, noteIds)
+        for noteIds, X in FeatureStore.iterShards("features"):
+            ...
+    '''
+
+    ARRAYS = ("data", "indices", "indptr", "shape", "noteIds")
+    SHARD_REGEX = re.compile(r"features-(\d+)(?:-([0-9a-f]+))?\.npz")
+
+    def __init__(self, directory: Path, shardSize: int = 100000):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.shardSize = shardSize
+        self.pid = os.getpid()
+        self.run = uuid4().hex[:12]
+        shardPaths = self.getShardPaths(self.directory)
+        self.shards = max((int(self.SHARD_REGEX.fullmatch(path.name).group(1)) + 1 for path in shardPaths), default=0)
+        self.rows = sum(int(_mapNpzMember(path, "shape")[0]) for path in shardPaths)
+        self.buffer = []
+        self.bufferedRows = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @classmethod
+    def getShardPaths(cls, directory: Path) -> List[Path]:
+        '''Returns the shards of a store in the order they were written, leaving out the temporary files of shards being written.'''
+        matches = (cls.SHARD_REGEX.fullmatch(path.name) for path in Path(directory).glob("features-*.npz"))
+        return [Path(directory)/match.group(0) for match in
+                sorted((match for match in matches if match), key=lambda match: (int(match.group(1)), match.group(2) or ""))]
+
+    def _checkProcess(self):
+        if os.getpid() != self.pid:
+            raise RuntimeError(f"FeatureStore of {self.directory} was created in process {self.pid} and cannot be written "
+                               f"from process {os.getpid()}; write it from the process that created it, ie. with ThreadedPool or nlp.pipe.")
+
+    def append(self, X: csr_matrix, noteIds=None):
+        '''
+        Adds the rows of X, with the note id of every row. Note ids must be all str or all int; without note ids (or for a
+        None id), rows are identified by their position in the store.
+        '''
+        with self.lock:
+            self._checkProcess()
+            if noteIds is None:
+                noteIds = [None] * X.shape[0]
+            noteIds = [self.rows + i if noteId is None else noteId for i, noteId in enumerate(noteIds)]
+            if len(noteIds) != X.shape[0]:
+                raise ValueError(f"{len(noteIds)} note ids given for {X.shape[0]} rows.")
+            self.buffer.append((csr_matrix(X), noteIds))
+            self.rows += X.shape[0]
+            self.bufferedRows += X.shape[0]
+            if self.bufferedRows >= self.shardSize:
+                self._writeShard()
+
+    def flush(self):
+        '''Writes the rows appended since the last shard to a shard of their own.'''
+        with self.lock:
+            self._checkProcess()
+            self._writeShard()
+
+    def close(self):
+        self.flush()
+
+    def _writeShard(self):
+        if not self.buffer:
+            return
+        X = vstack([i[0] for i in self.buffer], format="csr")
+        noteIds = np.asarray([noteId for _, batchIds in self.buffer for noteId in batchIds])
+        if noteIds.dtype.hasobject:
+            noteIds = noteIds.astype(str)
+
+        shardPath = self.directory/f"features-{self.shards:05d}-{self.run}.npz"
+        tmpPath = self.directory/f"features-{self.shards:05d}-{self.run}.tmp.npz"
+        np.savez(tmpPath, data=X.data, indices=X.indices, indptr=X.indptr, shape=np.array(X.shape, dtype=np.int64), noteIds=noteIds)
+        os.replace(tmpPath, shardPath)
+        self.shards += 1
+        self.buffer = []
+        self.bufferedRows = 0
+
+    @classmethod
+    def loadShard(cls, path: Path, mmap: bool = True):
+        '''Returns the (noteIds, X) of a shard, with the arrays of X memory-mapped.'''
+        if mmap:
+            data, indices, indptr, shape, noteIds = (_mapNpzMember(path, name) for name in cls.ARRAYS)
+        else:
+            with np.load(path) as arrays:
+                data, indices, indptr, shape, noteIds = (arrays[name] for name in cls.ARRAYS)
+        return noteIds, csr_matrix((data, indices, indptr), shape=tuple(int(i) for i in shape))
+
+    @classmethod
+    def iterShards(cls, directory: Path, mmap: bool = True):
+        '''Yields the (noteIds, X) of every shard of a store, in the order they were written.'''
+        for shardPath in cls.getShardPaths(directory):
+            yield cls.loadShard(shardPath, mmap)
+
+
+def scoreFeatureStore(directory: Path, models: dict, treeEngines: dict = None, mmap: bool = True):
+    '''
+    Yields (noteIds, {name: outputs}) for every shard of a FeatureStore, with the outputs of every model for the rows of
+    the shard, without text or spaCy. models are {name: {"model": ...}} as returned by the 'getXgbAssets' registry
+    function, and a model with a NumPyTreeEnsemble in treeEngines is scored with it instead. The models must have been
+    trained on the vectorizer the store was written with.
+    '''
+    treeEngines = treeEngines or {}
+    for noteIds, X in FeatureStore.iterShards(directory, mmap):
+        outputs = {}
+        for name, modelConfig in models.items():
+            engine = treeEngines.get(name)
+            outputs[name] = engine.predict(X) if engine is not None else modelConfig["model"].predict(X)
+        yield noteIds, outputs
+
+
 class XgbBinaryClassifier:
 
     def __init__(self, nlp: Language):
         self.vectorizer, self.models = (None, {},)
+        self.treeEngines = {}
+        self.vocabulary = None
+        self.analyzer = None
         self.runtimeConceptMap = {}
+        self.featureStore = None
+        if not Doc.has_extension("xgb_summary"):
+            Doc.set_extension("xgb_summary", default=None)
 
     def to_disk(self, path, exclude=tuple()):
         dataPath = path.parent/"xgbbinaryclassifier.bin"
-        assets = (self.vectorizer, self.models,)
+        models = self.models
+        vectorizer = self.vectorizer
+        if self.treeEngines:
+            # the xgboost models are not saved, so that loading the pipeline does not need the xgboost runtime
+            models = {name: {**modelConfig, "model": None} for name, modelConfig in self.models.items()}
+        if self.vocabulary is not None:
+            # the vocabulary is saved as arrays (see CompactVocabulary) instead of being pickled with the vectorizer
+            vectorizer = copy.copy(self.vectorizer)
+            for attribute in ("vocabulary_", "stop_words_"):
+                if hasattr(vectorizer, attribute):
+                    delattr(vectorizer, attribute)
+            self.vocabulary.save(path.parent, "xgbbinaryclassifier.vocabulary")
+
+        engines = {name: engine.toData() for name, engine in self.treeEngines.items()}
+        if self.vocabulary is not None:
+            assets = (vectorizer, models, engines, True)
+        elif self.treeEngines:
+            assets = (vectorizer, models, engines)
+        else:
+            assets = (vectorizer, models,)
         with open(dataPath, 'wb') as f:
             pickle.dump(assets, f)
 
@@ -38,11 +470,24 @@ class XgbBinaryClassifier:
         dataPath = path.parent/"xgbbinaryclassifier.bin"
         with open(dataPath, 'rb') as f:
             assets = pickle.load(f)
-            self.vectorizer, self.models = assets
+            self.vectorizer, self.models = assets[:2]
+        self.treeEngines = {name: NumPyTreeEnsemble.fromData(data) for name, data in assets[2].items()} if len(assets) > 2 else {}
+        self.vocabulary = CompactVocabulary.load(path.parent, "xgbbinaryclassifier.vocabulary") if len(assets) > 3 and assets[3] else None
+        self.analyzer = self.vectorizer.build_analyzer() if self.vocabulary is not None else None
         self.runtimeConceptMap = self.getConceptMap(list(map(lambda i: i[1]['concept_id'], self.models.items())))
 
-    def build(self):
+    def build(self, treeEngine=False, compactVocabulary=False):
+        '''
+        Builds the vectorizer and models from the 'getXgbAssets' registry function. With treeEngine=True, the models are
+        exported to NumPyTreeEnsemble node arrays, which are evaluated and saved in place of the xgboost models.
+        With compactVocabulary=True, terms are looked up in a CompactVocabulary, which is saved in place of the
+        vocabulary of the vectorizer.
+        '''
         self.vectorizer, self.models = self.getXgbAssets()
+        self.treeEngines = {name: NumPyTreeEnsemble.fromXgbModel(modelConfig["model"]) for name, modelConfig in self.models.items()} if treeEngine else {}
+        useVocabulary = compactVocabulary and hasattr(self.vectorizer, "vocabulary_")
+        self.vocabulary = CompactVocabulary.fromVectorizer(self.vectorizer) if useVocabulary else None
+        self.analyzer = self.vectorizer.build_analyzer() if useVocabulary else None
 
     def getXgbAssets(self):
         if registry.has("misc", "getXgbAssets"):
@@ -59,20 +504,110 @@ class XgbBinaryClassifier:
             return {}
 
     def __call__(self, doc: Doc) -> Doc:
-        doc.set_extension("xgb_summary", default=None, force=True)
         doc._.xgb_summary = self.predict(doc)
         return doc
 
+    def pipe(self, docs, batch_size=128):
+        '''Same as __call__ over a stream of docs, vectorizing and scoring batch_size docs at a time.'''
+        for batch in minibatch(docs, size=batch_size):
+            for doc, summary in zip(batch, self.predictBatch(batch)):
+                doc._.xgb_summary = summary
+                yield doc
+
     def predict(self, doc: Doc) -> XgbSummary:
-        if self.vectorizer:
-            X = self.getVector(doc.text)
-            return {name:  {"output": self.catText(modelConfig["model"], X), "concept_id": modelConfig["concept_id"], "concept_name": self.runtimeConceptMap.get(modelConfig["concept_id"]) or modelConfig.get("concept_name")} for (name, modelConfig) in self.models.items()}
-        else:
-            return {}
+        return self.predictBatch([doc])[0]
+
+    def predictBatch(self, docs) -> list:
+        '''Returns the XgbSummary of every doc.'''
+        if not self.vectorizer:
+            return [{} for _ in docs]
+
+        X = self.vectorize([doc.text for doc in docs])
+        featureStore = self.featureStore
+        if featureStore is not None:
+            featureStore.append(X, [doc.user_data.get("note_id") for doc in docs])
+        outputs = {name: self.catTexts(name, X) for name in self.models}
+        return [{name: {"output": outputs[name][i], "concept_id": modelConfig["concept_id"], "concept_name": self.runtimeConceptMap.get(modelConfig["concept_id"]) or modelConfig.get("concept_name")}
+                 for (name, modelConfig) in self.models.items()} for i in range(len(docs))]
+
+    def vectorize(self, texts: List[str]) -> csr_matrix:
+        '''
+        Returns the vectors of texts, the same as vectorizer.transform. With a CompactVocabulary, the terms produced by the
+        analyzer of the vectorizer are looked up in it, and the counts are weighted by the tf-idf transformer of the
+        vectorizer if it has one.
+        '''
+        if self.vocabulary is None:
+            return self.vectorizer.transform(texts)
+
+        indices = []
+        counts = []
+        indptr = [0]
+        for text in texts:
+            columns = self.vocabulary.getColumns(self.analyzer(text))
+            columns, textCounts = np.unique(columns[columns >= 0], return_counts=True)
+            indices.append(columns)
+            counts.append(textCounts)
+            indptr.append(indptr[-1] + len(columns))
+
+        X = csr_matrix((np.concatenate(counts) if counts else np.zeros(0, dtype=np.int64),
+                        np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64), indptr),
+                       shape=(len(texts), len(self.vocabulary)), dtype=self.vectorizer.dtype)
+        if self.vectorizer.binary:
+            X.data.fill(1)
+        tfidf = getattr(self.vectorizer, "_tfidf", None)
+        return tfidf.transform(X, copy=False) if tfidf is not None else X
+
+    def startFeatureStore(self, directory: Path, shardSize: int = 100000) -> FeatureStore:
+        '''
+        Starts saving the vectors of every batch of docs scored to a FeatureStore, with the note id of each doc from
+        doc.user_data["note_id"] (or its position in the store). Returns the store.
+        '''
+        self.stopFeatureStore()
+        self.featureStore = FeatureStore(directory, shardSize)
+        return self.featureStore
+
+    def stopFeatureStore(self):
+        '''Stops saving vectors, and writes the last shard.'''
+        featureStore, self.featureStore = self.featureStore, None
+        if featureStore is not None:
+            featureStore.close()
+
+    def storeFeatures(self, texts, noteIds, directory: Path, batchSize: int = 1000, shardSize: int = 100000) -> int:
+        '''Saves the vectors of texts with their note ids to a FeatureStore without running the pipeline. Returns the number of texts.'''
+        rows = 0
+        with FeatureStore(directory, shardSize) as featureStore:
+            for batch in minibatch(zip(texts, noteIds), size=batchSize):
+                featureStore.append(self.vectorize([text for text, _ in batch]), [noteId for _, noteId in batch])
+                rows += len(batch)
+        return rows
+
+    def scoreFeatureStore(self, directory: Path, names: List[str] = None):
+        '''Same as scoreFeatureStore with the models (or a subset of them by name) and tree engines of this component.'''
+        models = {name: self.models[name] for name in (names or self.models)}
+        return scoreFeatureStore(directory, models, self.treeEngines)
+
+    def checkVocabulary(self, texts) -> int:
+        '''Returns the number of texts whose vectors from the CompactVocabulary differ from vectorizer.transform, while the vectorizer still has its vocabulary (ie. right after build).'''
+        texts = list(texts)
+        difference = abs(self.vectorize(texts) - self.vectorizer.transform(texts))
+        return int((difference.max(axis=1).toarray().ravel() > 0).sum())
+
+    def catTexts(self, name: str, X: csr_matrix):
+        '''Returns the output of a model for every row of X, from its NumPyTreeEnsemble if it has one.'''
+        engine = self.treeEngines.get(name)
+        if engine is not None:
+            return engine.predict(X)
+        return self.models[name]["model"].predict(X)
+
+    def checkTreeEngines(self, texts) -> Dict[str, int]:
+        '''Returns the number of texts for which each NumPyTreeEnsemble output differs from its xgboost model, for models that have both.'''
+        X = self.vectorize(list(texts))
+        return {name: int((engine.predict(X) != self.models[name]["model"].predict(X)).sum())
+                for name, engine in self.treeEngines.items() if self.models[name].get("model") is not None}
 
     def getVector(self, text: str) -> Union[csr_matrix, None]:
         if self.vectorizer:
-            return self.vectorizer.transform([text])
+            return self.vectorize([text])
 
     def catText(self, model, X: csr_matrix) -> int:
         return model.predict(X)[0]
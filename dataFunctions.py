@@ -6,6 +6,38 @@ from Utility.resources import *
 from joblib import load
 from operator import itemgetter
 from data.xgbModels import modelConfigs
+import hashlib
+
+
+_parsedTables = {}
+'''{(path, parser name): (content hash, result)}, the latest version parsed of each source table.'''
+
+
+def _hashFile(path: Path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _parseOnce(path: Path, parser):
+    '''
+    Returns parser(path), parsing each version (by content hash) of a source table only once per process. Only the latest
+    version of a table is kept, so that reloads of a changed table do not accumulate parses.
+    '''
+    key = (str(path.resolve()), parser.__name__)
+    contentHash = _hashFile(path)
+    if key in _parsedTables and _parsedTables[key][0] == contentHash:
+        return _parsedTables[key][1]
+    _parsedTables.pop(key, None)  # drops the previous version before parsing the new one
+    _parsedTables[key] = (contentHash, parser(path))
+    return _parsedTables[key][1]
+
+
+def _getParsed(path: Path, parser):
+    '''Returns the result of _parseOnce(path, parser) if the current version of the table was already parsed, else None.'''
+    parsed = _parsedTables.get((str(path.resolve()), parser.__name__))
+    if parsed is not None and parsed[0] == _hashFile(path):
+        return parsed[1]
+    return None
 
 
 @registry.misc("getSectionHeaders")
@@ -23,7 +55,14 @@ def getSectionHeaders(path: Path = None):
 @registry.misc("getDemographRules")
 def getDemographRules():
     '''Returns a list of dictionaries each representing a demographic patterns.'''
-    path = Path("data/demographs.csv")
+    return _parseOnce(Path("data/demographs.csv"), _readDemographRules)
+
+
+def _readDemographRules(path: Path):
+    return list(_iterDemographRules(path))
+
+
+def _iterDemographRules(path: Path):
     expectedColumns = ['cui', 'concept', 'category', 'label', 'phrases', 'disabled']
 
     with open(path, mode='r', encoding='utf-8') as file:
@@ -78,6 +117,19 @@ def getXgbAssets():
     return (vectorizer, models)
 
 
+@registry.misc("getBoilerplateSample")
+def iterBoilerplateSample(path: Path = None):
+    '''
+    Yields the notes of the sample that BoilerplateMasker learns boilerplate lines from, one note per .txt file of
+    data/boilerplate_sample. Yields nothing if the directory does not exist.
+    '''
+    if path is None:
+        path = Path("data/boilerplate_sample")
+    for notePath in sorted(path.glob("*.txt")):
+        with open(notePath, mode='r', encoding='utf-8') as file:
+            yield file.read()
+
+
 @registry.misc("getRuleBasedSearchAsset")
 def createSearchAsset():
     '''
@@ -87,8 +139,50 @@ def createSearchAsset():
     index 2: dictionary for looking up phrases (level 2 only) by seq_id. eg {seg_id: [phrase]}
     index 3: dictionary for looking up phrases (level 3 only) by seq_id. eg {seg_id: [phrase]}
     ...
+    The table is parsed once per version, the same result is shared by EmrPhraseMatcher and MedCondDetect builds.
+    '''
+    return _parseOnce(Path("data/phrase_to_condition.csv"), _readSearchAsset)
+
+
+@registry.misc("getRuleBasedPhrases")
+def iterRuleBasedPhrases(path: Path = None):
     '''
-    path = "data/phrase_to_condition.csv"
+    Yields the distinct lowercased phrases of phrase_to_condition.csv as the rows are read, so that EmrPhraseMatcher
+    can be built from tables of millions of rows without holding its rows in memory (only the distinct phrases are kept, to skip repeats). Phrases are yielded in
+    table order.
+    Raises TypeError for a row of an unknown type, as createSearchAsset does. If the current version of the table was
+    already parsed by createSearchAsset, its (sorted) phrases are yielded from that parse instead of reading the table again.
+    '''
+    if path is None:
+        path = Path("data/phrase_to_condition.csv")
+    parsed = _getParsed(path, _readSearchAsset)
+    if parsed is not None:
+        yield from parsed[1]
+        return
+    expectedColumns = ['type', 'seq_id', 'concept_id', 'level', 'phrases']
+    acceptedTypeValues = ["EmrCondition"]
+    seen = set()
+
+    with open(path, mode='r', encoding='utf-8') as file:
+        csvReader = csv.reader(file, delimiter=',')
+        headers = list(next(csvReader))
+        rowDataMapper = getFileDataMapperFunc(expectedColumns, headers, True)
+
+        for row in csvReader:
+            type = rowDataMapper("type", row)
+            phrase = rowDataMapper("phrases", row).lower()
+
+            if not type in acceptedTypeValues:
+                raise TypeError(
+                    "!!! WARNING: Unknown format in EmrConditionFinder resource file column 0: code type !!!"
+                )
+
+            if phrase not in seen:
+                seen.add(phrase)
+                yield phrase
+
+
+def _readSearchAsset(path: Path):
     expectedColumns = ['type', 'seq_id', 'concept_id', 'level', 'phrases']
     acceptedTypeValues = ["EmrCondition"]
 
@@ -0,0 +1,47 @@
+'''
+Scores the XGB models of data/xgbModels.py over a FeatureStore, without the text of the notes or spaCy, and writes a
+CSV file with one row per note and one column per model, ie:
+python rescoreFeatureStore.py features/ --output scores.csv --models xgb_3000_hypertension --tree-engine
+
+The models must have been trained on the vectorizer the store was written with (data/xgb_vectorizer.model).
+Reports the number of notes scored and notes per second.
+'''
+from pathlib import Path
+import argparse
+import csv
+import time
+
+from joblib import load
+
+from components.xgb import NumPyTreeEnsemble, scoreFeatureStore
+from data.xgbModels import modelConfigs
+
+
+def loadModels(names=None) -> dict:
+    '''Returns {name: {"model", "concept_id"}} of the models of data/xgbModels.py, or of those named.'''
+    modelDir = Path("data")
+    return {modelDict["name"]: {"model": load(modelDir / modelDict["path"]), "concept_id": modelDict["concept_id"]}
+            for modelDict in modelConfigs if not names or modelDict["name"] in names}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score XGB models over the shards of a feature store.")
+    parser.add_argument("store", type=Path, help="Directory of the feature store.")
+    parser.add_argument("--output", type=Path, default=Path("scores.csv"), help="CSV file to write the outputs to.")
+    parser.add_argument("--models", nargs="*", help="Names of the models to score, all of data/xgbModels.py by default.")
+    parser.add_argument("--tree-engine", action="store_true", help="Score with NumPyTreeEnsemble instead of xgboost.")
+    args = parser.parse_args()
+
+    models = loadModels(args.models)
+    treeEngines = {name: NumPyTreeEnsemble.fromXgbModel(modelConfig["model"]) for name, modelConfig in models.items()} if args.tree_engine else {}
+
+    notes = 0
+    start = time.perf_counter()
+    with open(args.output, mode='w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["note_id"] + list(models))
+        for noteIds, outputs in scoreFeatureStore(args.store, models, treeEngines):
+            writer.writerows(zip(noteIds.tolist(), *(outputs[name].tolist() for name in models)))
+            notes += len(noteIds)
+    seconds = time.perf_counter() - start
+    print(f"{notes} notes scored with {len(models)} models in {seconds:.1f}s ({notes / seconds if seconds else 0.0:.1f} notes/s)")
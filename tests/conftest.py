@@ -0,0 +1,112 @@
+'''
+Builds small pipelines from an in-repo rule table, so that the components can be tested without the data/ directory or
+en_core_web_sm. The rule table, demograph rules and section headers are provided through the spaCy registry, the
+same way as dataFunctions.py does for the real tables.
+'''
+from collections import defaultdict
+from pathlib import Path
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import pytest
+import spacy
+from spacy import registry
+from spacy.language import Language
+
+from components import docResults, helperFunctions, lruCache, matchRecords, ruleGenerations  # noqa: F401 registers the shared helpers first
+from components import (boilerplate, demograph, negation, postProcess, prefilter, ruleBasedMedicalCondition,  # noqa: F401
+                        sectionizer, sentencizer, spellNormalizer, timeBudget)
+from components.tokenizer import customTokenizer
+
+RULES = [
+    ("S1", 320128, 1, "hypertension"),
+    ("S2", 201826, 1, "diabetes"),
+    ("S2", 201826, 2, "type 2"),
+    ("S3", 4329847, 1, "myocardial infarction"),
+    ("S4", 438112, 1, "cancer"),
+    ("S4", 438112, 2, "breast"),
+]
+'''(seq_id, concept id, level, phrase) rows, in the layout of phrase_to_condition.csv.'''
+
+CONCEPT_NAMES = {320128: "Essential hypertension", 201826: "Type 2 diabetes mellitus",
+                 4329847: "Myocardial infarction", 438112: "Neoplastic disease"}
+
+TEXTS = [
+    "Patient is a 80-year-old retired firefighter with hypertension. No diabetes.\n\n"
+    "Family history: breast cancer in mother.\nAssessment: type 2 diabetes, stable.",
+    "Denies myocardial infarction, but has hypertension.",
+    "Rules apply; hypertension ruled out. History of myocardial infarction.",
+    "Lab results only.",
+    "Assessment: hypertension. Plan: follow up. No diabetes, but breast cancer.",
+]
+
+LEMMAS = {"denies": "deny", "ruled": "rule", "declined": "decline"}
+'''Lemmas of the fixture words whose lemma is not their lowercased form, for the lemma negation patterns.'''
+
+PIPELINE = ["emr_time_budget", "custom_sentencizer", "emr_sectionizer", "emr_phrase_matcher", "demograph_matcher",
+            "negation_matcher", "med_cond_detect", "post_process"]
+
+
+@registry.misc("getRuleBasedSearchAsset")
+def getRuleBasedSearchAsset():
+    seqToConcept, levelOne, levelTwo = defaultdict(str), defaultdict(list), defaultdict(list)
+    levels = [seqToConcept, levelOne, levelTwo]
+    for seqId, conceptId, level, phrase in RULES:
+        if level == 1:
+            seqToConcept[seqId] = conceptId
+            levelOne[phrase].append(seqId)
+        else:
+            levels[level][seqId].append(phrase)
+    return (levels, sorted({i[3] for i in RULES}), sorted({i[1] for i in RULES}))
+
+
+@registry.misc("getConceptMap")
+def getConceptMap(conceptIds):
+    return {i: CONCEPT_NAMES[i] for i in conceptIds if i in CONCEPT_NAMES}
+
+
+@registry.misc("getDemographRules")
+def getDemographRules():
+    return [{"cui": "C1", "omopConceptId": 4022069, "label": "retired", "category": "employment", "phrases": ["retired"]},
+            {"cui": "C2", "omopConceptId": 4024315, "label": "firefighter", "category": "occupation",
+             "phrases": ["firefighter", "fireman"]}]
+
+
+@registry.misc("getSectionHeaders")
+def getSectionHeaders():
+    return {"family history": "fam_history", "assessment": "assessment", "plan": "plan"}
+
+
+@Language.component("fixture_lemmas", assigns=["token.lemma"])
+def setFixtureLemmas(doc):
+    '''Sets the lemmas of a doc from LEMMAS, in place of the en_core_web_sm lemmatizer.'''
+    for token in doc:
+        token.lemma_ = LEMMAS.get(token.lower_, token.lower_)
+    return doc
+
+
+def makeNlp(pipeline=PIPELINE, config=None, lemmaFree=True):
+    '''
+    Returns a tokenizer-only pipeline of the named factories, built from the rule table above. config gives the
+    config of each factory, ie. {"emr_phrase_matcher": {"memoSize": 100}}. With lemmaFree=False, the negation patterns
+    match on lemmas, which the pipeline must set (ie. with fixture_lemmas); otherwise negation_matcher is made by the
+    lemma-free factory, as in the rules_fast variant.
+    '''
+    config = config or {}
+    nlp = spacy.blank("en")
+    nlp.tokenizer = customTokenizer(nlp)
+    for name in pipeline:
+        factory = "negation_matcher_lemma_free" if name == "negation_matcher" and lemmaFree else name
+        nlp.add_pipe(factory, name=name, config=config.get(name, {}))
+    for name, component in nlp.pipeline:
+        if name == "negation_matcher":
+            component.build(lemmaFree=lemmaFree)
+        elif hasattr(component, "build"):
+            component.build()
+    return nlp
+
+
+@pytest.fixture
+def nlp():
+    return makeNlp()
@@ -0,0 +1,42 @@
+from spacy import registry
+
+from conftest import PIPELINE, makeNlp
+from components.boilerplate import getLineFingerprint, normalizeLine
+
+BOILERPLATE_PIPELINE = PIPELINE[:2] + ["emr_boilerplate"] + PIPELINE[2:]
+
+LINES = ["This note is confidential. Do not distribute.", "Electronically signed by the attending"]
+
+TEXT = ("This note is confidential. Do not distribute.\n"
+        "Patient has hypertension.\n"
+        "Electronically signed by the attending\n"
+        "physician, who denies diabetes.")
+
+
+def makeMaskingNlp():
+    nlp = makeNlp(BOILERPLATE_PIPELINE)
+    nlp.get_pipe("emr_boilerplate").setAssets((frozenset(getLineFingerprint(normalizeLine(line)) for line in LINES), 20))
+    return nlp
+
+
+def getSentences(doc):
+    return [(sent.start_char, sent.end_char) for sent in doc.sents]
+
+
+def test_only_lines_of_whole_sentences_are_merged():
+    doc = makeMaskingNlp()(TEXT)
+    # the signature line ends within a sentence, so it is left as it is
+    assert doc._.emrBoilerplate == [(0, 45)]
+    assert doc[0].text == LINES[0]
+
+    reference = makeNlp()(TEXT)
+    getDocResults = registry.get("misc", "getDocResults")
+    fields = ["rule_based_emr_items", "rule_based_emr_by_sent", "demograph_by_sent"]
+    assert {field: getDocResults(doc)[field] for field in fields} == {field: getDocResults(reference)[field] for field in fields}
+    assert getSentences(doc)[1:] == getSentences(reference)[2:]
+
+
+def test_masking_can_be_turned_off_per_call():
+    doc = makeMaskingNlp()(TEXT, component_cfg={"emr_boilerplate": {"enabled": False}})
+    assert doc._.emrBoilerplate == []
+    assert getSentences(doc) == getSentences(makeNlp()(TEXT))
@@ -0,0 +1,52 @@
+import spacy
+from spacy import registry
+
+import buildCache
+from conftest import PIPELINE, TEXTS, makeNlp
+from components.tokenizer import customTokenizer
+
+def test_key_follows_the_build_inputs(tmp_path):
+    path = tmp_path/"sections.csv"
+    path.write_text("Family History,family history\n", encoding="utf-8")
+    key = buildCache.getBuildKey("emr_sectionizer", "rules", [path])
+    assert buildCache.getBuildKey("emr_sectionizer", "rules", [path]) == key
+
+    assert buildCache.getBuildKey("emr_sectionizer", "rules_fast", [path]) != key
+    assert buildCache.getBuildKey("emr_sectionizer", "rules", [path], compact=True) != key
+    assert buildCache.getBuildKey("emr_sectionizer", "rules", [path], [("320128", "Essential hypertension")]) != key
+    path.write_text("Family History,fam_history\n", encoding="utf-8")
+    assert buildCache.getBuildKey("emr_sectionizer", "rules", [path]) != key
+
+
+def addPipes():
+    nlp = spacy.blank("en")
+    nlp.tokenizer = customTokenizer(nlp)
+    for name in PIPELINE:
+        nlp.add_pipe("negation_matcher_lemma_free" if name == "negation_matcher" else name, name=name)
+    return nlp
+
+
+def buildPipes(nlp, cacheDir):
+    for name, component in nlp.pipeline:
+        if hasattr(component, "build"):
+            buildCache.buildComponent(nlp, name, "key", cacheDir)
+    return nlp
+
+
+def rebuild(**buildArgs):
+    raise AssertionError("a cached component was built again")
+
+
+def test_restored_components_give_the_results_of_a_build(tmp_path, monkeypatch):
+    buildPipes(addPipes(), tmp_path)
+    assert sorted(i.name for i in tmp_path.iterdir()) == sorted(f"{name}-key" for name, component in makeNlp().pipeline
+                                                                if hasattr(component, "build"))
+
+    nlp = addPipes()
+    for name, component in nlp.pipeline:
+        if hasattr(component, "build"):
+            monkeypatch.setattr(component, "build", rebuild)
+    buildPipes(nlp, tmp_path)
+
+    getDocResults = registry.get("misc", "getDocResults")
+    assert [getDocResults(doc) for doc in nlp.pipe(TEXTS)] == [getDocResults(doc) for doc in makeNlp().pipe(TEXTS)]
@@ -0,0 +1,32 @@
+from collections import defaultdict
+
+from conftest import TEXTS, makeNlp
+from components.ruleBasedMedicalCondition import CompactSearchAsset
+
+
+def getOutputs(doc):
+    return (doc._.rule_based_emr_items, doc._.rule_based_emr_by_sent)
+
+
+def test_compact_rules_match_the_same():
+    reference = makeNlp()
+    compact = makeNlp()
+    compact.get_pipe("med_cond_detect").build(compact=True)
+    assert compact.get_pipe("med_cond_detect").compactAsset is not None
+    for text in TEXTS:
+        assert getOutputs(compact(text)) == getOutputs(reference(text))
+
+
+def test_seq_ids_without_a_concept_read_as_empty(nlp):
+    component = nlp.get_pipe("med_cond_detect")
+    seqToConcept, levelOne, levelTwo = defaultdict(str), defaultdict(list), defaultdict(list)
+    seqToConcept.update({"S1": 320128, "S2": None})
+    levelOne.update({"hypertension": ["S1"], "asthma": ["S2"], "copd": ["S3"]})
+    searchAsset = [seqToConcept, levelOne, levelTwo]
+    compactAsset = CompactSearchAsset.fromSearchAsset(searchAsset)
+
+    tokens = ["hypertension", "asthma", "copd"]
+    # the compact asset is built first, as the dictionary layout adds S3 to seqToConcept when it is looked up
+    compactConditions = component.getConditionsForListOfTokens(tokens, (None, {}, compactAsset))
+    conditions = component.getConditionsForListOfTokens(tokens, (searchAsset, {}, None))
+    assert conditions == compactConditions == [(320128, ["hypertension"]), (None, ["asthma"]), ("", ["copd"])]
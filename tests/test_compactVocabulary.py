@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+import zipfile
+
+import numpy as np
+import pytest
+
+from components.xgb import CompactVocabulary, _mapNpzMember
+
+TERMS = ["hypertension", "type 2 diabetes", "naïve", "ct", "c", ""]
+
+
+def makeVocabulary(terms=TERMS):
+    '''Returns the compact vocabulary of terms, in the shape of a fitted vectorizer, whose vocabulary_ maps terms to columns.'''
+    return CompactVocabulary.fromVectorizer(SimpleNamespace(vocabulary_={term: i for i, term in enumerate(terms)}))
+
+
+def test_terms_are_found_at_their_columns():
+    vocabulary = makeVocabulary()
+    assert len(vocabulary) == len(TERMS)
+    assert vocabulary.getColumns(TERMS).tolist() == list(range(len(TERMS)))
+    assert [vocabulary.getTerm(i) for i in range(len(TERMS))] == TERMS
+    assert vocabulary.getColumns(["cancer", "naive", "hypertension", "Hypertension"]).tolist() == [-1, -1, 0, -1]
+    assert vocabulary.getColumns([]).tolist() == []
+    assert makeVocabulary([]).getColumns(["ct"]).tolist() == [-1]
+
+
+def test_a_term_with_the_hash_of_another_is_not_found():
+    vocabulary = makeVocabulary()
+    # gives "ct" the hash of "cx", as if the two terms collided: their lengths are the same, so their bytes are compared
+    hashes = vocabulary.hashes.copy()
+    hashes[hashes == CompactVocabulary.getHashes([b"ct"])[0]] = CompactVocabulary.getHashes([b"cx"])[0]
+    order = np.argsort(hashes)
+    vocabulary = CompactVocabulary(hashes[order], vocabulary.columns[order], vocabulary.offsets, vocabulary.strings)
+    assert vocabulary.getColumns(["cx", "ct", "c"]).tolist() == [-1, -1, 4]
+
+
+def test_saved_vocabulary_is_loaded_memory_mapped(tmp_path):
+    makeVocabulary().save(tmp_path, "vocabulary")
+    vocabulary = CompactVocabulary.load(tmp_path, "vocabulary")
+    assert isinstance(vocabulary.hashes, np.memmap)
+    assert vocabulary.getColumns(TERMS[::-1]).tolist() == list(range(len(TERMS)))[::-1]
+
+
+def test_npz_members_are_memory_mapped(tmp_path):
+    arrays = {"ints": np.arange(10, dtype=np.int32), "matrix": np.asfortranarray(np.arange(6.0).reshape(2, 3)),
+              "empty": np.zeros((0, 4), dtype=np.float32), "bytes": np.frombuffer(b"ct scan", dtype=np.uint8)}
+    path = tmp_path/"arrays.npz"
+    np.savez(path, **arrays)
+    for name, array in arrays.items():
+        mapped = _mapNpzMember(path, name)
+        assert mapped.dtype == array.dtype and np.array_equal(mapped, array)
+        assert isinstance(mapped, np.memmap) or not array.size
+
+    compressedPath = tmp_path/"compressed.npz"
+    np.savez_compressed(compressedPath, **arrays)
+    with zipfile.ZipFile(compressedPath) as archive:
+        assert archive.getinfo("ints.npy").compress_type != zipfile.ZIP_STORED
+    assert np.array_equal(_mapNpzMember(compressedPath, "matrix"), arrays["matrix"])
+
+    np.savez(tmp_path/"objects.npz", objects=np.array([{"a": 1}], dtype=object))
+    with pytest.raises(ValueError):
+        _mapNpzMember(tmp_path/"objects.npz", "objects")
@@ -0,0 +1,60 @@
+import os
+
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix
+
+from components.xgb import FeatureStore
+
+
+def makeRows(n, offset=0):
+    return csr_matrix(np.arange(offset, offset + 3 * n, dtype=np.float64).reshape(n, 3))
+
+
+def readStore(directory):
+    shards = list(FeatureStore.iterShards(directory, mmap=False))
+    return [i for noteIds, _ in shards for i in noteIds.tolist()], [X.toarray() for _, X in shards]
+
+
+def test_positions_continue_from_stored_rows(tmp_path):
+    with FeatureStore(tmp_path, shardSize=2) as store:
+        store.append(makeRows(3))
+    with FeatureStore(tmp_path, shardSize=2) as store:
+        store.append(makeRows(2, offset=9))
+    noteIds, matrices = readStore(tmp_path)
+    assert noteIds == [0, 1, 2, 3, 4]
+    assert np.array_equal(np.vstack(matrices), makeRows(5).toarray())
+
+
+def test_temporary_shards_are_not_read(tmp_path):
+    with FeatureStore(tmp_path) as store:
+        store.append(makeRows(2), ["a", "b"])
+    # a shard being written by another store, or left behind by one that was killed
+    np.savez(tmp_path/"features-00001-0123456789ab.tmp.npz", data=np.zeros(0))
+    assert readStore(tmp_path)[0] == ["a", "b"]
+    assert FeatureStore(tmp_path).shards == 1
+
+
+def test_stores_written_at_the_same_time_keep_their_shards(tmp_path):
+    first, second = FeatureStore(tmp_path), FeatureStore(tmp_path)
+    first.append(makeRows(1), ["a"])
+    second.append(makeRows(1), ["b"])
+    first.close()
+    second.close()
+    assert sorted(readStore(tmp_path)[0]) == ["a", "b"]
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+def test_forked_process_cannot_write(tmp_path):
+    store = FeatureStore(tmp_path)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            store.append(makeRows(1))
+            os._exit(1)
+        except RuntimeError:
+            os._exit(0)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+    store.close()
+    assert readStore(tmp_path)[0] == []
@@ -0,0 +1,30 @@
+import pytest
+from spacy import registry
+
+from components.incremental import reprocessAmendedNote
+
+NOTE = ("Patient is a retired firefighter with hypertension.\n"
+        "Family history: breast cancer in mother.\n"
+        "Assessment: type 2 diabetes, stable. Denies myocardial infarction.\n"
+        "Plan: follow up.")
+
+AMENDMENTS = {
+    "append": NOTE + "\nAddendum: hypertension controlled.",
+    "in-section edit": NOTE.replace("type 2 diabetes, stable", "type 2 diabetes, worse, and cancer"),
+    "prepend": "Reason for visit: fireman with diabetes.\n" + NOTE,
+    "section removal": NOTE.replace("Family history: breast cancer in mother.\n", ""),
+}
+
+
+@pytest.mark.parametrize("amendment", AMENDMENTS)
+def test_amended_notes_match_a_full_run(nlp, amendment):
+    getDocResults = registry.get("misc", "getDocResults")
+    previousResults = getDocResults(nlp(NOTE))
+    assert previousResults["emrSections"] and previousResults["rule_based_emr_items"]
+
+    amendedText = AMENDMENTS[amendment]
+    doc = reprocessAmendedNote(nlp, NOTE, previousResults, amendedText)
+    expected = getDocResults(nlp(amendedText))
+    results = getDocResults(doc)
+    fields = [i for i in expected if i not in ("sentStarts", "emr_degraded")]
+    assert fields and {i: results[i] for i in fields} == {i: expected[i] for i in fields}
@@ -0,0 +1,40 @@
+'''
+Checks the results read from match records against the results of the baseline components, which stored the
+converted results on the doc. data/baselineOutputs.txt holds (text, results) pairs produced by the baseline components
+on the rule fixture of conftest, with the fixture lemmas, lemma negation patterns and section header patterns built.
+'''
+from ast import literal_eval
+from pathlib import Path
+
+from spacy import registry
+
+from conftest import PIPELINE, makeNlp
+from components.equivalence import compareOutputs, findFirstDifference
+
+BASELINE_FIELDS = ["rule_based_emr_items", "rule_based_emr_by_sent", "demograph", "demograph_by_sent"]
+
+
+def loadBaselineOutputs():
+    with open(Path(__file__).parent/"data"/"baselineOutputs.txt", mode='r', encoding='utf-8') as f:
+        return dict(literal_eval(f.read()))
+
+
+def test_results_match_the_baseline():
+    baseline = loadBaselineOutputs()
+    nlp = makeNlp(["fixture_lemmas"] + PIPELINE, lemmaFree=False)
+    report = compareOutputs(lambda texts: [baseline[text] for text in texts], nlp, list(baseline), fields=BASELINE_FIELDS)
+    assert report["identical"] == report["documents"] == len(baseline), report["examples"]
+
+
+def test_converted_results_are_cached_per_doc():
+    nlp = makeNlp()
+    doc = nlp("Patient has hypertension and diabetes.")
+    items = doc._.rule_based_emr_items
+    assert doc._.rule_based_emr_items is items
+    assert registry.get("misc", "getMatchRecords")(doc, "rule_based_emr_items")
+
+    # records set again replace the cached results
+    registry.get("misc", "setMatchRecords")(doc, "rule_based_emr_items", "sentenceConditions", ())
+    assert doc._.rule_based_emr_items == []
+    doc._.rule_based_emr_items = [{"start": 0}]
+    assert findFirstDifference(doc._.rule_based_emr_items, [{"start": 0}]) is None
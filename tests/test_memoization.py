@@ -0,0 +1,49 @@
+from conftest import TEXTS, makeNlp
+
+MEMO_CONFIG = {name: {"memoSize": 100} for name in ("emr_phrase_matcher", "negation_matcher", "med_cond_detect")}
+
+
+def process(nlp, text, sentStarts=()):
+    '''Runs the pipeline over a text, with sentences also starting at the given token indices.'''
+    doc = nlp.make_doc(text)
+    for i in sentStarts:
+        doc[i].is_sent_start = True
+    for _, component in nlp.pipeline:
+        doc = component(doc)
+    return doc
+
+
+def getOutputs(doc):
+    return (doc._.emrPhrases, doc._.rule_based_emr_items, doc._.rule_based_emr_by_sent)
+
+
+def test_memoized_matches_are_the_same():
+    reference = makeNlp()
+    memoized = makeNlp(config=MEMO_CONFIG)
+    for text in TEXTS * 2:
+        assert getOutputs(process(memoized, text)) == getOutputs(process(reference, text))
+    assert memoized.get_pipe("emr_phrase_matcher").sentenceMemo.hits > 0
+
+
+def test_memoized_matches_across_sentence_boundaries():
+    reference = makeNlp()
+    memoized = makeNlp(config=MEMO_CONFIG)
+    text = "History of myocardial infarction and type 2 diabetes."
+    # sentences starting at "infarction" and at "2" split a phrase and a level 2 phrase
+    for sentStarts in [(), (3,), (7,), (3, 7)]:
+        for _ in range(2):
+            expected = process(reference, text, sentStarts)
+            doc = process(memoized, text, sentStarts)
+            assert getOutputs(doc) == getOutputs(expected)
+    assert (11, 32) in process(memoized, text, (3,))._.emrPhrases
+
+
+def test_memoized_negation_of_unbounded_patterns():
+    reference = makeNlp()
+    memoized = makeNlp(config=MEMO_CONFIG)
+    # "Rules ... out" matches "rule * out" across the sentence boundary after "apply;"
+    text = "Rules apply; hypertension ruled out."
+    for _ in range(2):
+        assert getOutputs(process(memoized, text)) == getOutputs(process(reference, text))
+    negationPhrases = memoized.get_pipe("negation_matcher")._getMemoizedNegationPhrases(process(memoized, text))
+    assert {"start": 0, "end": len(text) - 1} in negationPhrases["NEG_F"]
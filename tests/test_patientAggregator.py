@@ -0,0 +1,44 @@
+from spacy import registry
+
+from conftest import TEXTS
+from components.patientAggregator import PatientAggregator
+
+PATIENTS = ["P2", "P1", "P3", "P1", "P2", "P1", "P3", "P2"]
+
+
+def getNotes(nlp):
+    '''Returns (results, (patientId, noteId)) pairs of the fixture texts, spread over three patients.'''
+    getDocResults = registry.get("misc", "getDocResults")
+    notes = []
+    for i, patientId in enumerate(PATIENTS):
+        results = getDocResults(nlp(TEXTS[i % len(TEXTS)]))
+        results["xgb_summary"] = {"xgb_hypertension": {"concept_id": 320128, "output": i % 2}}
+        notes.append((results, (patientId, f"N{i}")))
+    return notes
+
+
+def aggregate(notes, maxEntries, tmp_path=None):
+    with PatientAggregator(maxEntries=maxEntries, spillDir=tmp_path) as aggregator:
+        aggregator.consume(notes)
+        return list(aggregator.results()), len(aggregator.spills)
+
+
+def test_spilled_aggregates_merge_into_the_in_memory_rollups(nlp, tmp_path):
+    notes = getNotes(nlp)
+    expected, spills = aggregate(notes, 1000000)
+    assert spills == 0
+
+    results, spills = aggregate(notes, 2, tmp_path)
+    assert spills >= 3
+    assert results == expected
+    assert [patientId for patientId, _ in results] == ["P1", "P2", "P3"]
+
+    rollups = dict(results)
+    # the notes of P2 are TEXTS[0], TEXTS[4] and TEXTS[2], each mentioning hypertension, and are spilled separately
+    assert rollups["P2"]["notes"] == 3
+    hypertension = rollups["P2"]["conditions"][320128]
+    assert (hypertension["first"]["note"], hypertension["last"]["note"]) == ("N0", "N7")
+    assert hypertension["first"]["start"] == TEXTS[0].index("hypertension")
+    assert hypertension["last"]["start"] == TEXTS[2].index("hypertension")
+    assert hypertension["mentions"] == hypertension["notes"] == 3
+    assert rollups["P2"]["xgb"]["xgb_hypertension"] == {"concept_id": 320128, "positive": 1, "notes": 3}
@@ -0,0 +1,37 @@
+import spacy
+
+from conftest import makeNlp
+from components.pipelineProfiles import loadForOutputs, resolvePipes
+
+CORE_PIPES = [("tok2vec", "tok2vec"), ("tagger", "tagger"), ("senter", "senter"), ("attribute_ruler", "attribute_ruler"),
+              ("lemmatizer", "lemmatizer")]
+EMR_PIPES = [(name, name) for name in ("custom_sentencizer", "emr_sectionizer", "emr_phrase_matcher",
+                                       "demograph_matcher", "negation_matcher", "med_cond_detect", "post_process")]
+
+
+def test_sentence_starts_do_not_keep_other_components():
+    assert resolvePipes(CORE_PIPES + EMR_PIPES, ["demograph_items"]) == ["custom_sentencizer", "demograph_matcher"]
+
+
+def test_lemmas_keep_other_components():
+    kept = resolvePipes(CORE_PIPES + EMR_PIPES, ["rule_based_emr_items"])
+    assert kept[:len(CORE_PIPES)] == [name for name, _ in CORE_PIPES]
+    assert "demograph_matcher" not in kept
+
+
+def test_lemma_free_negation_does_not_keep_other_components():
+    pipes = [(name, "negation_matcher_lemma_free" if name == "negation_matcher" else factory) for name, factory in EMR_PIPES]
+    kept = resolvePipes(CORE_PIPES + pipes, ["rule_based_emr_items"])
+    assert "negation_matcher" in kept and not set(kept) & {name for name, _ in CORE_PIPES}
+    assert not any(makeNlp().analyze_pipes()["problems"].values())
+
+
+def test_load_for_outputs_skips_disabled_components(tmp_path):
+    nlp = makeNlp()
+    nlp.add_pipe("sentencizer", first=True)
+    nlp.disable_pipe("sentencizer")
+    nlp.to_disk(tmp_path)
+
+    loaded = loadForOutputs(tmp_path, ["demograph_items"])
+    assert loaded.component_names == ["custom_sentencizer", "demograph_matcher"]
+    assert loaded("Retired firefighter.")._.demograph_items
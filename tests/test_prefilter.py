@@ -0,0 +1,50 @@
+from spacy.language import Language
+
+from conftest import PIPELINE, TEXTS, makeNlp
+from components.pipelineProfiles import pipeSkippingRules
+
+PREFILTER_PIPELINE = PIPELINE[:1] + ["emr_prefilter"] + PIPELINE[1:]
+
+FIELDS = ["emrPhrases", "rule_based_emr_items", "rule_based_emr_by_sent", "demograph_items", "emrSections"]
+
+calls = []
+
+
+@Language.component("fixture_tagger", assigns=["token.tag"])
+def tagFixture(doc):
+    '''Stands in for the en_core_web_sm tagger, to count the notes it sees.'''
+    calls.append(doc.text)
+    return doc
+
+
+def getResults(docs):
+    return [{field: getattr(doc._, field) for field in FIELDS} for doc in docs]
+
+
+def test_prefilter_keeps_the_results():
+    texts = TEXTS + ["Breast exam normal.", "Type 2 only."]
+    prefiltered = makeNlp(PREFILTER_PIPELINE)
+    docs = list(prefiltered.pipe(texts))
+    assert getResults(docs) == getResults(makeNlp().pipe(texts))
+    # level 2 phrases are looked up as well, so notes with only "breast" keep their emrPhrases
+    assert [doc._.emrSkipRules for doc in docs] == [False, False, False, True, False, False, False]
+    assert prefiltered.get_pipe("emr_prefilter").getReport()["skipped"] == 1
+
+
+def test_prefilter_skips_nothing_with_the_spell_normalizer():
+    nlp = makeNlp(PREFILTER_PIPELINE[:5] + ["emr_spell_normalizer"] + PREFILTER_PIPELINE[5:])
+    doc = nlp("Patient has hypetension.")
+    assert not doc._.emrSkipRules
+    assert doc._.rule_based_emr_items
+
+
+def test_skipped_notes_bypass_other_components():
+    nlp = makeNlp(PREFILTER_PIPELINE)
+    nlp.add_pipe("fixture_tagger", after="emr_time_budget")
+    calls.clear()
+    texts = TEXTS * 2
+    docs = list(pipeSkippingRules(nlp, texts, batchSize=3))
+    assert [doc.text for doc in docs] == texts
+    assert getResults(docs) == getResults(makeNlp().pipe(texts))
+    assert sorted(calls) == sorted(text for text in texts if text != "Lab results only.")
+    assert [doc._.emrSkipRules for doc in docs] == [text == "Lab results only." for text in texts]
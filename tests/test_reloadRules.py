@@ -0,0 +1,34 @@
+import conftest
+from conftest import makeNlp
+from components.ruleGenerations import reloadRules
+
+TEXT = "Family history: hypertension.\nAssessment: hypertension, retired firefighter."
+
+
+def getOutputs(doc):
+    return (doc._.emrPhrases, doc._.rule_based_emr_items, doc._.demograph_items)
+
+
+def process(nlp, doc, names):
+    '''Runs the named components of the pipeline over a doc.'''
+    for name, component in nlp.pipeline:
+        if name in names:
+            doc = component(doc)
+    return doc
+
+
+def test_reload_is_consistent_for_docs_in_flight(monkeypatch):
+    nlp = makeNlp()
+    names = [name for name, _ in nlp.pipeline]
+    before = getOutputs(process(nlp, nlp.make_doc(TEXT), names))
+    assert before[1]
+
+    # a doc that has gone through the sectionizer before the reload keeps the previous rules in every component
+    inFlight = process(nlp, nlp.make_doc(TEXT), names[:3])
+    monkeypatch.setattr(conftest, "RULES", [("S1", 320128, 1, "firefighter")])
+    reloadRules(nlp, background=False)
+    assert getOutputs(process(nlp, inFlight, names[3:])) == before
+
+    after = getOutputs(process(nlp, nlp.make_doc(TEXT), names))
+    assert after != before
+    assert [code["triggers"] for sentence in after[1] for code in sentence["codes"]] == ["firefighter"]
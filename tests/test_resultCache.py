@@ -0,0 +1,76 @@
+import spacy
+from spacy import registry
+
+import conftest
+from conftest import TEXTS, makeNlp
+from components.resultCache import ResultCache, getPipelineFingerprint
+from components.ruleGenerations import reloadRules
+
+TEXT = "Assessment: hypertension, retired firefighter."
+
+
+def getResults(docs):
+    getDocResults = registry.get("misc", "getDocResults")
+    return [getDocResults(doc) for doc in docs]
+
+
+def getTriggers(doc):
+    return [code["triggers"] for sentence in doc._.rule_based_emr_items for code in sentence["codes"]]
+
+
+def test_hits_restore_the_results_of_a_full_run(nlp):
+    expected = getResults(nlp.pipe(TEXTS))
+    cache = ResultCache(nlp)
+    assert getResults(cache.pipe(TEXTS)) == expected
+    docs = list(cache.pipe(TEXTS + TEXTS[:2]))
+    assert getResults(docs) == expected + expected[:2]
+    assert docs[0]._.emrSections and docs[0]._.emrSections == expected[0]["emrSections"]
+    report = cache.report()
+    assert (report["misses"], report["hits"], report["diskHits"]) == (len(TEXTS), len(TEXTS) + 2, 0)
+
+
+def loadNlp(directory):
+    '''Returns the fixture pipeline saved to and loaded from directory, so that its fingerprint is taken from its files.'''
+    makeNlp().to_disk(directory)
+    return spacy.load(directory)
+
+
+def test_results_are_read_back_from_sqlite(tmp_path):
+    nlp = loadNlp(tmp_path/"pipeline")
+    path = tmp_path/"results.sqlite"
+    cache = ResultCache(nlp, path=path)
+    expected = getResults(cache.pipe(TEXTS))
+    cache.close()
+
+    cache = ResultCache(nlp, path=path)
+    assert getResults(cache.pipe(TEXTS)) == expected
+    assert (cache.report()["diskHits"], cache.report()["misses"]) == (len(TEXTS), 0)
+    cache.close()
+
+
+def test_per_call_config_is_part_of_the_key(nlp):
+    cache = ResultCache(nlp)
+    config = {"emr_sectionizer": {"sectionsAllowed": ["plan"]}}
+    assert getTriggers(next(cache.pipe([TEXT]))) == ["hypertension"]
+    assert getTriggers(next(cache.pipe([TEXT], component_cfg=config))) == []
+    assert cache.report()["misses"] == 2
+
+
+def test_reloaded_rules_invalidate_the_cache(monkeypatch, tmp_path):
+    nlp = loadNlp(tmp_path/"pipeline")
+    fingerprint = getPipelineFingerprint(nlp)
+    path = tmp_path/"results.sqlite"
+    cache = ResultCache(nlp, path=path)
+    assert getTriggers(next(cache.pipe([TEXT]))) == ["hypertension"]
+
+    monkeypatch.setattr(conftest, "RULES", [("S1", 320128, 1, "firefighter")])
+    reloadRules(nlp, background=False)
+    assert getPipelineFingerprint(nlp) != fingerprint
+    assert getTriggers(next(cache.pipe([TEXT]))) == ["firefighter"]
+    cache.close()
+
+    # a new cache on the same file does not read the results of the previous rules either
+    cache = ResultCache(nlp, path=path)
+    assert getTriggers(next(cache.pipe([TEXT]))) == ["firefighter"]
+    assert cache.report()["diskHits"] == 1
+    cache.close()
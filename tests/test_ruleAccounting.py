@@ -0,0 +1,34 @@
+import csv
+
+from conftest import TEXTS
+
+
+def test_accounting_report_counts_the_fixture_rules(nlp, tmp_path):
+    detector = nlp.get_pipe("med_cond_detect")
+    detector.startAccounting()
+    for doc in nlp.pipe(TEXTS):
+        pass
+    path = tmp_path/"rule_accounting.csv"
+    detector.dumpAccountingReport(path, sortBy="fires")
+    assert detector.stopAccounting() is not None
+
+    with open(path, mode='r', encoding='utf-8') as f:
+        rows = list(csv.DictReader(f))
+    counts = [(row["seq_id"], row["concept_id"], row["evaluations"], row["fires"], row["level2_evaluations"], row["level2_hits"])
+              for row in rows]
+    # negated phrases are removed before med_cond_detect: "No diabetes" and "Denies myocardial infarction" are not evaluated
+    assert counts == [("S1", "320128", "4", "4", "0", "0"), ("S4", "438112", "2", "2", "2", "2"),
+                      ("S2", "201826", "1", "1", "1", "1"), ("S3", "4329847", "1", "1", "0", "0")]
+    # the seconds of a rule are those of its deeper levels, level 1 is not timed
+    for row in rows:
+        assert float(row["seconds"]) == float(row["level2_seconds"])
+    assert [float(row["seconds"]) for row in rows if row["seq_id"] in ("S1", "S3")] == [0.0, 0.0]
+
+
+def test_unmatched_rules_have_no_fires(nlp):
+    detector = nlp.get_pipe("med_cond_detect")
+    detector.startAccounting()
+    nlp("Lab results only.")
+    report = detector.getAccountingReport(sortBy="evaluations")
+    assert {row["seqId"]: (row["evaluations"], row["fires"], row["seconds"], row["levels"]) for row in report} == {
+        seqId: (0, 0, 0, {}) for seqId in ("S1", "S2", "S3", "S4")}
@@ -0,0 +1,20 @@
+from conftest import PIPELINE, makeNlp
+
+from components.spellNormalizer import getEditDistance
+
+SPELLING_PIPELINE = PIPELINE[:4] + ["emr_spell_normalizer"] + PIPELINE[4:]
+
+
+def test_edit_distance_counts_transpositions_once():
+    assert getEditDistance("hypertension", "hypertnesion", 2) == 1
+    assert getEditDistance("diabetes", "diabetes", 2) == 0
+    assert getEditDistance("cancer", "dancers", 1) == 2
+
+
+def test_misspelled_phrases_are_detected_only_with_the_normalizer():
+    text = "Patient has hypetension."
+    assert makeNlp()(text)._.rule_based_emr_items == []
+
+    doc = makeNlp(SPELLING_PIPELINE)(text)
+    assert doc._.emrPhrases == {(12, 23): {"text": "hypetension", "type": "normalized_phrase", "normalizedTo": ["hypertension"]}}
+    assert [code["concept_id"] for sentence in doc._.rule_based_emr_items for code in sentence["codes"]] == [320128]
@@ -0,0 +1,25 @@
+import pytest
+
+from conftest import TEXTS, makeNlp
+from components.workerPool import runSingleThread, stressThreads
+from test_memoization import MEMO_CONFIG
+
+TEXTS_WITH_REPEATS = TEXTS + [TEXTS[0].upper(), "No hypertension. " * 20, ""]
+
+
+@pytest.mark.parametrize("config", [None, MEMO_CONFIG], ids=["plain", "memoized"])
+def test_threads_match_single_thread(config):
+    nlp = makeNlp(config=config)
+    reference, _ = runSingleThread(nlp, TEXTS_WITH_REPEATS)
+    report = stressThreads(nlp, TEXTS_WITH_REPEATS, reference, threads=8, rounds=20)
+    assert report["notes"] == 20 * len(TEXTS_WITH_REPEATS)
+    assert report["mismatches"] == 0, report["example"]
+
+
+def test_stress_check_reports_mismatches():
+    nlp = makeNlp()
+    reference, _ = runSingleThread(nlp, TEXTS)
+    reference[1] = dict(reference[1], rule_based_emr_items=[])
+    report = stressThreads(nlp, TEXTS, reference, threads=2, rounds=3)
+    assert report["mismatches"] == 3
+    assert report["example"]["note"] == 1 and report["example"]["field"] == "rule_based_emr_items"
@@ -0,0 +1,84 @@
+import time
+
+from spacy import registry
+from spacy.language import Language
+from spacy.util import minibatch
+
+from conftest import PIPELINE, makeNlp
+
+TEXT = "Denies myocardial infarction, but has hypertension."
+
+
+def test_notes_without_a_budget_are_processed_in_full(nlp):
+    doc = nlp(TEXT)
+    assert doc._.emr_degraded == []
+    assert doc._.emrTimeBudget is None
+    assert [code["triggers"] for sentence in doc._.rule_based_emr_items for code in sentence["codes"]] == ["hypertension"]
+
+
+def test_notes_out_of_time_are_degraded():
+    nlp = makeNlp()
+    doc = nlp(TEXT, component_cfg={"emr_time_budget": {"budgetMs": 1e-6}})
+    # negation scopes are no longer narrowed at "but", so hypertension is negated as well
+    assert doc._.emr_degraded == ["negation_matcher"]
+    assert doc._.rule_based_emr_items == []
+    assert nlp(TEXT)._.emr_degraded == []
+
+
+class BatchStage:
+    '''Stands in for a stage that processes a whole nlp.pipe batch at once, ie. the en_core_web_sm tagger.'''
+
+    def __init__(self, secondsPerDoc):
+        self.secondsPerDoc = secondsPerDoc
+
+    def __call__(self, doc):
+        return next(self.pipe([doc]))
+
+    def pipe(self, docs, batch_size=128):
+        for batch in minibatch(docs, size=batch_size):
+            time.sleep(self.secondsPerDoc * len(batch))
+            yield from batch
+
+
+class SlowStage:
+    '''Stands in for a stage of this package that takes seconds on every doc, and counts them towards its budget.'''
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def __call__(self, doc):
+        with registry.get("misc", "getStageBudget")(doc, "fixture_slow_stage"):
+            time.sleep(self.seconds)
+        return doc
+
+
+@Language.factory("fixture_batch_stage", default_config={"secondsPerDoc": 0.01})
+def createBatchStage(nlp, name, secondsPerDoc):
+    return BatchStage(secondsPerDoc)
+
+
+@Language.factory("fixture_slow_stage", default_config={"seconds": 0.01})
+def createSlowStage(nlp, name, seconds):
+    return SlowStage(seconds)
+
+
+def makeSlowNlp(slowSeconds):
+    pipeline = list(PIPELINE)
+    pipeline.insert(pipeline.index("emr_time_budget") + 1, "fixture_batch_stage")
+    pipeline.insert(pipeline.index("custom_sentencizer") + 1, "fixture_slow_stage")
+    return makeNlp(pipeline, config={"emr_time_budget": {"budgetMs": 200}, "fixture_slow_stage": {"seconds": slowSeconds}})
+
+
+def test_notes_are_not_charged_for_their_batch():
+    nlp = makeSlowNlp(0.01)
+    texts = [TEXT] * 30
+    # the batch stage takes 0.3s for the batch, longer than the budget of any note
+    docs = list(nlp.pipe(texts, batch_size=len(texts)))
+    assert [doc._.emr_degraded for doc in docs] == [[]] * len(texts)
+    assert all(0.01 <= doc._.emrTimeBudget["spent"] < 0.2 for doc in docs)
+
+
+def test_stages_of_a_note_add_up():
+    nlp = makeSlowNlp(0.25)
+    docs = list(nlp.pipe([TEXT] * 3))
+    assert [doc._.emr_degraded for doc in docs] == [["negation_matcher"]] * 3
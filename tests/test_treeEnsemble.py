@@ -0,0 +1,76 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from components.xgb import NumPyTreeEnsemble
+
+# two trees of one split each, as (left, right, feature, condition, default left) per node; leaves hold their value
+TREES = [
+    [(1, 2, 2, 0.5, True), (-1, -1, 0, -1.0, False), (-1, -1, 0, 2.0, False)],
+    [(1, 2, 0, 1.0, False), (-1, -1, 0, 0.5, False), (-1, -1, 0, -0.25, False)],
+]
+
+
+def makeEnsemble(trees, baseMargin=0.0, blockSize=16):
+    nodes, roots = [], []
+    for tree in trees:
+        offset = len(nodes)
+        roots.append(offset)
+        nodes += [(left + offset if left >= 0 else -1, right + offset if right >= 0 else -1, *split)
+                  for left, right, *split in tree]
+    return NumPyTreeEnsemble(*map(list, zip(*nodes)), roots, baseMargin, [0, 1], blockSize)
+
+
+def getMargin(trees, row, baseMargin=0.0):
+    '''Returns the margin of a row (a dict {feature: value}, absent features being missing), one node at a time.'''
+    margin = np.float32(baseMargin)
+    for tree in trees:
+        node = tree[0]
+        while node[0] >= 0:
+            left, right, feature, condition, defaultLeft = node
+            goLeft = defaultLeft if feature not in row else np.float32(row[feature]) < np.float32(condition)
+            node = tree[left if goLeft else right]
+        margin += np.float32(node[3])
+    return margin
+
+
+def toMatrix(rows, features=3):
+    '''Returns the rows as a csr_matrix holding exactly their entries, so that an explicit 0.0 is a value and not a missing value.'''
+    data = [value for row in rows for value in row.values()]
+    indices = [feature for row in rows for feature in row]
+    indptr = np.cumsum([0] + [len(row) for row in rows])
+    return csr_matrix((data, indices, indptr), shape=(len(rows), features))
+
+
+def test_missing_values_take_the_default_child():
+    rows = [{}, {0: 2.0}, {2: 0.0}, {2: 1.0}, {0: 0.0, 2: 1.0}, {1: 5.0}]
+    ensemble = makeEnsemble(TREES)
+    margins = [getMargin(TREES, row) for row in rows]
+    # the first row is missing both split features: the default of tree 0 is left (-1.0), of tree 1 right (-0.25)
+    assert margins[0] == np.float32(-1.25)
+    expected = [int(1 / (1 + np.exp(-margin)) > 0.5) for margin in margins]
+    assert ensemble.predict(toMatrix(rows)).tolist() == expected == [0, 0, 0, 1, 1, 0]
+
+
+def test_rows_decided_early_are_not_evaluated_further(monkeypatch):
+    # the first tree moves the margin far from 0, which the leaves of the small trees after it cannot undo, except for
+    # rows that miss feature 2 and stay close to 0
+    trees = [[(1, 2, 2, 0.5, True), (-1, -1, 0, 0.1, False), (-1, -1, 0, 50.0, False)]]
+    trees += [[(1, 2, 0, 1.0, True), (-1, -1, 0, -0.05, False), (-1, -1, 0, 0.05, False)]] * 6
+    rows = [{2: 1.0}, {}, {0: 2.0}, {2: 1.0, 0: 0.0}]
+    evaluated = []
+    getLeafValues = NumPyTreeEnsemble._getLeafValues
+
+    def recordLeafValues(self, dense, rows, treeStart, treeEnd):
+        evaluated.append(len(rows))
+        return getLeafValues(self, dense, rows, treeStart, treeEnd)
+
+    monkeypatch.setattr(NumPyTreeEnsemble, "_getLeafValues", recordLeafValues)
+    predictions = makeEnsemble(trees, blockSize=1).predict(toMatrix(rows))
+    # rows with feature 2 are decided by the first tree; the margin of the others moves by 0.05 a tree, so the row with
+    # feature 0 is decided once its margin (0.1 + 0.05 a tree) exceeds what the remaining trees can take off, and the row
+    # missing both features (0.1 - 0.05 a tree) once it can no longer get above 0
+    assert evaluated == [4, 2, 2, 2, 1]
+
+    expected = [int(1 / (1 + np.exp(-getMargin(trees, row))) > 0.5) for row in rows]
+    assert predictions.tolist() == expected == [1, 0, 1, 1]
+    assert makeEnsemble(trees, blockSize=len(trees)).predict(toMatrix(rows)).tolist() == expected
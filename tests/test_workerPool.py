@@ -0,0 +1,95 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from spacy import registry
+
+from conftest import TEXTS, makeNlp
+from components.workerPool import PreforkPool, ThreadedPool, makeLengthBatches
+
+
+def getSerialResults(nlp, texts):
+    '''Returns the results of the texts processed on this thread, with the result extensions the pools register.'''
+    registry.get("misc", "ensureResultExtensions")()
+    getDocResults = registry.get("misc", "getDocResults")
+    return [getDocResults(doc) for doc in nlp.pipe(texts)]
+
+
+def test_length_batches_cover_every_text_once():
+    texts = ["a" * length for length in (400, 10, 90, 10, 4000, 30)]
+    batches = makeLengthBatches(texts, tokenBudget=100, maxBatchSize=2)
+    assert sorted(i for batch in batches for i in batch) == list(range(len(texts)))
+    assert batches[0] == [4]
+    assert all(len(batch) <= 2 for batch in batches)
+
+
+def test_threaded_pool_matches_serial_results():
+    nlp = makeNlp()
+    texts = TEXTS * 4
+    expected = getSerialResults(nlp, texts)
+    with ThreadedPool(nlp, threads=4, batchSize=3) as pool:
+        assert list(pool.pipe(texts)) == expected
+
+
+def test_prefork_pool_matches_serial_results():
+    nlp = makeNlp()
+    texts = TEXTS * 4
+    expected = getSerialResults(nlp, texts)
+    with PreforkPool(nlp, workers=2, batchSize=3) as pool:
+        assert list(pool.pipe(texts)) == expected
+        assert list(pool.pipe(texts, tokenBudget=20)) == expected
+        report = pool.report()
+    assert set(report["workers"]) and report["growth"]["retired"] == 0
+
+
+def test_prefork_pool_starts_once_from_several_threads():
+    nlp = makeNlp()
+    pool = PreforkPool(nlp, workers=2)
+    try:
+        # the first calls of several threads start the pool, which must fork the workers only once
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(pool, TEXTS * 4))
+        assert results == getSerialResults(nlp, TEXTS * 4)
+        assert len(pool.processes) == 2
+    finally:
+        pool.close()
+
+
+def test_prefork_pool_raises_worker_errors():
+    nlp = makeNlp()
+    with PreforkPool(nlp, workers=1) as pool:
+        with pytest.raises(RuntimeError, match="Worker failed"):
+            pool.wait(pool.submit(TEXTS, component_cfg={"emr_sectionizer": {"unknownArgument": True}}))
+        assert pool(TEXTS[1]) == getSerialResults(nlp, TEXTS[1:2])[0]
+
+
+def test_prefork_pool_recycles_every_worker_once():
+    nlp = makeNlp()
+    expected = getSerialResults(nlp, TEXTS * 4)
+    with PreforkPool(nlp, workers=2, batchSize=2) as pool:
+        assert list(pool.pipe(TEXTS * 4)) == expected
+        pids = {process.pid for process in pool.processes}
+        pool.recycle()
+        # idle workers see their retire event within a second; a replacement is never retired by the same call
+        assert list(pool.pipe(TEXTS * 4)) == expected
+        while len(pool.retired) < 2:
+            pool(TEXTS[3])
+        assert list(pool.pipe(TEXTS * 4)) == expected
+        assert {stats["pid"] for stats in pool.retired} == pids
+        assert len(pool.retired) == 2 and not pids & {process.pid for process in pool.processes}
+
+
+def test_prefork_pool_replaces_workers_after_their_batches():
+    nlp = makeNlp()
+    expected = getSerialResults(nlp, TEXTS * 4)
+    with PreforkPool(nlp, workers=2, batchSize=2, maxBatchesPerWorker=1) as pool:
+        assert list(pool.pipe(TEXTS * 4)) == expected
+        assert len(pool.retired) >= 8
+
+
+def test_prefork_pool_makes_docs_without_growing_the_parent_vocab():
+    nlp = makeNlp()
+    with PreforkPool(nlp, workers=1) as pool:
+        strings = len(nlp.vocab.strings)
+        docs = list(pool.pipe(["Patient is a zymurgist with hypertension."], asDocs=True))
+        assert docs[0]._.rule_based_emr_items == getSerialResults(makeNlp(), [docs[0].text])[0]["rule_based_emr_items"]
+        assert len(nlp.vocab.strings) == strings